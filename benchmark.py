@@ -0,0 +1,1292 @@
+# Benchmark harness: runs the app in-process against local stand-ins for Mistral, text-to-speech and speech
+# recognition (each with configurable latency and jitter), drives it through headless Socket.IO clients and
+# writes the results as JSON, so runs can be compared for regressions.
+#
+#   python benchmark.py --sessions 8 --messages 5 --output before.json
+#   python benchmark.py --sessions 8 --messages 5 --output after.json --compare before.json
+#
+# Scenarios: 'text' sends typed messages, 'voice' streams microphone PCM and ends the utterance,
+# 'segmenter' replays fixtures/medical_answers.txt through the TTS segmenter without a server, next to
+# the plain sentence split it replaced, and
+# 'cancel' interrupts answers with a new message and measures how quickly the abandoned work stops
+# (time to free the LLM and TTS threads, Mistral tokens still generated after the interruption).
+# 'engines' synthesizes corpus sentences with each real TTS engine that is available here (gtts needs
+# network access, espeak and piper their programs) and the stub, and reports time to the first audio
+# byte and CPU per sentence, including the engine's child processes. 'connections' sends sequential
+# requests straight to the stub Mistral server with and without connection reuse, where every new
+# connection costs --llm-connect-delay (standing in for the TCP and TLS handshakes to the real API).
+# 'tts_overhead' times the per-sentence overhead of the original temp-file gTTS path against the
+# in-memory one, with gTTS faked out so only the handling around synthesis is measured. 'pacing' runs
+# the text scenario with clients that play the audio back (--playback) under backpressure and under the
+# old fixed pause after every sentence, and reports how far the text runs ahead of the speech.
+# 'scale' runs the app in a child process (--serve), opens --scale-sockets concurrent Socket.IO
+# connections that each ask --messages questions spread over --scale-ramp seconds, and reports the
+# server's thread count, memory and throughput, for the asyncio core and for --thread-per-message, which
+# stands in for the original server's thread per message. Both modes share the threading Socket.IO
+# transport, so the threads it holds per socket are reported separately.
+# 'tts_pipeline' submits the --tts-pipeline-sentences sentences of an answer straight to the TTS pipeline with an engine that
+# takes --tts-latency seconds per sentence, and times until the last sentence's audio is sent, with the
+# configured TTS pool and with one worker (the single tts_worker the pipeline replaced).
+# Every client also checks that the text and audio it receives belong to its own questions; any
+# message that does not counts as an isolation violation and makes the run exit with status 1.
+import argparse
+import array
+import asyncio
+import base64
+import json
+import logging
+import os
+import platform
+import random
+import re
+import resource
+import select
+import shutil
+import socket
+import tempfile
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import socketio
+from gtts import gTTS
+
+# Keep the app's own logging out of the way unless asked for
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+import python as app
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CORPUS_PATH = os.path.join(ROOT, 'fixtures', 'medical_answers.txt')
+
+QUESTIONS = [
+    "I have a headache after working all day",
+    "What should I take for a cold",
+    "How do I treat a small burn on my hand",
+    "I get heartburn after dinner",
+    "I twisted my ankle while running",
+    "I have a fever of 38.5 degrees",
+    "My allergies are bad this spring",
+    "I have had diarrhea since yesterday",
+    "My throat is sore and scratchy",
+    "A mosquito bite on my arm is very itchy",
+]
+
+SCENARIOS = ['text', 'voice', 'segmenter', 'cancel', 'engines', 'connections', 'tts_overhead', 'pacing', 'scale',
+             'tts_pipeline']
+
+SAMPLE_RATE = 16000
+CHUNK_SECONDS = 0.1
+# Room noise before a stub utterance's speech starts
+LEAD_IN_SECONDS = 0.5
+# First samples of a stub utterance; the rest of the header carries the question for StubSpeechStream
+UTTERANCE_MAGIC = [17, 42, 99, 7]
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, encoding='utf-8') as f:
+        return [answer.strip() for answer in f.read().split('\n\n') if answer.strip()]
+
+def jittered(base, jitter, rng=random):
+    return max(0.0, base * (1 + rng.uniform(-jitter, jitter)))
+
+def summarize(values):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    def rank(p):
+        return values[min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1)]
+    return {'count': len(values), 'mean': statistics.mean(values), 'p50': rank(50), 'p90': rank(90),
+            'p99': rank(99), 'max': values[-1]}
+
+def memory_mb():
+    usage = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    usage[line.split(':')[0]] = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {'rss_mb': usage.get('VmRSS'), 'peak_rss_mb': usage.get('VmHWM', peak)}
+
+# Thread count and memory of another process, from /proc
+def process_status(pid):
+    status = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('Threads', 'VmRSS'):
+                    status[key] = int(value.split()[0])
+    except OSError:
+        pass
+    rss = status.get('VmRSS')
+    return {'threads': status.get('Threads'), 'rss_mb': rss / 1024 if rss is not None else None}
+
+def stub_answer(corpus, question):
+    return corpus[sum(map(ord, question)) % len(corpus)]
+
+# The stub TTS engine starts each sentence's audio with AUDIO_MARKER, the text length and the text,
+# so a client can tell which sentence a clip or first chunk was synthesized from
+AUDIO_MARKER = b'STUB'
+
+def audio_text(audio):
+    start = audio.find(AUDIO_MARKER, 0, 64)
+    if start < 0:
+        return None
+    length = int.from_bytes(audio[start + 4:start + 6], 'little')
+    return audio[start + 6:start + 6 + length].decode('utf-8', 'replace')
+
+# Mistral chat-completions stand-in: answers come from the fixture corpus, streamed token by token
+# (server-sent events) or returned whole, after a first-byte delay and a per-token delay. Every
+# request is logged in server.requests, including how many tokens it sent and whether the app
+# hung up before the end.
+class StubMistralHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    # Runs once per connection. Like a real API front end, writes go out at once (no Nagle delay waiting
+    # for the client to acknowledge the headers before the body is sent).
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.connections += 1
+        time.sleep(self.server.config['connect_delay'])
+
+    def do_POST(self):
+        config = self.server.config
+        rng = random.Random()
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        question = request['messages'][-1]['content']
+        tokens = re.findall(r'\s*\S+', stub_answer(config['corpus'], question))
+        usage = {'prompt_tokens': sum(len(m['content']) for m in request['messages']) // 4,
+                 'completion_tokens': len(tokens)}
+        record = {'question': question, 'started': time.perf_counter(), 'ended': None, 'tokens': 0,
+                  'total_tokens': len(tokens), 'aborted': False}
+        self.server.requests.append(record)
+        try:
+            self._respond(request, tokens, usage, record, config, rng)
+        except (BrokenPipeError, ConnectionResetError):
+            record['aborted'] = True
+        record['ended'] = time.perf_counter()
+        if record['aborted']:
+            self.close_connection = True
+
+    def _respond(self, request, tokens, usage, record, config, rng):
+        if self._closed(jittered(config['first_byte'], config['jitter'], rng)):
+            record['aborted'] = True
+            return
+
+        if not request.get('stream'):
+            if self._closed(sum(jittered(config['token_delay'], config['jitter'], rng) for _ in tokens)):
+                record['aborted'] = True
+                return
+            record['tokens'] = len(tokens)
+            body = json.dumps({'choices': [{'message': {'content': "".join(tokens)}}], 'usage': usage}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i, token in enumerate(tokens):
+            if i and self._closed(jittered(config['token_delay'], config['jitter'], rng)):
+                record['aborted'] = True
+                return
+            self._event({'choices': [{'delta': {'content': token}}]})
+            record['tokens'] += 1
+        self._event({'choices': [], 'usage': usage})
+        self._chunk(b'data: [DONE]\n\n')
+        self._chunk(b'')
+
+    # Wait for delay seconds, or until the app hangs up; returns True if it did
+    def _closed(self, delay):
+        readable, _, _ = select.select([self.connection], [], [], delay)
+        return bool(readable) and not self.connection.recv(1, socket.MSG_PEEK)
+
+    def _event(self, payload):
+        self._chunk(f"data: {json.dumps(payload)}\n\n".encode())
+
+    def _chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+class StubMistralServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # The app hanging up on a cancelled answer is expected
+    def handle_error(self, request, client_address):
+        pass
+
+def start_stub_mistral(args, corpus):
+    server = StubMistralServer(('127.0.0.1', 0), StubMistralHandler)
+    server.config = {'corpus': corpus, 'first_byte': args.llm_first_byte, 'token_delay': args.llm_token_delay,
+                     'jitter': args.jitter, 'connect_delay': args.llm_connect_delay}
+    server.requests = []
+    server.connections = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Program run by StubTTSEngine: reads the text, waits the synthesis latency and writes silent PCM as
+# long as the text would take to say, in chunks spread over the per-character synthesis time. The
+# first bytes carry AUDIO_MARKER and the text.
+STUB_TTS_PROGRAM = """
+import random, sys, time
+latency, per_char, jitter, chars_per_second, sample_rate, chunks_per_second = map(float, sys.argv[1:])
+text = sys.stdin.read()
+encoded = text.encode('utf-8')
+marker = b'STUB' + len(encoded).to_bytes(2, 'little') + encoded
+def jittered(base):
+    return max(0.0, base * (1 + random.uniform(-jitter, jitter)))
+duration = len(text) / chars_per_second
+chunks = max(1, int(duration * chunks_per_second))
+chunk = bytes(int(sample_rate * duration / chunks) * 2)
+time.sleep(jittered(latency))
+for i in range(chunks):
+    time.sleep(jittered(per_char * len(text) / chunks))
+    sys.stdout.buffer.write((marker + chunk)[:len(chunk)] if i == 0 else chunk)
+    sys.stdout.buffer.flush()
+"""
+
+# Text-to-speech stand-in: a local engine like espeak or Piper, so the app runs (and cancels) a real
+# process per sentence; its latency includes the interpreter starting up
+class StubTTSEngine(app.SubprocessTTSEngine):
+    name = 'stub'
+    voice = 'stub'
+    sample_rate = SAMPLE_RATE
+    chunks_per_second = 4
+
+    def __init__(self, latency, per_char, jitter):
+        self.latency = latency
+        self.per_char = per_char
+        self.jitter = jitter
+
+    def command(self):
+        return [sys.executable, '-c', STUB_TTS_PROGRAM] + [str(value) for value in (
+            self.latency, self.per_char, self.jitter, app.SPEECH_CHARS_PER_SECOND, self.sample_rate, self.chunks_per_second)]
+
+# Speech recognition stand-in: the benchmark client puts the question in the first audio chunk; partial
+# transcripts reveal one more word per chunk of speech, and the final result comes after a latency
+class StubSpeechBackend:
+    name = 'stub'
+
+    def __init__(self, chunk_latency, latency, jitter):
+        self.chunk_latency = chunk_latency
+        self.latency = latency
+        self.jitter = jitter
+
+    def start(self, sample_rate):
+        return StubSpeechStream(self)
+
+class StubSpeechStream:
+    def __init__(self, backend):
+        self.backend = backend
+        self.words = []
+        self.heard = 0
+
+    def accept(self, chunk):
+        time.sleep(jittered(self.backend.chunk_latency, self.backend.jitter))
+        samples = array.array('h', chunk)
+        if list(samples[:4]) == UTTERANCE_MAGIC:
+            length = samples[4]
+            self.words = bytes(samples[5:5 + length]).decode('utf-8').split()
+            return None
+        if app.pcm_rms(chunk) > app.STT_MIN_SPEECH_RMS:
+            self.heard += 1
+        return " ".join(self.words[:self.heard]) or None
+
+    def finish(self):
+        time.sleep(jittered(self.backend.latency, self.backend.jitter))
+        if not self.words:
+            raise app.sr.UnknownValueError()
+        return " ".join(self.words)
+
+def utterance_chunks(question, speech_seconds, rng):
+    samples_per_chunk = int(SAMPLE_RATE * CHUNK_SECONDS)
+    encoded = question.encode('utf-8')
+    header = UTTERANCE_MAGIC + [len(encoded)] + list(encoded)
+    quiet = [array.array('h', (rng.randint(-20, 20) for _ in range(samples_per_chunk))).tobytes()
+             for _ in range(int(LEAD_IN_SECONDS / CHUNK_SECONDS))]
+    quiet[0] = array.array('h', header + [0] * (samples_per_chunk - len(header))).tobytes()
+    loud = [array.array('h', (rng.randint(-6000, 6000) for _ in range(samples_per_chunk))).tobytes()
+            for _ in range(int(speech_seconds / CHUNK_SECONDS))]
+    return quiet + loud
+
+# Work still running in the app for an abandoned answer: threads inside the Mistral request for
+# question, or synthesizing one of the sentences of answer
+def abandoned_work(question, answer):
+    llm = tts = 0
+    for frame in sys._current_frames().values():
+        while frame is not None:
+            if frame.f_code.co_filename == app.__file__:
+                name, local = frame.f_code.co_name, frame.f_locals
+                if name in ('stream_medical_response', 'get_medical_response') and local.get('user_input') == question:
+                    llm += 1
+                    break
+                if name == 'stream' and isinstance(local.get('text'), str) and local['text'] in answer:
+                    tts += 1
+                    break
+            frame = frame.f_back
+    return llm, tts
+
+# One browser tab: sends messages one after another and timestamps what comes back
+class BenchmarkClient:
+    def __init__(self, url, index, args, corpus, stub):
+        self.url = url
+        self.args = args
+        self.corpus = corpus
+        self.stub = stub
+        self.session_id = f"benchmark-{os.getpid()}-{index}"
+        # With --same-questions every client asks the same questions at the same time
+        self.rng = random.Random(args.seed + (0 if args.same_questions else index))
+        self.sio = socketio.Client(reconnection=False)
+        self.current = None
+        self.final = threading.Event()
+        self.audio = threading.Event()
+        self.results = []
+        self.interruptions = []
+        # Answer tokens seen so far; messages of an abandoned answer (stale_token or older) are ignored
+        self.last_token = 0
+        self.stale_token = 0
+        # Answers (whitespace-normalized) to the questions this client asked, and messages that matched none
+        self.answers = []
+        self.checked = 0
+        self.violations = []
+        self.connected = False
+        # With --playback, audio "plays" back to back in arrival order and the client reports how many
+        # sentences are waiting or playing, like static/app.js does
+        self.playback_lock = threading.Lock()
+        self.scheduled = []  # (seq, end of playback) of audio not played to the end yet
+        self.playback_end = 0.0
+        self.reported_depth = 0
+        for event in ('response_stream', 'play_audio', 'play_audio_chunk', 'speech_recognized', 'busy', 'error_message'):
+            self.sio.on(event, partial(self._on, event))
+
+    def _on(self, event, data=None):
+        now = time.perf_counter()
+        self._check(event, data)
+        record = self.current
+        if record is None:
+            return
+        token = data.get('message_id', data.get('token')) if isinstance(data, dict) else None
+        if token is not None:
+            if token <= self.stale_token:
+                return
+            self.last_token = max(self.last_token, token)
+        if event == 'response_stream':
+            if record['first_text'] is None and data.get('delta'):
+                record['first_text'] = now
+            if data.get('delta') and not data.get('is_final'):
+                record['sentences'].setdefault(data['seq'], {}).setdefault('text', now)
+            if data.get('is_final'):
+                record['final_text'] = now
+                record['prompt_tokens'] = data.get('prompt_tokens')
+                self.final.set()
+        elif event in ('play_audio', 'play_audio_chunk'):
+            if record['first_audio'] is None:
+                record['first_audio'] = now
+            record['last_audio'] = now
+            record['audio_bytes'] += len(data.get('audio') or data.get('audio_data') or b'')
+            if data['seq'] < record['audio_seq']:
+                record['audio_out_of_order'] += 1
+            record['audio_seq'] = max(record['audio_seq'], data['seq'])
+            sentence = record['sentences'].setdefault(data['seq'], {})
+            sentence.setdefault('audio', now)
+            if self.args.playback:
+                self._play(sentence, data)
+            self.audio.set()
+        elif event == 'speech_recognized':
+            record['recognized'] = now
+        elif event == 'busy':
+            record['busy'] = data.get('kind')
+            if data.get('kind') != 'tts':
+                self.final.set()
+        elif event == 'error_message':
+            record['error'] = data.get('message')
+            self.final.set()
+
+    # Answers this client may receive for question: with speculation on, a voice question may also be
+    # answered from one of its partial transcripts
+    def _expect(self, scenario, question):
+        words = question.split()
+        prompts = [question]
+        if scenario == 'voice' and not self.args.no_speculation:
+            prompts += [" ".join(words[:n]) for n in range(app.SPECULATION_MIN_WORDS, len(words))]
+        self.answers += [" ".join(stub_answer(self.corpus, prompt).split()) for prompt in prompts]
+
+    # Every text delta and every sentence's first audio must come from an answer to this client's questions
+    def _check(self, event, data):
+        if event == 'response_stream':
+            texts = [data.get('delta'), data.get('text')]
+        elif event == 'play_audio' or (event == 'play_audio_chunk' and data.get('chunk_seq') == 0):
+            audio = data.get('audio') or base64.b64decode(data.get('audio_data') or '')
+            texts = [audio_text(audio)]
+            if texts[0] is None:
+                self.violations.append({'event': event, 'text': None})
+                return
+        else:
+            return
+        for text in texts:
+            text = " ".join((text or "").split())
+            if not text:
+                continue
+            self.checked += 1
+            if not any(text in answer for answer in self.answers):
+                self.violations.append({'event': event, 'text': text[:80]})
+
+    # Queue a clip or chunk behind the audio already playing
+    def _play(self, sentence, data):
+        audio = data.get('audio') or base64.b64decode(data.get('audio_data') or '')
+        if audio.startswith(b'RIFF'):
+            audio = audio[44:]
+        duration = len(audio) / (data.get('sample_rate') or SAMPLE_RATE) / 2 / self.args.playback_speed
+        with self.playback_lock:
+            start = max(time.perf_counter(), self.playback_end)
+            self.playback_end = start + duration
+            self.scheduled.append((data['seq'], self.playback_end))
+            sentence.setdefault('played', start)
+            sentence['ended'] = self.playback_end
+        self._report_depth()
+
+    def _report_depth(self):
+        with self.playback_lock:
+            now = time.perf_counter()
+            self.scheduled = [(seq, end) for seq, end in self.scheduled if end > now]
+            depth = len({seq for seq, _ in self.scheduled})
+            if depth == self.reported_depth:
+                return
+            self.reported_depth = depth
+        self.sio.emit('playback_status', {'queue_depth': depth})
+
+    def _playback(self, stopped):
+        while not stopped.wait(0.01):
+            self._report_depth()
+
+    # start_barrier (a Barrier or an Event) holds the questions back until every client is connected
+    def run(self, scenario, start_barrier, delay=0.0):
+        self.sio.connect(self.url, auth={'session_id': self.session_id},
+                         transports=['polling'] if self.args.polling else ['websocket'])
+        self.sio.emit('client_capabilities', {'binary_audio': self.args.transport == 'binary'})
+        self.connected = True
+        stopped = threading.Event()
+        if self.args.playback:
+            threading.Thread(target=self._playback, args=(stopped,), daemon=True).start()
+        if start_barrier:
+            start_barrier.wait()
+        time.sleep(delay)
+        try:
+            for i in range(self.args.messages):
+                question = QUESTIONS[self.rng.randrange(len(QUESTIONS))]
+                if scenario == 'cancel':
+                    self._interrupt(question, self.args.interrupt_after[i % len(self.args.interrupt_after)])
+                    continue
+                if self.args.messages > 1:
+                    question = f"{question}, follow-up {i + 1}" if i else question
+                self._ask(scenario, question)
+                time.sleep(self.args.think_time)
+        finally:
+            stopped.set()
+            self.sio.disconnect()
+
+    # Ask question, replace it with another one after the given delay, and measure how long the
+    # abandoned answer keeps work running in the app and at the upstream API
+    def _interrupt(self, question, after):
+        answer = stub_answer(self.corpus, question)
+        follow_up = self.rng.choice([q for q in QUESTIONS if stub_answer(self.corpus, q) != answer])
+        self.current = dict(self._record(), sent=time.perf_counter())
+        self._expect('text', question)
+        self.sio.emit('send_message', {'message': question})
+        time.sleep(after)
+
+        interrupted = time.perf_counter()
+        self.stale_token = self.last_token
+        llm, tts = abandoned_work(question, answer)
+        upstream = next((r for r in reversed(self.stub.requests) if r['question'] == question), None)
+        result = {'llm_running': llm, 'tts_running': tts, 'freed': None,
+                  'upstream': upstream, 'upstream_running': bool(upstream) and upstream['ended'] is None,
+                  'upstream_tokens': upstream['tokens'] if upstream else 0}
+
+        def watch():
+            while time.perf_counter() - interrupted < self.args.timeout:
+                if abandoned_work(question, answer) == (0, 0):
+                    result['freed'] = time.perf_counter() - interrupted
+                    return
+                time.sleep(0.001)
+        watcher = threading.Thread(target=watch)
+        watcher.start()
+        self._ask('text', follow_up, sent=interrupted)
+        watcher.join()
+
+        if upstream:
+            result['upstream_tokens'] = upstream['tokens'] - result['upstream_tokens']
+            result['upstream_aborted'] = upstream['aborted']
+            result['upstream_ended'] = upstream['ended'] - interrupted if upstream['ended'] else None
+        result['follow_up'] = self.results[-1]
+        self.interruptions.append(result)
+
+    @staticmethod
+    def _record():
+        return {'first_text': None, 'first_audio': None, 'final_text': None, 'last_audio': None, 'recognized': None,
+                'audio_bytes': 0, 'prompt_tokens': None, 'busy': None, 'error': None, 'playback_end': None,
+                'sentences': {}, 'audio_seq': 0, 'audio_out_of_order': 0}
+
+    def _ask(self, scenario, question, sent=None):
+        self.final.clear()
+        self.audio.clear()
+        # Like the browser, drop whatever still arrives for an earlier answer
+        self.stale_token = self.last_token
+        record = self._record()
+        self._expect(scenario, question)
+        if scenario == 'voice':
+            chunks = utterance_chunks(question, self.args.speech_seconds, self.rng)
+            self.current = record
+            self.sio.emit('start_voice_input', {'sample_rate': SAMPLE_RATE})
+            for chunk in chunks:
+                self.sio.emit('audio_chunk', chunk)
+                time.sleep(CHUNK_SECONDS)
+            # Latencies of a voice question count from the end of speech
+            record['sent'] = time.perf_counter()
+            self.sio.emit('end_voice_input')
+        else:
+            record['sent'] = sent or time.perf_counter()
+            self.current = record
+            self.sio.emit('send_message', {'message': question})
+        self.final.wait(self.args.timeout)
+        # Audio keeps coming after the final text; the answer is done once it has been quiet for a while
+        while self.audio.wait(self.args.audio_quiet):
+            self.audio.clear()
+        if self.args.playback:
+            # Let the answer finish playing before the next question
+            record['playback_end'] = self.playback_end
+            time.sleep(max(0.0, self.playback_end - time.perf_counter()))
+        self.current = None
+        self.results.append(record)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+# The server before the asyncio core ran each answer and each recognition on a thread of its own
+# (a threading.Thread per send_message and start_voice_input) that lived until the work was done. With
+# --thread-per-message every answer and recognition task gets such a thread, blocked until the task
+# finishes, so the server carries the same threads while the work itself is unchanged.
+def thread_per_message():
+    def shadowed(start, attribute):
+        def shadow(session, *args, **kwargs):
+            result = start(session, *args, **kwargs)
+            threading.Thread(target=wait_for_task, args=(session, attribute), daemon=True).start()
+            return result
+        return shadow
+    app.Session.start_answer = shadowed(app.Session.start_answer, 'answer_task')
+    app.Session.start_listening = shadowed(app.Session.start_listening, 'listen_task')
+
+# The task is created on answer_loop by a callback queued before this coroutine
+def wait_for_task(session, attribute):
+    async def finished():
+        task = getattr(session, attribute)
+        if task:
+            await asyncio.wait([task])
+    asyncio.run_coroutine_threadsafe(finished(), app.answer_loop).result()
+
+# Returns the app's URL and the stub Mistral server, which is only started when no endpoint is given
+def start_app(args, corpus, port=None, endpoint=None):
+    stub = None
+    if endpoint is None:
+        stub = start_stub_mistral(args, corpus)
+        endpoint = f"http://127.0.0.1:{stub.server_port}/v1/chat/completions"
+    app.mistral_client.endpoint = endpoint
+    app.mistral_client.reuse_connections = not args.no_connection_reuse
+    app.MISTRAL_STREAM = not args.no_stream
+    app.TTS_ENGINES['stub'] = partial(StubTTSEngine, args.tts_latency, args.tts_per_char, args.jitter)
+    app.TTS_ENGINE = 'stub'
+    app.TTS_STREAM_AUDIO = not args.no_tts_stream
+    app._tts_engine = None
+    app.SPEECH_BACKENDS['stub'] = partial(StubSpeechBackend, args.stt_chunk_latency, args.stt_latency, args.jitter)
+    app.STT_BACKEND = 'stub'
+    app._speech_backend = None
+    app.SPECULATION_ENABLED = not args.no_speculation
+    app.MAX_CLIENT_AUDIO_QUEUE = args.max_client_audio_queue
+    app.MAX_TTS_PIPELINE_LAG = args.max_tts_pipeline_lag
+    if args.thread_per_message:
+        thread_per_message()
+    # The development server logs the WebSocket close handshake as a bad request
+    logging.getLogger('werkzeug').setLevel(logging.CRITICAL)
+
+    port = port or free_port()
+    threading.Thread(target=app.socketio.run, args=(app.app,), daemon=True,
+                     kwargs={'host': '127.0.0.1', 'port': port, 'allow_unsafe_werkzeug': True}).start()
+    url = f"http://127.0.0.1:{port}"
+    wait_until_serving(url)
+    return url, stub
+
+def wait_until_serving(url, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            requests.get(f"{url}/pools", timeout=1)
+            return
+        except requests.exceptions.ConnectionError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+# Fresh caches and metrics for each scenario, so one run does not warm the next
+def reset_app(args):
+    app.response_cache = app.ResponseCache(app.RESPONSE_CACHE_SIZE if args.warm_caches else 0)
+    if not args.warm_caches:
+        app.tts_cache = app.AudioCache(0, None, 0)
+    app.stage_metrics = app.StageMetrics()
+    app.llm_flights = app.SingleFlight('llm')
+    app.tts_flights = app.SingleFlight('tts')
+    for key in app.speculation_stats:
+        app.speculation_stats[key] = 0
+
+def isolation(clients):
+    violations = [violation for client in clients for violation in client.violations]
+    return {'isolation_checked': sum(client.checked for client in clients),
+            'isolation_violations': len(violations), 'isolation_examples': violations[:5]}
+
+def run_session_scenario(url, stub, corpus, scenario, args):
+    reset_app(args)
+    clients = [BenchmarkClient(url, i, args, corpus, stub) for i in range(args.sessions)]
+    barrier = threading.Barrier(args.sessions + 1)
+    threads = [threading.Thread(target=client.run, args=(scenario, barrier)) for client in clients]
+    memory_before = memory_mb()
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    records = [record for client in clients for record in client.results]
+    completed = [r for r in records if r['final_text'] is not None]
+    def since_sent(key):
+        return [r[key] - r['sent'] for r in completed if r[key] is not None]
+    totals = [max(r['final_text'], r['last_audio'] or 0) - r['sent'] for r in completed]
+    result = {
+        'messages': len(records),
+        'completed': len(completed),
+        'busy': sum(1 for r in records if r['busy']),
+        'errors': sum(1 for r in records if r['error']),
+        'wall_seconds': wall,
+        'messages_per_second': len(completed) / wall if wall else None,
+        'time_to_first_text': summarize(since_sent('first_text')),
+        'time_to_first_audio': summarize(since_sent('first_audio')),
+        'total_answer_time': summarize(totals),
+        'audio_bytes_per_answer': statistics.mean(r['audio_bytes'] for r in completed) if completed else None,
+        'prompt_tokens': summarize(r['prompt_tokens'] for r in completed),
+        'stages': {stage: {'count': h['count'], 'mean_ms': h['sum'] / h['count'] * 1000}
+                   for stage, h in sorted(app.stage_metrics.histograms.items()) if h['count']},
+        'flights': {'llm': app.llm_flights.snapshot(), 'tts': app.tts_flights.snapshot()},
+        'memory': {'before': memory_before, 'after': memory_mb()},
+    }
+    result.update(isolation(clients))
+    if scenario == 'voice':
+        result['time_to_recognized'] = summarize(since_sent('recognized'))
+        result['speculation'] = dict(app.speculation_stats)
+    if args.playback:
+        result['time_to_final_text'] = summarize(since_sent('final_text'))
+        result['time_to_playback_end'] = summarize(since_sent('playback_end'))
+        result.update(audio_sync(completed))
+    return result
+
+# How closely the audio of each sentence followed its text: the delay until its audio arrived and started
+# playing, and how many earlier sentences were still waiting or playing when its text was shown
+def audio_sync(records):
+    lag, ahead_seconds, ahead = [], [], []
+    audio_before_text = without_audio = 0
+    for record in records:
+        sentences = record['sentences']
+        for seq, sentence in sentences.items():
+            if 'text' not in sentence:
+                continue
+            if 'audio' not in sentence:
+                without_audio += 1
+                continue
+            if sentence['audio'] < sentence['text']:
+                audio_before_text += 1
+            lag.append(sentence['audio'] - sentence['text'])
+            if 'played' in sentence:
+                ahead_seconds.append(sentence['played'] - sentence['text'])
+            ahead.append(sum(1 for earlier in range(seq)
+                             if sentences.get(earlier, {}).get('ended', float('inf')) > sentence['text']))
+    return {
+        'text_to_audio_lag': summarize(lag),
+        'text_ahead_of_speech_seconds': summarize(ahead_seconds),
+        'text_ahead_of_speech_sentences': summarize(ahead),
+        'audio_before_text': audio_before_text,
+        'sentences_without_audio': without_audio,
+        'audio_out_of_order': sum(record['audio_out_of_order'] for record in records),
+    }
+
+# The pacing text streaming had before backpressure: a fixed pause after every sentence
+FIXED_PACING_SECONDS = 0.3
+
+async def fixed_pacing(session, token):
+    await asyncio.sleep(FIXED_PACING_SECONDS)
+    return FIXED_PACING_SECONDS
+
+# The text scenario with clients playing the audio back, paced by backpressure and by the fixed pause
+def run_pacing_scenario(url, stub, corpus, args):
+    args = argparse.Namespace(**dict(vars(args), playback=True))
+    results = {'max_client_audio_queue': app.MAX_CLIENT_AUDIO_QUEUE, 'max_tts_pipeline_lag': app.MAX_TTS_PIPELINE_LAG,
+               'fixed_pacing_seconds': FIXED_PACING_SECONDS}
+    original = app.Session.wait_for_capacity
+    for mode in ('backpressure', 'fixed'):
+        if mode == 'fixed':
+            app.Session.wait_for_capacity = fixed_pacing
+        try:
+            results[mode] = run_session_scenario(url, stub, corpus, 'text', args)
+        finally:
+            app.Session.wait_for_capacity = original
+    results['isolation_violations'] = sum(results[mode]['isolation_violations'] for mode in ('backpressure', 'fixed'))
+    return results
+
+# Options of this run that the app in a --serve child process needs
+SERVER_OPTIONS = ['tts_latency', 'tts_per_char', 'no_tts_stream', 'stt_latency', 'stt_chunk_latency', 'jitter',
+                  'no_stream', 'no_connection_reuse', 'no_speculation', 'max_client_audio_queue',
+                  'max_tts_pipeline_lag', 'warm_caches']
+
+def server_command(args, port, endpoint, baseline):
+    command = [sys.executable, os.path.abspath(__file__), '--serve', str(port), '--mistral-endpoint', endpoint]
+    for name in SERVER_OPTIONS:
+        value = getattr(args, name)
+        if value is True:
+            command.append('--' + name.replace('_', '-'))
+        elif value is not False:
+            command += ['--' + name.replace('_', '-'), str(value)]
+    if baseline:
+        command.append('--thread-per-message')
+    return command
+
+# Many sockets against the app in a child process, so its threads and memory are measured on their own.
+# Every client connects first; then each asks its questions, starting at a random point in --scale-ramp.
+def run_scale_scenario(stub, corpus, args):
+    stub = stub or start_stub_mistral(args, corpus)
+    endpoint = f"http://127.0.0.1:{stub.server_port}/v1/chat/completions"
+    results = {'sockets': args.scale_sockets, 'messages_per_socket': args.messages, 'ramp_seconds': args.scale_ramp}
+    for mode, baseline in (('asyncio', False), ('thread_per_message', True)):
+        port = free_port()
+        server = subprocess.Popen(server_command(args, port, endpoint, baseline), env=dict(os.environ, LOG_LEVEL='ERROR'))
+        try:
+            url = f"http://127.0.0.1:{port}"
+            wait_until_serving(url, timeout=30)
+            results[mode] = run_scale_mode(url, server.pid, stub, corpus, args)
+        finally:
+            server.terminate()
+            server.wait()
+    results['isolation_violations'] = sum(results[mode]['isolation_violations'] for mode in ('asyncio', 'thread_per_message'))
+    return results
+
+def run_scale_mode(url, pid, stub, corpus, args):
+    idle = process_status(pid)
+    samples = [idle]
+    sampled = threading.Event()
+    def sample():
+        while not sampled.wait(0.05):
+            samples.append(process_status(pid))
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+
+    clients = [BenchmarkClient(url, i, args, corpus, stub) for i in range(args.scale_sockets)]
+    go = threading.Event()
+    failures = []
+    def run(client):
+        try:
+            client.run('text', go, client.rng.uniform(0, args.scale_ramp))
+        except Exception as e:
+            failures.append(f"{type(e).__name__}: {e}")
+    threads = [threading.Thread(target=run, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + args.timeout
+    while time.monotonic() < deadline and any(thread.is_alive() and not client.connected
+                                              for thread, client in zip(threads, clients)):
+        time.sleep(0.05)
+    connected = process_status(pid)
+    go.set()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    sampled.set()
+    sampler.join()
+
+    records = [record for client in clients for record in client.results]
+    completed = [r for r in records if r['final_text'] is not None]
+    return {
+        'connected': sum(1 for client in clients if client.connected),
+        'client_errors': len(failures),
+        'client_error_examples': failures[:5],
+        'messages': len(records),
+        'completed': len(completed),
+        'busy': sum(1 for r in records if r['busy'] and r['busy'] != 'tts'),
+        'tts_skipped': sum(1 for r in records if r['busy'] == 'tts'),
+        'errors': sum(1 for r in records if r['error']),
+        'wall_seconds': wall,
+        'messages_per_second': len(completed) / wall if wall else None,
+        'time_to_first_text': summarize(r['first_text'] - r['sent'] for r in completed if r['first_text']),
+        'total_answer_time': summarize(max(r['final_text'], r['last_audio'] or 0) - r['sent'] for r in completed),
+        'server_threads': {'idle': idle['threads'], 'connected': connected['threads'],
+                           'peak': max((s['threads'] for s in samples if s['threads']), default=None),
+                           'per_socket': (connected['threads'] - idle['threads']) / len(clients)},
+        'server_rss_mb': {'idle': idle['rss_mb'], 'connected': connected['rss_mb'],
+                          'peak': max((s['rss_mb'] for s in samples if s['rss_mb']), default=None)},
+        **isolation(clients),
+    }
+
+# Interrupt answers with a new message, one session at a time so the abandoned work can be told apart
+def run_cancel_scenario(url, stub, corpus, args):
+    reset_app(args)
+    interruptions, clients = [], []
+    for i in range(args.sessions):
+        client = BenchmarkClient(url, i, args, corpus, stub)
+        client.run('cancel', None)
+        interruptions += client.interruptions
+        clients.append(client)
+
+    busy = [r for r in interruptions if r['llm_running'] or r['tts_running']]
+    running = [r for r in interruptions if r['upstream_running']]
+    follow_ups = [r['follow_up'] for r in interruptions if r['follow_up']['final_text'] is not None]
+    return {
+        'interruptions': len(interruptions),
+        'work_running_at_interrupt': len(busy),
+        'time_to_free_workers': summarize(r['freed'] for r in busy),
+        'over_abort_deadline': sum(1 for r in busy if r['freed'] is None or r['freed'] > args.abort_deadline),
+        'upstream_running_at_interrupt': len(running),
+        'upstream_aborted': sum(1 for r in running if r['upstream_aborted']),
+        'time_to_upstream_abort': summarize(r['upstream_ended'] for r in running if r['upstream_aborted']),
+        'upstream_tokens_after_interrupt': sum(r['upstream_tokens'] for r in running),
+        'follow_up_time_to_first_text': summarize(r['first_text'] - r['sent'] for r in follow_ups if r['first_text']),
+        'follow_up_time_to_first_audio': summarize(r['first_audio'] - r['sent'] for r in follow_ups if r['first_audio']),
+        'stages': {stage: {'count': h['count'], 'mean_ms': h['sum'] / h['count'] * 1000}
+                   for stage, h in sorted(app.stage_metrics.histograms.items()) if h['count']},
+        **isolation(clients),
+    }
+
+# The sentence splitting SpeechSegmenter replaced, kept as a baseline: one TTS call per sentence, cut after
+# every terminator followed by a space, abbreviations and list numbers included
+class SentenceSplitter:
+    boundary = re.compile(r'(?<=[.!?]) +')
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, text):
+        self.buffer += text
+        parts = self.boundary.split(self.buffer)
+        self.buffer = parts.pop()
+        return [s.strip() for s in parts if s.strip()]
+
+    def flush(self):
+        rest = self.buffer.strip()
+        self.buffer = ""
+        return [rest] if rest else []
+
+# Replay the corpus token by token through a segmenter and model time-to-first-audio from the configured
+# LLM and TTS latencies
+def segment_corpus(corpus, args, segmenter_class):
+    calls, lengths, first_audio = 0, [], []
+    cpu = time.process_time()
+    for answer in corpus:
+        segmenter = segmenter_class()
+        tokens = re.findall(r'\s*\S+', answer)
+        first = None
+        for i, token in enumerate(tokens + [None]):
+            chunks = segmenter.feed(token) if token is not None else segmenter.flush()
+            for chunk in chunks:
+                calls += 1
+                lengths.append(len(chunk))
+                if first is None:
+                    arrived = args.llm_first_byte + min(i, len(tokens) - 1) * args.llm_token_delay
+                    first = arrived + args.tts_latency + len(chunk) * args.tts_per_char
+        first_audio.append(first)
+    min_chars = app.SEGMENT_MIN_SECONDS * app.SPEECH_CHARS_PER_SECOND
+    return {
+        'answers': len(corpus),
+        'tts_calls': calls,
+        'chunks_under_min_duration': sum(1 for n in lengths if n < min_chars),
+        'chunk_chars': summarize(lengths),
+        'modeled_time_to_first_audio': summarize(first_audio),
+        'cpu_ms_per_answer': (time.process_time() - cpu) / len(corpus) * 1000,
+    }
+
+# SpeechSegmenter's results, with the old sentence splitting alongside for comparison
+def run_segmenter_scenario(corpus, args):
+    return dict(segment_corpus(corpus, args, app.SpeechSegmenter),
+                sentence_split=segment_corpus(corpus, args, SentenceSplitter))
+
+# Sequential whole-answer requests through MistralClient, with and without connection reuse. The stub
+# answers at once so the difference is the connection setup.
+def run_connections_scenario(stub, corpus, args):
+    stub = stub or start_stub_mistral(args, corpus)
+    endpoint = f"http://127.0.0.1:{stub.server_port}/v1/chat/completions"
+    saved = dict(stub.config)
+    stub.config.update(first_byte=0.0, token_delay=0.0)
+    results = {}
+    try:
+        for reuse in (True, False):
+            client = app.MistralClient(endpoint, reuse_connections=reuse)
+            connections = stub.connections
+            latencies = []
+            for i in range(args.connection_requests):
+                headers, data = app.build_mistral_request(QUESTIONS[i % len(QUESTIONS)])
+                start = time.perf_counter()
+                client.post(data, headers).json()
+                latencies.append(time.perf_counter() - start)
+            results['reuse' if reuse else 'no_reuse'] = {
+                'requests': len(latencies),
+                'connections': stub.connections - connections,
+                'latency': summarize(latencies),
+            }
+            client.http.close()
+    finally:
+        stub.config.update(saved)
+    results['connect_delay'] = args.llm_connect_delay
+    return results
+
+# gTTS without the network: "synthesizes" silence of about the size gTTS returns for the text
+MP3_BYTES_PER_CHAR = 270
+
+class FakeGTTS(gTTS):
+    def write_to_fp(self, fp):
+        fp.write(bytes(len(self.text) * MP3_BYTES_PER_CHAR))
+
+# The original text_to_speech: save to a temp file, sleep 0.2 s, read it back, base64 and delete it.
+# Returns the payload and the seconds spent sleeping.
+def temp_file_speech(text):
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.mp3') as temp_file:
+        temp_filename = temp_file.name
+    FakeGTTS(text=text, lang='en', slow=False).save(temp_filename)
+    slept = time.perf_counter()
+    time.sleep(0.2)
+    slept = time.perf_counter() - slept
+    with open(temp_filename, 'rb') as audio_file:
+        audio_data = base64.b64encode(audio_file.read()).decode('utf-8')
+    os.unlink(temp_filename)
+    return audio_data, slept
+
+def in_memory_speech(text):
+    return base64.b64encode(app.GTTSEngine().synthesize(text)).decode('utf-8')
+
+def run_tts_overhead_scenario(corpus, args):
+    sentences = engine_sentences(corpus, args.engine_sentences)
+    original = app.gTTS
+    app.gTTS = FakeGTTS
+    try:
+        temp_file, temp_file_io, in_memory = [], [], []
+        for sentence in sentences:
+            start = time.perf_counter()
+            old, slept = temp_file_speech(sentence)
+            temp_file.append(time.perf_counter() - start)
+            temp_file_io.append(temp_file[-1] - slept)
+            start = time.perf_counter()
+            new = in_memory_speech(sentence)
+            in_memory.append(time.perf_counter() - start)
+            assert old == new
+    finally:
+        app.gTTS = original
+    def ms(values):
+        return summarize(value * 1000 for value in values)
+    return {
+        'sentences': len(sentences),
+        'temp_file_ms': ms(temp_file),
+        'temp_file_without_sleep_ms': ms(temp_file_io),
+        'in_memory_ms': ms(in_memory),
+    }
+
+# TTS engine that waits a fixed time per sentence without using CPU, so only the pipeline's scheduling shows
+class SleepTTSEngine(app.TTSEngine):
+    name = 'sleep'
+    voice = 'sleep'
+    mime = 'audio/wav'
+    extension = 'wav'
+    stream_format = {'format': 'pcm', 'sample_rate': SAMPLE_RATE, 'channels': 1}
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def synthesize(self, text):
+        time.sleep(self.latency)
+        return AUDIO_MARKER + text.encode('utf-8')
+
+    def stream(self, text, cancellation=None):
+        yield self.synthesize(text)
+
+    def assemble(self, chunks):
+        return b''.join(chunks)
+
+# Submit sentences to a session's pipeline on answer_loop; returns the seconds until the last one is sent
+def time_pipeline(session, sentences, timeout):
+    sent = threading.Event()
+    emit = session.emit
+    def record(event, *args):
+        if event in ('play_audio', 'play_audio_chunk') and args[0]['seq'] == len(sentences) - 1:
+            sent.set()
+    session.emit = record
+    token = session.next_token()
+    start = time.perf_counter()
+    def submit():
+        for sentence in sentences:
+            session.tts.submit(token, sentence)
+    app.answer_loop.call_soon_threadsafe(submit)
+    finished = sent.wait(timeout)
+    session.emit = emit
+    return time.perf_counter() - start if finished else None
+
+def run_tts_pipeline_scenario(corpus, args):
+    sentences = engine_sentences(corpus, args.tts_pipeline_sentences)
+    saved = app._tts_engine, app.tts_pool, app.tts_cache, app.tts_flights
+    app._tts_engine = SleepTTSEngine(args.tts_latency)
+    app.tts_cache = app.AudioCache(0, None, 0)
+    results = {'sentences': len(sentences), 'synthesis_seconds': args.tts_latency}
+    try:
+        for mode, pool in (('pipeline', saved[1]),
+                           ('one_worker', app.WorkPool('tts', 1, 1, app.TTS_MAX_WAITING, app.TTS_QUEUE_DEADLINE))):
+            app.tts_pool = pool
+            times = []
+            for run in range(args.tts_pipeline_runs):
+                app.tts_flights = app.SingleFlight('tts')
+                times.append(time_pipeline(app.Session(f"tts-pipeline-{mode}-{run}"), sentences, args.timeout))
+            results[mode] = {
+                'time_to_last_audio': summarize(times),
+                'synthesis_rounds': statistics.median(t / args.tts_latency for t in times if t is not None),
+            }
+    finally:
+        app._tts_engine, app.tts_pool, app.tts_cache, app.tts_flights = saved
+    return results
+
+# Why a TTS engine cannot run here, or None
+def engine_unavailable(name):
+    if name == 'espeak' and not shutil.which(app.ESPEAK_COMMAND):
+        return f"{app.ESPEAK_COMMAND} not found"
+    if name == 'piper':
+        if not shutil.which(app.PIPER_COMMAND):
+            return f"{app.PIPER_COMMAND} not found"
+        if not os.path.exists(app.PIPER_MODEL):
+            return f"voice model {app.PIPER_MODEL} not found"
+    return None
+
+def engine_sentences(corpus, count):
+    sentences = []
+    for answer in corpus:
+        segmenter = app.SpeechSegmenter()
+        sentences += segmenter.feed(answer) + segmenter.flush()
+    return sentences[:count]
+
+# Synthesize the same sentences with each engine, one at a time. CPU time counts this process (gTTS runs
+# in it) and the engine's finished child processes (espeak, piper, the stub).
+def run_engines_scenario(corpus, args):
+    sentences = engine_sentences(corpus, args.engine_sentences)
+    engines = {'stub': partial(StubTTSEngine, args.tts_latency, args.tts_per_char, args.jitter)}
+    results = {}
+    for name in args.engines:
+        reason = engine_unavailable(name) if name != 'stub' else None
+        if reason:
+            results[name] = {'available': False, 'reason': reason}
+            continue
+        engine = (engines.get(name) or app.TTS_ENGINES[name])()
+        first_audio, totals, cpu, audio_bytes = [], [], [], 0
+        error = None
+        for sentence in sentences:
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            own = time.process_time()
+            start = time.perf_counter()
+            first = None
+            try:
+                for chunk in engine.stream(sentence):
+                    if first is None:
+                        first = time.perf_counter() - start
+                    audio_bytes += len(chunk)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                break
+            totals.append(time.perf_counter() - start)
+            first_audio.append(first)
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu.append(time.process_time() - own + (after.ru_utime - children.ru_utime) + (after.ru_stime - children.ru_stime))
+        results[name] = {
+            'available': error is None or bool(totals),
+            'error': error,
+            'sentences': len(totals),
+            'time_to_first_audio_byte': summarize(first_audio),
+            'synthesis_time': summarize(totals),
+            'cpu_ms_per_sentence': statistics.mean(cpu) * 1000 if cpu else None,
+            'audio_bytes_per_sentence': audio_bytes / len(totals) if totals else None,
+        }
+    return {'sentences': len(sentences), 'engines': results}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Key metrics that should not get worse between runs, as (scenario, metric, statistic)
+COMPARED_METRICS = [
+    (scenario, metric, stat)
+    for scenario in ('text', 'voice')
+    for metric in ('time_to_first_text', 'time_to_first_audio', 'total_answer_time')
+    for stat in ('p50', 'p99')
+] + [('voice', 'time_to_recognized', 'p50'), ('segmenter', 'tts_calls', None),
+      ('cancel', 'time_to_free_workers', 'p50'), ('cancel', 'time_to_free_workers', 'p99'),
+      ('cancel', 'upstream_tokens_after_interrupt', None), ('cancel', 'follow_up_time_to_first_audio', 'p50')]
+
+# Print the change of each key metric against a baseline; returns the worst regression in percent
+def compare(results, baseline):
+    worst = 0.0
+    print(f"\n{'metric':<48} {'baseline':>10} {'current':>10} {'change':>8}")
+    for scenario, metric, stat in COMPARED_METRICS:
+        old = baseline.get('scenarios', {}).get(scenario, {}).get(metric)
+        new = results['scenarios'].get(scenario, {}).get(metric)
+        if stat:
+            old = old and old.get(stat)
+            new = new and new.get(stat)
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        worst = max(worst, change)
+        name = '.'.join(filter(None, (scenario, metric, stat)))
+        print(f"{name:<48} {old:>10.3f} {new:>10.3f} {change:>+7.1f}%")
+    return worst
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the medical assistant against local stand-ins")
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help="scenario to run, can be repeated (default: all)")
+    parser.add_argument('--sessions', type=int, default=4, help="concurrent clients")
+    parser.add_argument('--messages', type=int, default=3, help="messages per client")
+    parser.add_argument('--same-questions', action='store_true',
+                        help="have every client ask the same questions, to measure request coalescing")
+    parser.add_argument('--think-time', type=float, default=0.0, help="seconds between a client's messages")
+    parser.add_argument('--transport', choices=['binary', 'base64'], default='binary')
+    parser.add_argument('--polling', action='store_true', help="use HTTP long-polling instead of WebSocket")
+    parser.add_argument('--llm-first-byte', type=float, default=0.4)
+    parser.add_argument('--llm-token-delay', type=float, default=0.03)
+    parser.add_argument('--llm-connect-delay', type=float, default=0.05,
+                        help="seconds the stub Mistral server takes to accept a new connection")
+    parser.add_argument('--no-stream', action='store_true', help="use non-streaming Mistral requests")
+    parser.add_argument('--no-connection-reuse', action='store_true',
+                        help="open a new connection to Mistral for every request")
+    parser.add_argument('--connection-requests', type=int, default=20,
+                        help="requests per mode in the connections scenario")
+    parser.add_argument('--tts-latency', type=float, default=0.2, help="seconds per TTS call")
+    parser.add_argument('--tts-per-char', type=float, default=0.002, help="seconds of synthesis per character")
+    parser.add_argument('--no-tts-stream', action='store_true', help="send whole clips instead of streamed chunks")
+    parser.add_argument('--engines', nargs='+', choices=['gtts', 'espeak', 'piper', 'stub'],
+                        default=['gtts', 'espeak', 'piper', 'stub'], help="TTS engines the engines scenario compares")
+    parser.add_argument('--tts-pipeline-sentences', type=int, default=6, help="sentences per answer in the tts_pipeline scenario")
+    parser.add_argument('--tts-pipeline-runs', type=int, default=5, help="answers per mode in the tts_pipeline scenario")
+    parser.add_argument('--engine-sentences', type=int, default=10, help="corpus sentences per engine")
+    parser.add_argument('--stt-latency', type=float, default=0.3, help="seconds for the final transcript")
+    parser.add_argument('--stt-chunk-latency', type=float, default=0.005, help="seconds per audio chunk")
+    parser.add_argument('--speech-seconds', type=float, default=1.5, help="length of each spoken question")
+    parser.add_argument('--no-speculation', action='store_true')
+    parser.add_argument('--interrupt-after', type=float, nargs='+', default=[0.2, 0.8],
+                        help="seconds after asking that the cancel scenario sends the next message, used in turn")
+    parser.add_argument('--abort-deadline', type=float, default=0.05,
+                        help="seconds an abandoned answer may keep LLM or TTS work running")
+    parser.add_argument('--jitter', type=float, default=0.2, help="relative jitter applied to every latency")
+    parser.add_argument('--warm-caches', action='store_true', help="keep the response and TTS caches enabled")
+    parser.add_argument('--timeout', type=float, default=30.0, help="seconds to wait for an answer")
+    parser.add_argument('--thread-per-message', action='store_true',
+                        help="give every answer and recognition a thread of its own, like the original server")
+    parser.add_argument('--scale-sockets', type=int, default=500, help="concurrent sockets in the scale scenario")
+    parser.add_argument('--scale-ramp', type=float, default=10.0,
+                        help="seconds over which the scale scenario's clients start asking")
+    parser.add_argument('--serve', type=int, metavar='PORT', help="only run the app with the stand-ins on this port")
+    parser.add_argument('--mistral-endpoint', help="with --serve, the Mistral stand-in to use")
+    parser.add_argument('--playback', action='store_true',
+                        help="play the audio back in real time and report the queue depth, like the browser")
+    parser.add_argument('--playback-speed', type=float, default=1.0,
+                        help="with --playback, how many times faster than real time the audio plays")
+    parser.add_argument('--max-client-audio-queue', type=int, default=app.MAX_CLIENT_AUDIO_QUEUE,
+                        help="sentences queued in the client before the text stream is held back")
+    parser.add_argument('--max-tts-pipeline-lag', type=int, default=app.MAX_TTS_PIPELINE_LAG,
+                        help="sentences waiting for audio before the text stream is held back")
+    parser.add_argument('--audio-quiet', type=float, default=0.5,
+                        help="seconds without audio after which an answer counts as complete")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="baseline JSON file to compare against")
+    parser.add_argument('--max-regression', type=float,
+                        help="with --compare, exit with status 1 if a key metric got worse by more than this percent")
+    args = parser.parse_args()
+    scenarios = args.scenario or SCENARIOS
+    random.seed(args.seed)
+
+    corpus = load_corpus()
+    if args.serve:
+        start_app(args, corpus, args.serve, args.mistral_endpoint)
+        reset_app(args)
+        threading.Event().wait()
+    results = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+        'scenarios': {},
+    }
+    url, stub = start_app(args, corpus) if {'text', 'voice', 'cancel', 'pacing'} & set(scenarios) else (None, None)
+    for scenario in scenarios:
+        print(f"Running {scenario} scenario...", file=sys.stderr)
+        if scenario == 'segmenter':
+            results['scenarios'][scenario] = run_segmenter_scenario(corpus, args)
+        elif scenario == 'engines':
+            results['scenarios'][scenario] = run_engines_scenario(corpus, args)
+        elif scenario == 'connections':
+            results['scenarios'][scenario] = run_connections_scenario(stub, corpus, args)
+        elif scenario == 'tts_overhead':
+            results['scenarios'][scenario] = run_tts_overhead_scenario(corpus, args)
+        elif scenario == 'cancel':
+            results['scenarios'][scenario] = run_cancel_scenario(url, stub, corpus, args)
+        elif scenario == 'pacing':
+            results['scenarios'][scenario] = run_pacing_scenario(url, stub, corpus, args)
+        elif scenario == 'scale':
+            results['scenarios'][scenario] = run_scale_scenario(stub, corpus, args)
+        elif scenario == 'tts_pipeline':
+            results['scenarios'][scenario] = run_tts_pipeline_scenario(corpus, args)
+        else:
+            results['scenarios'][scenario] = run_session_scenario(url, stub, corpus, scenario, args)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    leaks = {name: scenario['isolation_violations'] for name, scenario in results['scenarios'].items()
+             if scenario.get('isolation_violations')}
+    if leaks:
+        print(f"Messages delivered to the wrong session: {leaks}", file=sys.stderr)
+        return 1
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            worst = compare(results, json.load(f))
+        if args.max_regression is not None and worst > args.max_regression:
+            print(f"Regression of {worst:.1f}% exceeds {args.max_regression}%", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+# Writes the end-of-speech WAV fixtures: 8 kHz 16-bit mono, speech-like voiced bursts (a 140 Hz
+# harmonic series shaped into syllables) over room noise. Run again after changing a recipe.
+import math
+import os
+import random
+import struct
+import wave
+
+SAMPLE_RATE = 8000
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Each fixture is a random seed and a list of (seconds, kind, level); kind is 'noise' or 'speech', level
+# an RMS in PCM units
+FIXTURES = {
+    # Quiet room: a short question, then the speaker stops
+    'quiet_room.wav': (1, [(0.6, 'noise', 60), (1.8, 'speech', 3000), (1.5, 'noise', 60)]),
+    # The speaker starts before any room noise is heard
+    'immediate_speech.wav': (3, [(1.8, 'speech', 3000), (1.5, 'noise', 60)]),
+    # Fan noise in the background, and a pause between two phrases shorter than the end-of-speech silence
+    'noisy_room.wav': (0, [(0.6, 'noise', 500), (1.0, 'speech', 4000), (0.4, 'noise', 500),
+                       (0.8, 'speech', 4000), (1.5, 'noise', 500)]),
+    # Nobody speaks
+    'silence.wav': (2, [(6.0, 'noise', 60)]),
+}
+
+def samples(kind, seconds, level, rng):
+    count = int(seconds * SAMPLE_RATE)
+    if kind == 'noise':
+        return [rng.gauss(0, level) for _ in range(count)]
+    out = []
+    for i in range(count):
+        t = i / SAMPLE_RATE
+        # Four syllables a second, never fully silent between them
+        envelope = 0.55 + 0.45 * math.sin(2 * math.pi * 4 * t)
+        voiced = sum(math.sin(2 * math.pi * 140 * h * t) / h for h in range(1, 6))
+        out.append(level * 1.1 * envelope * voiced + rng.gauss(0, level * 0.05))
+    return out
+
+def write(name, recipe, seed):
+    rng = random.Random(seed)
+    pcm = []
+    for seconds, kind, level in recipe:
+        pcm.extend(samples(kind, seconds, level, rng))
+    with wave.open(os.path.join(HERE, name), 'wb') as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(SAMPLE_RATE)
+        out.writeframes(b''.join(struct.pack('<h', max(-32768, min(32767, int(s)))) for s in pcm))
+
+if __name__ == '__main__':
+    for name, (seed, recipe) in FIXTURES.items():
+        write(name, recipe, seed)
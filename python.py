@@ -1,32 +1,944 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
 import os
-import tempfile
+import io
 import base64
 import time
 import threading
-import queue
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import re
+import json
+import logging
+import logging.handlers
+import queue
+import atexit
+import bisect
+import gzip
+import mimetypes
+import hashlib
+import random
+import contextlib
+import array
+import sys
+import socket
+import subprocess
+import wave
+import sqlite3
+import abc
+import argparse
+import shutil
+import tempfile
+from collections import Counter, OrderedDict, deque
 import speech_recognition as sr
 from gtts import gTTS
-from flask_socketio import SocketIO
+from flask_socketio import SocketIO, join_room
+from socketio import PubSubManager
+
+try:
+    import vosk
+except ImportError:
+    vosk = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import gunicorn.config
+except ImportError:
+    gunicorn = None
+
+# Logs go through a queue to a background thread, so socket handlers and the answer loop never block on
+# stdout. LOG_LEVEL=DEBUG adds per-sentence detail and every timing span.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+logger = logging.getLogger('medical_assistant')
+
+def setup_logging(level=LOG_LEVEL):
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(process)d] %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
+
+# Stage timings (seconds), aggregated into one histogram per stage and served at /metrics
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class StageMetrics:
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}  # stage -> {'buckets': per-bucket counts, 'count', 'sum'}
+        self.lock = threading.Lock()
 
-app = Flask(__name__)
-socketio = SocketIO(app)
+    # Session and token only tag the debug log line; as labels they would grow without bound
+    def observe(self, stage, seconds, session=None, token=None):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0}
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                histogram['buckets'][index] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+        logger.debug("span %s %.2f ms session=%s token=%s", stage, seconds * 1000, session.sid if session else None, token)
+
+    # Time the body of a with block; spans that raise are not recorded
+    @contextlib.contextmanager
+    def span(self, stage, session=None, token=None):
+        start = time.perf_counter()
+        yield
+        self.observe(stage, time.perf_counter() - start, session, token)
+
+    # Prometheus text exposition format
+    def render(self):
+        name = 'medical_assistant_stage_seconds'
+        lines = [f"# HELP {name} Time spent in each stage of answering a message.", f"# TYPE {name} histogram"]
+        with self.lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram["sum"]}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram["count"]}')
+        return "\n".join(lines) + "\n"
+
+stage_metrics = StageMetrics()
+
+# Scaling out: run several worker processes (see --workers) that share a Socket.IO message queue and a
+# session store, so an emit from any worker reaches the client and any worker can cancel a session's answer.
+# Both take a URL: None keeps everything in this process, 'redis://host:6379/0' uses Redis, and
+# 'sqlite:///path/to/file.db' is a local stand-in for running several workers on one machine.
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+SESSION_STORE_URL = os.environ.get('SESSION_STORE_URL')
+# How often a worker checks the store for an answer cancelled by another worker, in seconds
+SESSION_CANCEL_POLL = 0.1
+# Seconds a disconnected client has to reconnect (to any worker) before its answer is dropped
+SESSION_RECONNECT_GRACE = 5.0
+SESSION_TTL = 24 * 60 * 60
+SQLITE_QUEUE_POLL = 0.02
+SQLITE_QUEUE_RETENTION = 60.0
+
+# Open a sqlite database shared between processes; WAL lets readers poll while another process writes
+def open_sqlite(url):
+    path = url[len('sqlite:///'):]
+    conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+# Socket.IO message queue on a sqlite file: every worker appends its emits to one table and polls it
+# for the emits of the others. Good enough for a handful of local workers; use Redis across machines.
+# Messages are stored as JSON like the Redis manager does (emit already base64-encodes binary
+# attachments), so a row in the file can never run code in a worker.
+class SqlitePubSubManager(PubSubManager):
+    name = 'sqlite'
+
+    def __init__(self, url, channel='flask-socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.url = url
+        self.local = threading.local()
+        self._connection().execute('CREATE TABLE IF NOT EXISTS socketio_messages '
+                                   '(id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT, created REAL, data TEXT)')
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = open_sqlite(self.url)
+        return conn
+
+    def _publish(self, data):
+        now = time.time()
+        conn = self._connection()
+        conn.execute('INSERT INTO socketio_messages (channel, created, data) VALUES (?, ?, ?)',
+                     (self.channel, now, self.json.dumps(data)))
+        if random.random() < 0.01:
+            conn.execute('DELETE FROM socketio_messages WHERE created < ?', (now - SQLITE_QUEUE_RETENTION,))
+
+    def _listen(self):
+        conn = self._connection()
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM socketio_messages').fetchone()[0]
+        while True:
+            rows = conn.execute('SELECT id, data FROM socketio_messages WHERE id > ? AND channel = ? ORDER BY id',
+                                (last_id, self.channel)).fetchall()
+            for last_id, data in rows:
+                yield data
+            if not rows:
+                time.sleep(SQLITE_QUEUE_POLL)
+
+def socketio_options(url):
+    if not url:
+        return {}
+    if url.startswith('sqlite:///'):
+        return {'client_manager': SqlitePubSubManager(url)}
+    return {'message_queue': url}
+
+app = Flask(__name__, static_folder=None)
+socketio = SocketIO(app, **socketio_options(SOCKETIO_MESSAGE_QUEUE))
 
 # Mistral API Configuration
 MISTRAL_API_KEY = "Enter_Your_API_KEY"
 MISTRAL_MODEL = "mistral-medium"
 MISTRAL_ENDPOINT = "https://api.mistral.ai/v1/chat/completions"
+MISTRAL_MAX_TOKENS = 150
 
-# Queue for speech processing; items will be tuples of (token, sentence)
-tts_queue = queue.Queue()
+# Mistral HTTP client: pooled keep-alive connections, (connect, read) timeouts in seconds,
+# retries with jittered exponential backoff on 429/5xx, and a circuit breaker that fails fast
+# for MISTRAL_BREAKER_COOLDOWN seconds after MISTRAL_BREAKER_THRESHOLD consecutive failures
+MISTRAL_POOL_SIZE = 10
+# Set to False to open a new connection for every request (to measure what keep-alive saves)
+MISTRAL_REUSE_CONNECTIONS = True
+MISTRAL_CONNECT_TIMEOUT = 3.05
+MISTRAL_READ_TIMEOUT = 30
+MISTRAL_MAX_RETRIES = 2
+MISTRAL_BACKOFF_BASE = 0.5
+MISTRAL_BACKOFF_MAX = 4.0
+MISTRAL_BREAKER_THRESHOLD = 5
+MISTRAL_BREAKER_COOLDOWN = 30.0
 
-# Global token to keep track of the current response
-current_token = 0
+# Response cache in front of Mistral: exact matches on the normalized prompt, plus near-duplicates whose
+# content words (ignoring filler words and order) have a cosine similarity of at least RESPONSE_CACHE_SIMILARITY.
+# A near-duplicate must also have exactly the same numbers and negations ("2" vs "12 year old", "with" vs
+# "without alcohol"). The default only accepts rephrasings with the same content words: one other word can be
+# a different drug or condition, so lower it with care. Paraphrases ("my head hurts") are not matched.
+RESPONSE_CACHE_SIZE = 256
+RESPONSE_CACHE_TTL = 6 * 60 * 60
+RESPONSE_CACHE_SIMILARITY = 1.0
 
-# Function to Fetch Response from Mistral API
-def get_medical_response(user_input):
+# Words ignored when comparing prompts, and words that change their meaning and must always match
+RESPONSE_CACHE_FILLER_WORDS = {'a', 'an', 'the', 'i', 'im', 'ive', 'me', 'my', 'is', 'am', 'are', 'be', 'been',
+                               'do', 'does', 'did', 'can', 'could', 'should', 'would', 'will', 'to', 'of', 'for',
+                               'in', 'on', 'at', 'it', 'this', 'that', 'what', 'please', 'have', 'has', 'had',
+                               'got', 'get', 'so', 'just', 'really', 'very', 'hi', 'hello', 'm', 's', 've'}
+RESPONSE_CACHE_NEGATIONS = {'not', 'no', 'nor', 'never', 'none', 'without', 'cannot', 'cant', 'dont', 'doesnt',
+                            'isnt', 'wont', 'shouldnt', 't'}
+
+# Speech-to-text: the browser streams 16-bit mono PCM at STT_SAMPLE_RATE and the server recognizes it
+# incrementally with the STT_BACKEND engine ('google', or 'vosk' for offline recognition with VOSK_MODEL_PATH)
+STT_BACKEND = 'google'
+VOSK_MODEL_PATH = 'model'
+STT_SAMPLE_RATE = 16000
+STT_MAX_BUFFERED_CHUNKS = 200
+
+# End-of-speech detection: the session's noise floor follows the quietest audio heard, drifting up by at
+# most STT_NOISE_FLOOR_RISE (a fraction per second) when the room gets louder; audio louder than
+# STT_SPEECH_FACTOR times the floor is speech
+STT_NOISE_FLOOR_RISE = 0.05
+STT_SPEECH_FACTOR = 2.5
+STT_MIN_SPEECH_RMS = 300
+STT_END_SILENCE_SECONDS = 0.8
+STT_NO_SPEECH_TIMEOUT = 5.0
+STT_PHRASE_TIME_LIMIT = 10.0
+STT_CHUNK_TIMEOUT = 2.0
+
+# Speculative answers: once a partial transcript of at least SPECULATION_MIN_WORDS words has stayed the
+# same for SPECULATION_STABLE_CHUNKS audio chunks, Mistral is asked about it before the user finishes.
+# The answer is kept if the final transcript is at least SPECULATION_MATCH_THRESHOLD similar (character
+# trigrams) and has the same numbers and negations. Each utterance may start at most SPECULATION_BUDGET
+# speculative requests, since all but the adopted one are wasted; the next utterance starts afresh.
+SPECULATION_ENABLED = True
+SPECULATION_MIN_WORDS = 3
+SPECULATION_STABLE_CHUNKS = 3
+SPECULATION_MATCH_THRESHOLD = 0.9
+SPECULATION_BUDGET = 3
+
+# Text-to-speech configuration: TTS_ENGINE is 'gtts' (Google, network), or a local engine that
+# streams PCM as it speaks: 'espeak' (espeak-ng) or 'piper' (Piper neural voices, needs PIPER_MODEL)
+TTS_LANG = 'en'
+TTS_ENGINE = 'gtts'
+ESPEAK_COMMAND = 'espeak-ng'
+ESPEAK_VOICE = 'en'
+ESPEAK_WORDS_PER_MINUTE = 175
+PIPER_COMMAND = 'piper'
+PIPER_MODEL = 'en_US-lessac-medium.onnx'
+PIPER_SAMPLE_RATE = 22050
+
+# Send audio to the client as the engine produces it (play_audio_chunk) instead of one clip per sentence
+TTS_STREAM_AUDIO = True
+
+# TTS audio cache: in-memory LRU bounded by bytes, plus an optional on-disk tier (set TTS_CACHE_DIR to enable)
+TTS_CACHE_MAX_BYTES = 32 * 1024 * 1024
+TTS_CACHE_DIR = None
+TTS_CACHE_DISK_MAX_BYTES = 256 * 1024 * 1024
+
+# Phrases pre-synthesized into the cache at startup
+TTS_WARMUP_PHRASES = [
+    "This is a test of the text to speech system.",
+    "Please consult a doctor.",
+    "If symptoms are severe, please consult a doctor.",
+]
+
+# Worker pools for blocking work. For each pool: WORKERS jobs run at once globally, PER_SESSION
+# at once per session, at most MAX_WAITING jobs wait for a slot, and a job that has waited
+# QUEUE_DEADLINE seconds is dropped. Work beyond MAX_WAITING is rejected with a "busy" event.
+LLM_WORKERS = 16
+LLM_PER_SESSION = 1
+LLM_MAX_WAITING = 32
+LLM_QUEUE_DEADLINE = 5.0
+
+# Number of sentences synthesized at once, shared by all sessions. A session may synthesize a whole
+# typical answer (about six sentences) at once, so its last sentence is ready about one synthesis after
+# the first.
+TTS_WORKERS = 8
+TTS_PER_SESSION = 6
+TTS_MAX_WAITING = 64
+TTS_QUEUE_DEADLINE = 10.0
+
+STT_WORKERS = 4
+STT_PER_SESSION = 1
+STT_MAX_WAITING = 8
+STT_QUEUE_DEADLINE = 3.0
+
+# Answers, speech recognition and TTS run as asyncio tasks on a single event loop thread.
+# Blocking calls (Mistral HTTP, gTTS, speech recognition) are handed to the pools' fixed-size
+# executors, so messages never start threads of their own. The Socket.IO transport still runs in
+# Flask-SocketIO's threading mode on Werkzeug, which holds a few threads for every connected socket
+# (about 2000 at 500 sockets in benchmark.py's scale scenario); the server's thread count grows with
+# connections, not with messages.
+answer_loop = asyncio.new_event_loop()
+
+class Busy(Exception):
+    pass
+
+# Bounded pool with admission control; slots are only taken and released on answer_loop
+class WorkPool:
+    def __init__(self, name, workers, per_session, max_waiting, queue_deadline):
+        self.name = name
+        self.workers = workers
+        self.per_session = per_session
+        self.max_waiting = max_waiting
+        self.queue_deadline = queue_deadline
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.active = Counter()   # session id -> running jobs
+        self.waiters = deque()    # (session id, future) waiting for a slot, oldest first
+        self.stats = {'admitted': 0, 'rejected': 0, 'expired': 0}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, session):
+        await self._acquire(session.sid)
+        try:
+            yield
+        finally:
+            self._release(session.sid)
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def snapshot(self):
+        return dict(self.stats, active=sum(self.active.values()), waiting=len(self.waiters),
+                    workers=self.workers, max_waiting=self.max_waiting)
+
+    def _has_room(self, sid):
+        return sum(self.active.values()) < self.workers and self.active[sid] < self.per_session
+
+    async def _acquire(self, sid):
+        # Waiters only hold back newcomers from their own session; others queue only when the pool is full
+        if self._has_room(sid) and all(waiting_sid != sid for waiting_sid, _ in self.waiters):
+            self._take(sid)
+            return
+        if len(self.waiters) >= self.max_waiting:
+            self.stats['rejected'] += 1
+            raise Busy(f"{self.name} queue is full")
+
+        waiter = answer_loop.create_future()
+        self.waiters.append((sid, waiter))
+        try:
+            await asyncio.wait_for(waiter, self.queue_deadline)
+        except asyncio.TimeoutError:
+            self.stats['expired'] += 1
+            raise Busy(f"{self.name} queue deadline exceeded")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release(sid)  # The slot was handed over just as we were cancelled
+            raise
+        finally:
+            if (sid, waiter) in self.waiters:
+                self.waiters.remove((sid, waiter))
+
+    def _take(self, sid):
+        self.active[sid] += 1
+        self.stats['admitted'] += 1
+
+    def _release(self, sid):
+        self.active[sid] -= 1
+        if self.active[sid] <= 0:
+            del self.active[sid]
+        # Hand freed capacity to the oldest waiters whose session is under its own cap
+        for waiting_sid, waiter in list(self.waiters):
+            if sum(self.active.values()) >= self.workers:
+                break
+            if waiter.done():
+                self.waiters.remove((waiting_sid, waiter))
+            elif self._has_room(waiting_sid):
+                self.waiters.remove((waiting_sid, waiter))
+                self._take(waiting_sid)
+                waiter.set_result(None)
+
+llm_pool = WorkPool("llm", LLM_WORKERS, LLM_PER_SESSION, LLM_MAX_WAITING, LLM_QUEUE_DEADLINE)
+tts_pool = WorkPool("tts", TTS_WORKERS, TTS_PER_SESSION, TTS_MAX_WAITING, TTS_QUEUE_DEADLINE)
+stt_pool = WorkPool("stt", STT_WORKERS, STT_PER_SESSION, STT_MAX_WAITING, STT_QUEUE_DEADLINE)
+
+answer_loop_thread = threading.Thread(target=answer_loop.run_forever, name="answer-loop")
+answer_loop_thread.daemon = True
+answer_loop_thread.start()
+
+class Cancelled(Exception):
+    pass
+
+# Cooperative cancellation of blocking work on a pool thread. The work registers what would unblock it
+# (shutting down its socket, killing its process) with on_cancel(); cancel(), from any thread, runs
+# those callbacks, so the thread returns within one read instead of finishing the job.
+class Cancellation:
+    def __init__(self):
+        self.cancelled = False
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            self.event.set()
+            # Run under the lock, so a callback never fires after its on_cancel() block has ended
+            for callback in self.callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.debug("Cancellation callback failed: %s", e)
+            self.callbacks.clear()
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+    # Sleep for up to timeout seconds; returns True if cancelled in the meantime
+    def wait(self, timeout):
+        return self.event.wait(timeout)
+
+    # Call callback on cancel while the block runs (right away if already cancelled)
+    @contextlib.contextmanager
+    def on_cancel(self, callback):
+        with self.lock:
+            if self.cancelled:
+                callback()
+            else:
+                self.callbacks.append(callback)
+        try:
+            yield
+        finally:
+            with self.lock:
+                if callback in self.callbacks:
+                    self.callbacks.remove(callback)
+
+_exhausted = object()
+
+# Iterate a blocking iterator from the event loop, one executor hop per item. If the consumer stops
+# early, cancellation (if given) aborts the step in progress and the iterator is closed once that
+# step returns, so its cleanup (closing a response, reaping a process) runs right away.
+async def iterate_in_executor(iterator, executor, cancellation=None):
+    step = None
+    try:
+        while True:
+            step = executor.submit(next, iterator, _exhausted)
+            item = await asyncio.wrap_future(step)
+            if item is _exhausted:
+                return
+            yield item
+    finally:
+        if step is not None and not step.done():
+            if cancellation is not None:
+                cancellation.cancel()
+            if hasattr(iterator, 'close'):
+                step.add_done_callback(lambda _: iterator.close())
+        elif hasattr(iterator, 'close'):
+            iterator.close()
+
+# Single-flight: concurrent identical LLM requests (same question and history) and TTS syntheses (same
+# cache key) share one upstream call, whose output is buffered and replayed to every caller. Callers
+# are reference-counted; the call is only cancelled once the last one has stopped listening. Each
+# caller holds its own pool slot while it waits, so shared calls never exceed the pool's workers.
+class SharedCall:
+    def __init__(self, flights, key, produce):
+        self.flights = flights
+        self.key = key
+        self.info = {}  # Details about the call every caller can read once it is done, such as token usage
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.waiters = 0
+        self.changed = asyncio.Event()
+        self.task = answer_loop.create_task(self._run(produce))
+
+    async def _run(self, produce):
+        try:
+            async with contextlib.aclosing(produce(self.info)) as chunks:
+                async for chunk in chunks:
+                    self.chunks.append(chunk)
+                    self.changed.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self.changed.set()
+            self.flights._forget(self)
+
+    # Yield the chunks produced so far, then the rest as they arrive
+    async def replay(self):
+        self.waiters += 1
+        sent = 0
+        try:
+            while True:
+                while sent < len(self.chunks):
+                    yield self.chunks[sent]
+                    sent += 1
+                if self.done:
+                    if self.error:
+                        raise self.error
+                    return
+                self.changed.clear()
+                await self.changed.wait()
+        finally:
+            self.waiters -= 1
+            if self.waiters == 0 and not self.done:
+                self.flights.stats['cancelled'] += 1
+                self.flights._forget(self)
+                self.task.cancel()
+
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}  # key -> SharedCall in flight
+        self.stats = {'calls': 0, 'shared': 0, 'cancelled': 0}
+
+    # Returns the call in flight for key, or starts produce(info), an async iterator, as a new one
+    def join(self, key, produce):
+        call = self.calls.get(key)
+        if call is None:
+            call = self.calls[key] = SharedCall(self, key, produce)
+            self.stats['calls'] += 1
+        else:
+            self.stats['shared'] += 1
+            logger.debug("Sharing in-flight %s call", self.name)
+        return call
+
+    def snapshot(self):
+        return dict(self.stats, in_flight=len(self.calls))
+
+    def _forget(self, call):
+        if self.calls.get(call.key) is call:
+            del self.calls[call.key]
+
+llm_flights = SingleFlight("llm")
+tts_flights = SingleFlight("tts")
+
+# Backpressure: text is streamed as fast as it arrives, and only held back while the client has
+# more than MAX_CLIENT_AUDIO_QUEUE clips waiting or the TTS pipeline is more than MAX_TTS_PIPELINE_LAG
+# sentences behind. BACKPRESSURE_MAX_WAIT caps a single wait so a silent client cannot stall an answer.
+# The text is held back before more sentences are waiting than the session may synthesize at once.
+MAX_CLIENT_AUDIO_QUEUE = 3
+MAX_TTS_PIPELINE_LAG = TTS_PER_SESSION - 1
+BACKPRESSURE_POLL = 0.05
+BACKPRESSURE_MAX_WAIT = 10.0
+
+# Session state shared by all workers: the current answer token, the socket the client is attached to
+# and the conversation history.
+# Sessions are keyed by an id the browser tab picks, so a client that reconnects to another worker keeps it.
+class MemorySessionStore:
+    shared = False
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def next_token(self, key):
+        with self.lock:
+            entry = self.entries.setdefault(key, {'token': 0, 'sid': None})
+            entry['token'] += 1
+            return entry['token']
+
+    def token(self, key):
+        with self.lock:
+            return self.entries.get(key, {}).get('token', 0)
+
+    def attach(self, key, sid):
+        with self.lock:
+            self.entries.setdefault(key, {'token': 0, 'sid': None})['sid'] = sid
+
+    def attached(self, key):
+        with self.lock:
+            return self.entries.get(key, {}).get('sid')
+
+    def get_conversation(self, key):
+        with self.lock:
+            return self.entries.get(key, {}).get('conversation')
+
+    def put_conversation(self, key, state):
+        with self.lock:
+            self.entries.setdefault(key, {'token': 0, 'sid': None})['conversation'] = state
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+class SqliteSessionStore:
+    shared = True
+
+    def __init__(self, url):
+        self.url = url
+        self.local = threading.local()
+        conn = self._connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS sessions '
+                     '(key TEXT PRIMARY KEY, token INTEGER NOT NULL DEFAULT 0, sid TEXT, updated REAL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS conversations (key TEXT PRIMARY KEY, state TEXT, updated REAL)')
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = open_sqlite(self.url)
+        return conn
+
+    def next_token(self, key):
+        return self._connection().execute(
+            'INSERT INTO sessions (key, token, updated) VALUES (?, 1, ?) '
+            'ON CONFLICT(key) DO UPDATE SET token = token + 1, updated = excluded.updated RETURNING token',
+            (key, time.time())).fetchone()[0]
+
+    def token(self, key):
+        row = self._connection().execute('SELECT token FROM sessions WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def attach(self, key, sid):
+        now = time.time()
+        conn = self._connection()
+        conn.execute('INSERT INTO sessions (key, sid, updated) VALUES (?, ?, ?) '
+                     'ON CONFLICT(key) DO UPDATE SET sid = excluded.sid, updated = excluded.updated',
+                     (key, sid, now))
+        conn.execute('DELETE FROM sessions WHERE updated < ?', (now - SESSION_TTL,))
+        conn.execute('DELETE FROM conversations WHERE updated < ?', (now - SESSION_TTL,))
+
+    def attached(self, key):
+        row = self._connection().execute('SELECT sid FROM sessions WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def get_conversation(self, key):
+        row = self._connection().execute('SELECT state FROM conversations WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_conversation(self, key, state):
+        self._connection().execute('INSERT OR REPLACE INTO conversations (key, state, updated) VALUES (?, ?, ?)',
+                                   (key, json.dumps(state), time.time()))
+
+    def delete(self, key):
+        conn = self._connection()
+        conn.execute('DELETE FROM sessions WHERE key = ?', (key,))
+        conn.execute('DELETE FROM conversations WHERE key = ?', (key,))
+
+class RedisSessionStore:
+    shared = True
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("SESSION_STORE_URL 'redis://' needs the redis package (pip install redis)")
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+
+    def _key(self, key):
+        return f"session:{key}"
+
+    def next_token(self, key):
+        pipe = self.client.pipeline()
+        pipe.hincrby(self._key(key), 'token', 1)
+        pipe.expire(self._key(key), SESSION_TTL)
+        return pipe.execute()[0]
+
+    def token(self, key):
+        return int(self.client.hget(self._key(key), 'token') or 0)
+
+    def attach(self, key, sid):
+        pipe = self.client.pipeline()
+        pipe.hset(self._key(key), 'sid', sid)
+        pipe.expire(self._key(key), SESSION_TTL)
+        pipe.execute()
+
+    def attached(self, key):
+        return self.client.hget(self._key(key), 'sid')
+
+    def get_conversation(self, key):
+        state = self.client.hget(self._key(key), 'conversation')
+        return json.loads(state) if state else None
+
+    def put_conversation(self, key, state):
+        pipe = self.client.pipeline()
+        pipe.hset(self._key(key), 'conversation', json.dumps(state))
+        pipe.expire(self._key(key), SESSION_TTL)
+        pipe.execute()
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+def create_session_store(url):
+    if not url:
+        return MemorySessionStore()
+    if url.startswith('sqlite:///'):
+        return SqliteSessionStore(url)
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisSessionStore(url)
+    raise RuntimeError(f"Unsupported SESSION_STORE_URL: {url}")
+
+session_store = create_session_store(SESSION_STORE_URL)
+
+# With a message queue every emit is a synchronous sqlite or Redis write, so session emits are queued and
+# published in order by one thread instead of blocking answer_loop (and every other session on it)
+emit_queue = queue.SimpleQueue()
+
+def publish_emits():
+    while True:
+        event, args, room = emit_queue.get()
+        try:
+            socketio.emit(event, *args, to=room)
+        except Exception as e:
+            logger.error("Failed to publish %s to %s: %s", event, room, e)
+
+if SOCKETIO_MESSAGE_QUEUE:
+    emit_thread = threading.Thread(target=publish_emits, name="emit-publisher")
+    emit_thread.daemon = True
+    emit_thread.start()
+
+# Per-client state: each browser tab gets its own cancel token, tasks, TTS pipeline and targeted emits.
+# Emits go to a room named after the session id, which reaches the client on whichever worker it is on.
+# Methods prefixed with an underscore, and the TTS pipeline, only run on answer_loop.
+class Session:
+    def __init__(self, sid):
+        self.sid = sid
+        # Token to keep track of the current response of this session; the shared copy lives in session_store
+        self.token = session_store.token(sid)
+        self.conversation = Conversation(session_store.get_conversation(sid))
+        # Speech pipeline for the sentences of the current response
+        self.tts = TTSPipeline(self)
+        # Set when the client announces it can play raw MP3 bytes (binary Socket.IO attachments)
+        self.binary_audio = False
+        # Audio clips the client has received but not finished playing, as reported by the client
+        self.client_queue_depth = 0
+        self.answer_task = None
+        self.listen_task = None
+        # (token, perf_counter when it started) of the latest answer, until the client reports playback
+        self.answer_started = (None, None)
+        # Incoming microphone chunks while listening, and the noise floor measured for this client
+        self.audio_chunks = None
+        self.noise_floor = None
+        self.lock = threading.Lock()
+
+    def emit(self, event, *args):
+        if SOCKETIO_MESSAGE_QUEUE:
+            emit_queue.put((event, args, self.sid))
+        else:
+            socketio.emit(event, *args, to=self.sid)
+
+    def is_current(self, token):
+        return token == self.token
+
+    # Invalidate the current response and return the token for the new one. With a shared store this is a
+    # sqlite or Redis round trip, so code on answer_loop calls it (and start_answer) through an executor.
+    def next_token(self):
+        with self.lock:
+            self.token = session_store.next_token(self.sid)
+            # The client drops its audio queue on stop_audio
+            self.client_queue_depth = 0
+            return self.token
+
+    # Cancel the current answer and start answering user_input; safe to call from any thread.
+    # prefetched is a Speculation already fetching the answer to a close-enough prompt.
+    def start_answer(self, user_input, prefetched=None):
+        token = self.next_token()
+        self.answer_started = (token, time.perf_counter())
+        logger.debug("Cancelling previous processing for %s, new token: %s", self.sid, token)
+
+        # Notify client to stop audio immediately; it drops any audio for older tokens still on the way
+        self.emit('stop_audio', {'token': token})
+        logger.debug("Sent stop_audio signal to %s", self.sid)
+
+        answer_loop.call_soon_threadsafe(self._start_answer, user_input, token, prefetched)
+        return token
+
+    # Stop the current answer without starting another one; safe to call from any thread
+    def cancel(self):
+        token = self.next_token()
+        self.emit('stop_audio', {'token': token})
+        answer_loop.call_soon_threadsafe(self._cancel_answer)
+        return token
+
+    def start_listening(self, sample_rate):
+        answer_loop.call_soon_threadsafe(self._start_listening, sample_rate)
+
+    # Queue a chunk of microphone PCM; None marks the end of the utterance
+    def feed_audio(self, chunk):
+        answer_loop.call_soon_threadsafe(self._feed_audio, chunk)
+
+    # Drop everything in flight for this session (client went away)
+    def close(self):
+        self.next_token()
+        answer_loop.call_soon_threadsafe(self._close)
+
+    def _start_answer(self, user_input, token, prefetched=None):
+        if not self.is_current(token):
+            if prefetched:
+                prefetched.cancel()
+            return  # A newer message already replaced this one
+        self._cancel_answer()
+        logger.debug("Starting answer task for %s, token %s", self.sid, token)
+        self.answer_task = answer_loop.create_task(stream_response(self, user_input, token, prefetched))
+        if session_store.shared:
+            answer_loop.create_task(self._watch_answer(token))
+
+    # Another worker moved the shared token on (a new message or a cancel after the client reconnected
+    # there): stop this worker's copy of the answer, including speech still being synthesized
+    async def _watch_answer(self, token):
+        loop = asyncio.get_running_loop()
+        while self.is_current(token) and (not self.answer_task.done() or self.tts.pending()):
+            await asyncio.sleep(SESSION_CANCEL_POLL)
+            shared = await loop.run_in_executor(None, session_store.token, self.sid)
+            if shared != token and self.is_current(token):
+                logger.info("Answer %s for %s superseded by token %s on another worker", token, self.sid, shared)
+                with self.lock:
+                    self.token = max(self.token, shared)
+                    self.client_queue_depth = 0
+                self._cancel_answer()
+
+    def _cancel_answer(self):
+        if self.answer_task and not self.answer_task.done():
+            self.answer_task.cancel()
+        dropped = self.tts.cancel()
+        logger.debug("Cleared TTS pipeline for %s (%d items removed)", self.sid, dropped)
+
+    def _start_listening(self, sample_rate):
+        if self.listen_task and not self.listen_task.done():
+            logger.warning("Already listening for %s, ignoring voice input request", self.sid)
+            return
+        self.audio_chunks = asyncio.Queue(maxsize=STT_MAX_BUFFERED_CHUNKS)
+        self.listen_task = answer_loop.create_task(recognize_speech(self, self.audio_chunks, sample_rate))
+
+    def _feed_audio(self, chunk):
+        if self.audio_chunks is None:
+            return
+        if self.audio_chunks.full():
+            if chunk is not None:
+                logger.warning("Dropping audio chunk for %s, recognizer is behind", self.sid)
+                return
+            self.audio_chunks.get_nowait()  # Make room for the end marker
+        self.audio_chunks.put_nowait(chunk)
+
+    def _close(self):
+        self._cancel_answer()
+        if self.listen_task and not self.listen_task.done():
+            self.listen_task.cancel()
+
+    # Pick up turns another worker added to this session's conversation; returns the conversation.
+    # Store round trips run in an executor so a slow sqlite or Redis call never blocks answer_loop.
+    async def sync_conversation(self):
+        if session_store.shared:
+            state = await asyncio.get_running_loop().run_in_executor(None, session_store.get_conversation, self.sid)
+            # Only a newer version: this worker's own last turn may still be on its way to the store
+            if state and state.get('version', 0) > self.conversation.version:
+                self.conversation = Conversation(state)
+        return self.conversation
+
+    async def record_turn(self, user_input, answer):
+        self.conversation.add_turn(user_input, answer)
+        state = self.conversation.to_dict()
+        await asyncio.get_running_loop().run_in_executor(None, session_store.put_conversation, self.sid, state)
+
+    def queue_tts(self, token, sentence):
+        self.tts.submit(token, sentence)
+
+    def set_client_queue_depth(self, depth):
+        self.client_queue_depth = depth
+
+    def is_backlogged(self):
+        return self.client_queue_depth > MAX_CLIENT_AUDIO_QUEUE or self.tts.pending() > MAX_TTS_PIPELINE_LAG
+
+    # Hold the text stream while the audio side is too far behind; returns the seconds spent waiting
+    async def wait_for_capacity(self, token):
+        start = time.monotonic()
+        deadline = start + BACKPRESSURE_MAX_WAIT
+        while self.is_current(token) and self.is_backlogged():
+            if time.monotonic() >= deadline:
+                logger.warning("Backpressure wait timed out for %s", self.sid)
+                break
+            await asyncio.sleep(BACKPRESSURE_POLL)
+        return time.monotonic() - start
+
+    # Build an audio payload in the transport the client negotiated; returns (payload, wire size, encode seconds)
+    def audio_payload(self, audio, **fields):
+        start = time.perf_counter()
+        if self.binary_audio:
+            payload = dict(fields, audio=audio)
+            size = len(audio)
+        else:
+            audio_data = base64.b64encode(audio).decode('utf-8')
+            payload = dict(fields, audio_data=audio_data)
+            size = len(audio_data)
+        return payload, size, time.perf_counter() - start
+
+# Sessions with a client on this worker, keyed by session id, and the session id of each socket
+sessions = {}
+session_keys = {}
+sessions_lock = threading.Lock()
+
+SESSION_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{8,64}')
+
+def get_session(sid):
+    with sessions_lock:
+        key = session_keys.get(sid, sid)
+        session = sessions.get(key)
+        if session is None:
+            session = sessions[key] = Session(key)
+        return session
+
+# Called SESSION_RECONNECT_GRACE seconds after socket sid of session key disconnected
+def release_session(key, sid):
+    with sessions_lock:
+        if key in session_keys.values():
+            return  # The client reconnected to this worker
+        session = sessions.pop(key, None)
+    if session is None:
+        return
+    if session_store.attached(key) not in (sid, None):
+        # The client reconnected to another worker; the answer keeps streaming to its room from here
+        logger.info("Session %s moved to another worker", key)
+        return
+    # Drop any answer still in flight for this client
+    session.close()
+    if not session_store.shared:
+        session_store.delete(key)
+
+# Set to False to wait for the full completion before streaming sentences
+MISTRAL_STREAM = True
+
+MISTRAL_SYSTEM_PROMPT = "You are an AI medical assistant. Provide your response in clear, short sentences separated by periods. First tell the user what you're going to explain, then provide the information. If symptoms are mentioned, suggest possible conditions and first-aid remedies. Recommend only OTC (over-the-counter) medicines. If symptoms are severe, suggest consulting a doctor."
+
+# context holds the earlier conversation messages to send between the system prompt and user_input
+def build_mistral_request(user_input, stream=False, context=()):
     headers = {
         "Authorization": f"Bearer {MISTRAL_API_KEY}",
         "Content-Type": "application/json"
@@ -35,673 +947,1785 @@ def get_medical_response(user_input):
     data = {
         "model": MISTRAL_MODEL,
         "messages": [
-            {"role": "system", "content": "You are an AI medical assistant. Provide your response in clear, short sentences separated by periods. First tell the user what you're going to explain, then provide the information. If symptoms are mentioned, suggest possible conditions and first-aid remedies. Recommend only OTC (over-the-counter) medicines. If symptoms are severe, suggest consulting a doctor."},
+            {"role": "system", "content": MISTRAL_SYSTEM_PROMPT},
+            *context,
             {"role": "user", "content": user_input}
         ],
-        "max_tokens": 150,
+        "max_tokens": MISTRAL_MAX_TOKENS,
         "temperature": 0.7
     }
+    if stream:
+        data["stream"] = True
+        headers["Accept"] = "text/event-stream"
+
+    return headers, data
+
+# Conversation history: prompts stay under CONVERSATION_TOKEN_BUDGET tokens (system prompt, history and
+# CONVERSATION_QUESTION_TOKENS for the new question). The last CONVERSATION_RECENT_TURNS exchanges are always
+# sent verbatim; once there are more than CONVERSATION_MAX_TURNS, or the budget is hit, the older ones are
+# folded into a running summary capped at CONVERSATION_SUMMARY_TOKENS. Folding in batches keeps the prompt
+# prefix stable for several turns, so each turn usually only appends to it.
+CONVERSATION_TOKEN_BUDGET = 1500
+CONVERSATION_QUESTION_TOKENS = 200
+CONVERSATION_RECENT_TURNS = 4
+CONVERSATION_MAX_TURNS = 8
+CONVERSATION_SUMMARY_TOKENS = 250
+CONVERSATION_NOTE_WORDS = 30
+
+# Rough token count for budgeting: a token per 4 letters of a word and per punctuation mark, plus a few
+# per message for the chat template. The exact count comes back in the usage field of each response.
+TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]")
+MESSAGE_TOKEN_OVERHEAD = 4
+
+def estimate_tokens(text):
+    return len(TOKEN_PATTERN.findall(text)) + MESSAGE_TOKEN_OVERHEAD
+
+# Condense an exchange for the summary: the question, and the first sentence of the answer, which states
+# what the answer explains (the system prompt asks for that)
+def summarize_turn(user_input, answer):
+    first_sentence = re.split(r"(?<=[.!?])\s+", answer.strip(), maxsplit=1)[0]
+    words = first_sentence.split()
+    if len(words) > CONVERSATION_NOTE_WORDS:
+        first_sentence = " ".join(words[:CONVERSATION_NOTE_WORDS]) + "..."
+    return f"The user asked: {user_input} You answered: {first_sentence}"
+
+# Per-session history; state is a plain dict so it can be kept in the session store
+class Conversation:
+    def __init__(self, state=None):
+        state = state or {}
+        self.notes = list(state.get('notes', []))
+        self.turns = [tuple(turn) for turn in state.get('turns', [])]
+        self.version = state.get('version', 0)
+        # Built messages between the system prompt and the question, and their estimated tokens
+        self.prefix = None
+        self.prefix_tokens = 0
+
+    def to_dict(self):
+        return {'notes': self.notes, 'turns': [list(turn) for turn in self.turns], 'version': self.version}
+
+    def is_empty(self):
+        return not self.turns and not self.notes
+
+    def _append(self, role, content):
+        self.prefix.append({"role": role, "content": content})
+        self.prefix_tokens += estimate_tokens(content)
+
+    def _build(self):
+        if self.prefix is None:
+            self.prefix = []
+            self.prefix_tokens = estimate_tokens(MISTRAL_SYSTEM_PROMPT)
+            if self.notes:
+                self._append("system", "Summary of the earlier conversation: " + " ".join(self.notes))
+            for user_input, answer in self.turns:
+                self._append("user", user_input)
+                self._append("assistant", answer)
+
+    # Returns the history messages to send before user_input and the estimated prompt tokens
+    def context(self, user_input):
+        self._build()
+        messages = list(self.prefix)
+        tokens = self.prefix_tokens + estimate_tokens(user_input)
+        # An unusually long question: drop the oldest verbatim turns from this prompt only
+        first_turn = 1 if self.notes else 0
+        while tokens > CONVERSATION_TOKEN_BUDGET and len(messages) > first_turn:
+            tokens -= sum(estimate_tokens(message["content"]) for message in messages[first_turn:first_turn + 2])
+            del messages[first_turn:first_turn + 2]
+        return messages, tokens
+
+    def add_turn(self, user_input, answer):
+        self.turns.append((user_input, answer))
+        self.version += 1
+        if self.prefix is not None:
+            self._append("user", user_input)
+            self._append("assistant", answer)
+        if (len(self.turns) > CONVERSATION_MAX_TURNS
+                or self.prefix_tokens > CONVERSATION_TOKEN_BUDGET - CONVERSATION_QUESTION_TOKENS):
+            self._fold()
+
+    # Summarize turns older than the last CONVERSATION_RECENT_TURNS (fewer if still over budget)
+    def _fold(self):
+        keep = CONVERSATION_RECENT_TURNS
+        while True:
+            while len(self.turns) > keep:
+                self.notes.append(summarize_turn(*self.turns.pop(0)))
+            while len(self.notes) > 1 and sum(estimate_tokens(note) for note in self.notes) > CONVERSATION_SUMMARY_TOKENS:
+                self.notes.pop(0)
+            self.prefix = None
+            self._build()
+            if keep == 0 or self.prefix_tokens <= CONVERSATION_TOKEN_BUDGET - CONVERSATION_QUESTION_TOKENS:
+                return
+            keep -= 1
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+# Shut a socket down in both directions, which wakes a thread blocked reading from it (closing it does not)
+def shutdown_socket(sock):
+    if sock is None:
+        return
+    try:
+        # The plain socket method, so TLS sockets are not torn down under the reading thread
+        socket.socket.shutdown(sock, socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+# Cancellation of the request the current thread is sending, see MistralClient.post
+_request_cancellation = threading.local()
+
+# Connections whose wait for the response headers can be cancelled from another thread
+class CancellableConnectionMixin:
+    def getresponse(self, *args, **kwargs):
+        cancellation = getattr(_request_cancellation, 'current', None)
+        if cancellation is None:
+            return super().getresponse(*args, **kwargs)
+        with cancellation.on_cancel(lambda: shutdown_socket(self.sock)):
+            return super().getresponse(*args, **kwargs)
+
+class CancellableHTTPConnection(CancellableConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+class CancellableHTTPSConnection(CancellableConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+class CancellableHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = CancellableHTTPConnection
+
+class CancellableHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = CancellableHTTPSConnection
+
+class CancellableHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': CancellableHTTPConnectionPool,
+                                                   'https': CancellableHTTPSConnectionPool}
+
+# Shut down the connection under a streamed response, so a read blocked on it returns right away
+def abort_response(response):
+    connection = getattr(response.raw, 'connection', None) or getattr(response.raw, '_connection', None)
+    shutdown_socket(getattr(connection, 'sock', None))
+
+# Client for the Mistral chat-completions endpoint, shared by all sessions
+class MistralClient:
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(self, endpoint, pool_size=MISTRAL_POOL_SIZE, timeout=(MISTRAL_CONNECT_TIMEOUT, MISTRAL_READ_TIMEOUT),
+                 max_retries=MISTRAL_MAX_RETRIES, breaker_threshold=MISTRAL_BREAKER_THRESHOLD,
+                 breaker_cooldown=MISTRAL_BREAKER_COOLDOWN, reuse_connections=MISTRAL_REUSE_CONNECTIONS):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.reuse_connections = reuse_connections
+        self.max_retries = max_retries
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.open_until = 0.0
+
+        self.http = requests.Session()
+        adapter = CancellableHTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+
+    # POST a chat-completions request; returns a response with a successful status or raises RequestException.
+    # Cancelling cancellation while waiting for the response (or a retry) raises Cancelled.
+    def post(self, data, headers, stream=False, cancellation=None):
+        self._check_breaker()
+        attempt = 0
+        while True:
+            if cancellation is not None:
+                cancellation.check()
+            _request_cancellation.current = cancellation
+            if not self.reuse_connections:
+                # The server closes the connection after the response, so the pool never hands it out again
+                headers = dict(headers, Connection='close')
+            try:
+                response = self.http.post(self.endpoint, json=data, headers=headers, stream=stream, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if cancellation is not None:
+                    cancellation.check()  # Our own shutdown, not a failure of the API
+                if attempt >= self.max_retries:
+                    self._record(False)
+                    raise
+                logger.warning("Mistral request failed (%s), retrying", e)
+                delay = self._backoff(attempt)
+            else:
+                if response.status_code not in self.retry_statuses:
+                    self._record(True)
+                    response.raise_for_status()
+                    return response
+                if attempt >= self.max_retries:
+                    self._record(False)
+                    response.raise_for_status()
+                logger.warning("Mistral returned %s, retrying", response.status_code)
+                delay = self._backoff(attempt, response.headers.get('Retry-After'))
+                response.close()
+            finally:
+                _request_cancellation.current = None
+            attempt += 1
+            if cancellation is None:
+                time.sleep(delay)
+            elif cancellation.wait(delay):
+                raise Cancelled()
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after:
+            try:
+                return min(float(retry_after), MISTRAL_BACKOFF_MAX)
+            except ValueError:
+                pass
+        # Full jitter: anywhere between 0 and the exponential cap
+        return random.uniform(0, min(MISTRAL_BACKOFF_MAX, MISTRAL_BACKOFF_BASE * (2 ** attempt)))
+
+    def _check_breaker(self):
+        with self.lock:
+            if self.failures >= self.breaker_threshold:
+                if time.monotonic() < self.open_until:
+                    raise CircuitOpenError("Mistral API is unavailable, please try again shortly")
+                # Half-open: let this request through as a probe
+                self.open_until = time.monotonic() + self.breaker_cooldown
+
+    def _record(self, success):
+        with self.lock:
+            if success:
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.failures >= self.breaker_threshold:
+                self.open_until = time.monotonic() + self.breaker_cooldown
+                logger.error("Mistral circuit breaker open for %ss", self.breaker_cooldown)
+
+mistral_client = MistralClient(MISTRAL_ENDPOINT)
+
+MISTRAL_ERROR_PREFIX = "Error: Unable to fetch response."
+
+# A failed Mistral request, raised rather than returned as answer text so a partial answer is never
+# mistaken for a complete one
+class MistralError(Exception):
+    pass
+
+# Function to Fetch Response from Mistral API
+# usage, if given, is filled with the token counts Mistral reports for the request, and cancelling
+# cancellation aborts the request (raising Cancelled); a failed request raises MistralError
+def get_medical_response(user_input, context=(), usage=None, cancellation=None):
+    headers, data = build_mistral_request(user_input, context=context)
 
     try:
-        response = requests.post(MISTRAL_ENDPOINT, json=data, headers=headers)
-        response.raise_for_status()
+        response = mistral_client.post(data, headers, cancellation=cancellation)
         result = response.json()
+        if usage is not None:
+            usage.update(result.get("usage") or {})
         return result["choices"][0]["message"]["content"]
     except requests.exceptions.RequestException as e:
-        return f"Error: Unable to fetch response. {str(e)}"
+        raise MistralError(f"{MISTRAL_ERROR_PREFIX} {str(e)}") from e
+
+# Function to stream the response from Mistral API token by token (server-sent events).
+# Cancelling cancellation closes the connection, which also stops Mistral generating the rest.
+def stream_medical_response(user_input, context=(), usage=None, cancellation=None):
+    headers, data = build_mistral_request(user_input, stream=True, context=context)
+    cancellation = cancellation or Cancellation()
+
+    try:
+        with mistral_client.post(data, headers, stream=True, cancellation=cancellation) as response:
+            with cancellation.on_cancel(lambda: abort_response(response)):
+                # Server-sent events are always UTF-8; without a charset requests would assume ISO-8859-1
+                response.encoding = 'utf-8'
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue
+                    payload = line[len("data:"):].strip()
+                    if payload == "[DONE]":
+                        break
+                    chunk = json.loads(payload)
+                    if usage is not None and chunk.get("usage"):
+                        usage.update(chunk["usage"])  # Sent with the last chunk
+                    choices = chunk.get("choices") or []
+                    if not choices:
+                        continue
+                    content = (choices[0].get("delta") or {}).get("content")
+                    if content:
+                        yield content
+    except requests.exceptions.RequestException as e:
+        if cancellation.cancelled:
+            return
+        raise MistralError(f"{MISTRAL_ERROR_PREFIX} {str(e)}") from e
+
+# Cache of complete answers keyed on the normalized prompt, with a content-word index for near-duplicate lookups
+class ResponseCache:
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, threshold=RESPONSE_CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # normalized prompt -> entry, least recently used first
+        self.index = {}               # content word -> set of normalized prompts containing it
+        self.stats = {'exact_hits': 0, 'similar_hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+
+    @staticmethod
+    def normalize(prompt):
+        return " ".join(re.sub(r"[^\w\s]", " ", prompt.casefold()).split())
+
+    @staticmethod
+    def trigrams(text):
+        padded = f"  {text} "
+        return Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    @staticmethod
+    def content_words(text):
+        return Counter(word for word in text.split() if word not in RESPONSE_CACHE_FILLER_WORDS)
+
+    # Numbers and negations of a normalized prompt; near-duplicates must agree on all of them
+    @staticmethod
+    def critical_words(text):
+        return sorted(word for word in text.split() if word in RESPONSE_CACHE_NEGATIONS or any(c.isdigit() for c in word))
+
+    @staticmethod
+    def similarity(a, b):
+        dot = sum(count * b[gram] for gram, count in a.items() if gram in b)
+        if not dot:
+            return 0.0
+        norm_a = sum(count * count for count in a.values()) ** 0.5
+        norm_b = sum(count * count for count in b.values()) ** 0.5
+        return dot / (norm_a * norm_b)
+
+    # Returns the cached answer for the prompt or a near-duplicate of it, or None
+    def get(self, prompt):
+        key = self.normalize(prompt)
+        if not key:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            kind = 'exact_hits'
+            if entry is None:
+                entry, score = self._most_similar(key)
+                kind = 'similar_hits'
+                if entry is not None:
+                    logger.info("Response cache near-duplicate (%.2f): '%s' ~ '%s'", score, prompt, entry['prompt'])
+            if entry is not None and now - entry['created'] > self.ttl:
+                self._remove(entry['key'])
+                self.stats['expired'] += 1
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(entry['key'])
+            entry['hits'] += 1
+            entry['last_hit'] = now
+            self.stats[kind] += 1
+            return entry['response']
+
+    def put(self, prompt, response):
+        key = self.normalize(prompt)
+        if not key or not response:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            words = self.content_words(key)
+            self.entries[key] = {'key': key, 'prompt': prompt, 'response': response, 'words': words,
+                                 'critical': self.critical_words(key), 'created': time.monotonic(),
+                                 'hits': 0, 'last_hit': None}
+            for word in words:
+                self.index.setdefault(word, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            entries = [{'prompt': entry['prompt'], 'hits': entry['hits']} for entry in self.entries.values()]
+            return dict(self.stats, size=len(self.entries), max_entries=self.max_entries, entries=entries)
+
+    def _most_similar(self, key):
+        words = self.content_words(key)
+        critical = self.critical_words(key)
+        # Only prompts sharing a content word can be similar; score the ones sharing the most first
+        shared = Counter()
+        for word in words:
+            for other in self.index.get(word, ()):
+                shared[other] += 1
+        best, best_score = None, 0.0
+        for other, _ in shared.most_common(20):
+            entry = self.entries[other]
+            if entry['critical'] != critical:
+                continue
+            score = self.similarity(words, entry['words'])
+            if score > best_score:
+                best, best_score = entry, score
+        if best_score < self.threshold - 1e-9:
+            return None, best_score
+        return best, best_score
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        for word in entry['words']:
+            keys = self.index.get(word)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.index[word]
+
+response_cache = ResponseCache()
+
+# Blocking, non-streaming counterpart of stream_medical_response
+def complete_medical_response(user_input, context=(), usage=None, cancellation=None):
+    yield get_medical_response(user_input, context, usage, cancellation)
+
+def mistral_chunks(user_input, context, usage):
+    cancellation = Cancellation()
+    if MISTRAL_STREAM:
+        chunks = stream_medical_response(user_input, context, usage, cancellation)
+    else:
+        chunks = complete_medical_response(user_input, context, usage, cancellation)
+    return iterate_in_executor(chunks, llm_pool.executor, cancellation)
+
+# Requests for the same question (as the response cache normalizes it) with the same history are identical
+def llm_flight_key(user_input, context):
+    return (MISTRAL_STREAM, ResponseCache.normalize(user_input), json.dumps(list(context)))
 
-def stream_response(user_input, token):
-    global current_token
-    if token != current_token:
+# Fetch the answer to user_input from Mistral while holding one of the session's LLM slots, sharing
+# the request with any identical one in flight. Use with contextlib.aclosing so the slot is released
+# (and the shared request dropped, if nobody else wants it) as soon as the consumer stops.
+async def fetch_medical_response(session, user_input, context=(), usage=None, token=None):
+    async with llm_pool.slot(session):
+        call = llm_flights.join(llm_flight_key(user_input, context),
+                                lambda info: mistral_chunks(user_input, context, info))
+        start = time.perf_counter()
+        first = True
+        async with contextlib.aclosing(call.replay()) as chunks:
+            async for chunk in chunks:
+                if first:
+                    stage_metrics.observe('llm_first_byte', time.perf_counter() - start, session, token)
+                    first = False
+                yield chunk
+        if usage is not None:
+            usage.update(call.info)
+        stage_metrics.observe('llm_total', time.perf_counter() - start, session, token)
+
+async def replay_text(text):
+    yield text
+
+# Speech segmentation: answers are cut into TTS chunks of about SEGMENT_MIN_SECONDS to SEGMENT_MAX_SECONDS
+# of speech, estimated at SPEECH_CHARS_PER_SECOND. Shorter sentences are merged with the next one and longer
+# ones are split at a clause boundary. The first chunk is sent as soon as it closes and kept under
+# SEGMENT_FIRST_MAX_SECONDS, since it decides how soon the user hears anything.
+SPEECH_CHARS_PER_SECOND = 15
+SEGMENT_MIN_SECONDS = 2.0
+SEGMENT_MAX_SECONDS = 10.0
+SEGMENT_FIRST_MAX_SECONDS = 4.0
+
+# Words that end with a period without ending the sentence, even before a capital ("Dr. Smith", "e.g. Ibuprofen").
+# Anything followed by a lowercase word is never a sentence end, which covers "a.m. and", "b.i.d. for" and the like.
+SEGMENT_ABBREVIATIONS = {'dr', 'mr', 'mrs', 'ms', 'prof', 'st', 'vs', 'e.g', 'i.e', 'cf', 'approx', 'fig', 'no', 'et al'}
+
+# Incremental speech segmenter: feed it text as it arrives, get back the chunks ready for TTS
+class SpeechSegmenter:
+    terminator = re.compile(r'[.!?]+["\')\]]*\s+|\n\s*')
+    clause = re.compile(r'[,;:]\s+')
+    conjunction = re.compile(r'\s+(?=(?:and|but|or|so|because|which|while|although|unless|if|when|then)\s)')
+
+    def __init__(self):
+        self.buffer = ""   # text of the sentence still open
+        self.current = ""  # closed text held back to merge with the next sentence
+        self.sent = 0      # chunks returned so far
+        self.min_chars = int(SEGMENT_MIN_SECONDS * SPEECH_CHARS_PER_SECOND)
+        self.max_chars = int(SEGMENT_MAX_SECONDS * SPEECH_CHARS_PER_SECOND)
+        self.first_max_chars = int(SEGMENT_FIRST_MAX_SECONDS * SPEECH_CHARS_PER_SECOND)
+
+    def feed(self, text):
+        self.buffer += text
+        chunks = []
+        start = 0
+        for match in self.terminator.finditer(self.buffer):
+            if match.end() == len(self.buffer):
+                break  # Whether this ends the sentence depends on what follows
+            if self._is_boundary(start, match):
+                chunks += self._close(self.buffer[start:match.end()].strip())
+                start = match.end()
+        self.buffer = self.buffer[start:]
+        return chunks
+
+    def flush(self):
+        chunks = self._close(self.buffer.strip())
+        self.buffer = ""
+        if self.current:
+            chunks.append(self.current)
+            self.current = ""
+        return chunks
+
+    def _is_boundary(self, start, match):
+        sentence = self.buffer[start:match.start()].strip()
+        if not sentence:
+            return False
+        if match.group()[0] == '\n':
+            return True
+        if self.buffer[match.end()].islower():
+            return False
+        if not match.group().startswith('.') or match.group().startswith('..'):
+            return True  # ! ? and ellipses
+        words = sentence.split()
+        word = words[-1].lstrip('(["\'').lower()
+        if word in SEGMENT_ABBREVIATIONS or ' '.join(words[-2:]).lower() in SEGMENT_ABBREVIATIONS:
+            return False
+        # A list number ("2. Ice it") rather than the end of a sentence
+        return not (word.isdigit() and len(words) == 1)
+
+    # Merge or split a closed sentence into chunks within the duration window
+    def _close(self, sentence):
+        chunks = []
+        while sentence:
+            first = self.sent == 0 and not self.current
+            limit = self.first_max_chars if first else self.max_chars
+            if len(sentence) > limit:
+                piece, sentence = self._split(sentence, limit)
+            else:
+                piece, sentence = sentence, ""
+            if self.current and len(self.current) + 1 + len(piece) > self.max_chars:
+                chunks.append(self.current)
+                self.sent += 1
+                self.current = ""
+            self.current = f"{self.current} {piece}" if self.current else piece
+            if self.sent == 0 or len(self.current) >= self.min_chars:
+                chunks.append(self.current)
+                self.sent += 1
+                self.current = ""
+        return chunks
+
+    # Cut a long sentence at the last clause boundary that fits in limit characters, preferring
+    # punctuation over conjunctions and either over a bare word boundary
+    def _split(self, sentence, limit):
+        for pattern in (self.clause, self.conjunction):
+            cuts = [match for match in pattern.finditer(sentence, 0, limit + 1) if match.start() >= self.min_chars]
+            if cuts:
+                cut = cuts[-1]
+                head = sentence[:cut.start() + len(cut.group().rstrip())]
+                return head.strip(), sentence[cut.end():].strip()
+        space = sentence.rfind(' ', 0, limit + 1)
+        if space <= 0:
+            return sentence, ""
+        return sentence[:space], sentence[space + 1:]
+
+async def stream_response(session, user_input, token, prefetched=None):
+    if not session.is_current(token):
+        if prefetched:
+            prefetched.cancel()
         return  # Exit if this response is no longer current
     
-    socketio.emit('thinking_status', {'status': True})
+    session.emit('thinking_status', {'status': True})
+    accumulated_text = ""
+    failed = False
     
     try:
-        full_response = get_medical_response(user_input)
-        sentences = [s.strip() for s in re.split(r'(?<=[.!?]) +', full_response) if s.strip()]
-        
-        print(f"Processing response with {len(sentences)} sentences")
-        
-        accumulated_text = ""
-        for sentence in sentences:
-            if token != current_token:
-                print("Token changed, stopping response streaming")
-                break  # Stop processing if token has changed
-            
-            accumulated_text += (" " if accumulated_text else "") + sentence
-            socketio.emit('response_stream', {'text': accumulated_text, 'is_final': False})
-            
-            print(f"Adding sentence to TTS queue: '{sentence}'")
-            tts_queue.put((token, sentence))
+        conversation = await session.sync_conversation()
+        context, prompt_tokens = conversation.context(user_input)
+        usage = {}
+        # Cached answers are only valid without history: a follow-up means something else in context
+        cached_response = response_cache.get(user_input) if conversation.is_empty() else None
+        if prefetched and (cached_response is not None or prefetched.version != conversation.version):
+            prefetched.cancel()
+            prefetched = None
+        if cached_response is not None:
+            # A cache hit goes through the same sentence path so voice and text behave the same
+            logger.info("Response cache hit for '%s'", user_input)
+            source = replay_text(cached_response)
+            prompt_tokens = 0
+        elif prefetched:
+            logger.info("Using speculative answer for '%s'", prefetched.prompt)
+            source = prefetched.replay()
+            usage = prefetched.usage
+        else:
+            source = fetch_medical_response(session, user_input, context, usage, token)
+        if prompt_tokens:
+            logger.debug("Prompt for token %s: ~%d tokens, %d history messages", token, prompt_tokens, len(context))
+
+        segmenter = SpeechSegmenter()
+        sentence_count = 0
+
+        # response_stream messages carry only the newly appended text; the token identifies the message
+        async def emit_sentence(sentence):
+            nonlocal accumulated_text, sentence_count
+            delta = (" " if accumulated_text else "") + sentence
+            accumulated_text += delta
+            session.emit('response_stream', {'message_id': token, 'seq': sentence_count, 'delta': delta, 'is_final': False})
+            sentence_count += 1
             
-            socketio.sleep(0.3)  # Reduced delay for quicker response
+            logger.debug("Adding sentence to TTS queue: '%s'", sentence)
+            session.queue_tts(token, sentence)
             
-        if token == current_token:
-            socketio.emit('response_stream', {'text': accumulated_text, 'is_final': True})
+            waited = await session.wait_for_capacity(token)
+            if waited >= BACKPRESSURE_POLL:
+                logger.debug("Throttled text stream for %.2fs (client queue %d, TTS lag %d)",
+                             waited, session.client_queue_depth, session.tts.pending())
+
+        async with contextlib.aclosing(source) as chunks:
+            async for chunk in chunks:
+                if not session.is_current(token):
+                    logger.debug("Token changed, stopping response streaming")
+                    break  # Stop processing if token has changed
+                with stage_metrics.span('sentence_split', session, token):
+                    sentences = segmenter.feed(chunk)
+                for sentence in sentences:
+                    await emit_sentence(sentence)
+
+        if session.is_current(token):
+            for sentence in segmenter.flush():
+                await emit_sentence(sentence)
+            logger.info("Processed response for %s, token %s, with %d sentences", session.sid, token, sentence_count)
+            session.tts.finish(token)
+            if cached_response is None and not context and accumulated_text:
+                response_cache.put(user_input, accumulated_text)
+            # Prefer the count Mistral reports; the estimate stands in when it did not send usage
+            prompt_tokens = usage.get('prompt_tokens', prompt_tokens)
+            if 'prompt_tokens' in usage:
+                logger.info("Prompt for token %s: %s tokens reported, %s completion tokens",
+                            token, prompt_tokens, usage.get('completion_tokens'))
+            # The final message carries the full text so the client can reconcile any lost delta
+            session.emit('response_stream', {'message_id': token, 'seq': sentence_count, 'delta': '', 'text': accumulated_text,
+                                             'prompt_tokens': prompt_tokens, 'is_final': True})
             
+    except Busy as e:
+        logger.warning("Rejected answer for token %s: %s", token, e)
+        session.emit('busy', {'kind': 'llm', 'message': 'The assistant is busy right now. Please try again in a moment.'})
+    except asyncio.CancelledError:
+        logger.debug("Answer task for token %s cancelled", token)
+        raise
+    except MistralError as e:
+        # Whatever was streamed before the failure stays on screen but is neither cached nor remembered
+        logger.error("Mistral request failed for token %s: %s", token, e)
+        failed = True
+        session.emit('error_message', {'message': str(e)})
     except Exception as e:
-        print(f"Error in stream_response: {str(e)}")
-        socketio.emit('error_message', {'message': f'Error generating response: {str(e)}'})
+        logger.exception("Error in stream_response: %s", e)
+        failed = True
+        session.emit('error_message', {'message': f'Error generating response: {str(e)}'})
     finally:
-        if token == current_token:
-            socketio.emit('thinking_status', {'status': False})
+        # Keep whatever part of the answer the user got, so a follow-up after an interruption has context
+        if accumulated_text and not failed:
+            await session.record_turn(user_input, accumulated_text)
+        if session.is_current(token):
+            session.emit('thinking_status', {'status': False})
 
-# Function to handle speech recognition with improved error handling
-def recognize_speech():
-    global current_token, tts_queue
-    recognizer = sr.Recognizer()
+# Speech recognition backends: start() returns a stream that takes PCM chunks via accept(),
+# which returns the current partial transcript (or None), and finish(), which returns the final text
+class GoogleSpeechBackend:
+    name = 'google'
 
-    try:
-        print("Starting speech recognition")
-        socketio.emit('listening_status', {'status': True})
+    def start(self, sample_rate):
+        return GoogleSpeechStream(sample_rate)
+
+# Google's free web API has no streaming mode, so the audio is buffered and sent once at the end
+class GoogleSpeechStream:
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.buffer = bytearray()
+        self.recognizer = sr.Recognizer()
+
+    def accept(self, chunk):
+        self.buffer.extend(chunk)
+        return None
+
+    def finish(self):
+        audio = sr.AudioData(bytes(self.buffer), self.sample_rate, 2)
+        return self.recognizer.recognize_google(audio)
+
+class VoskSpeechBackend:
+    name = 'vosk'
+
+    def __init__(self, model_path=VOSK_MODEL_PATH):
+        if vosk is None:
+            raise RuntimeError("STT_BACKEND 'vosk' needs the vosk package (pip install vosk)")
+        self.model = vosk.Model(model_path)
+
+    def start(self, sample_rate):
+        return VoskSpeechStream(vosk.KaldiRecognizer(self.model, sample_rate))
+
+class VoskSpeechStream:
+    def __init__(self, recognizer):
+        self.recognizer = recognizer
+        self.segments = []  # text of segments Vosk has already finalized
 
-        with sr.Microphone() as source:
-            print("Adjusting for ambient noise...")
-            recognizer.adjust_for_ambient_noise(source, duration=1)
-            print("Listening for speech...")
-            audio = recognizer.listen(source, timeout=5, phrase_time_limit=10)
-            print("Audio captured")
+    def accept(self, chunk):
+        if self.recognizer.AcceptWaveform(chunk):
+            text = json.loads(self.recognizer.Result()).get('text', '')
+            if text:
+                self.segments.append(text)
+            return " ".join(self.segments)
+        partial = json.loads(self.recognizer.PartialResult()).get('partial', '')
+        return " ".join(self.segments + ([partial] if partial else []))
 
-        socketio.emit('listening_status', {'status': False})
+    def finish(self):
+        text = json.loads(self.recognizer.FinalResult()).get('text', '')
+        if text:
+            self.segments.append(text)
+        transcript = " ".join(self.segments)
+        if not transcript:
+            raise sr.UnknownValueError()
+        return transcript
 
-        print("Recognizing speech...")
-        user_input = recognizer.recognize_google(audio)
-        print(f"Speech recognized: '{user_input}'")
+SPEECH_BACKENDS = {
+    'google': GoogleSpeechBackend,
+    'vosk': VoskSpeechBackend,
+}
 
-        socketio.emit('speech_recognized', {'text': user_input})
+_speech_backend = None
+_speech_backend_lock = threading.Lock()
 
-        # **Cancel previous processing before starting a new one**
-        current_token += 1
-        print(f"Cancelling previous processing, new token: {current_token}")
+# The configured backend is created on first use, since loading an offline model can take a while
+def get_speech_backend():
+    global _speech_backend
+    with _speech_backend_lock:
+        if _speech_backend is None:
+            _speech_backend = SPEECH_BACKENDS[STT_BACKEND]()
+            logger.info("Speech recognition backend: %s", _speech_backend.name)
+        return _speech_backend
 
-        with tts_queue.mutex:
-            queue_size = len(tts_queue.queue)
-            tts_queue.queue.clear()
-            print(f"Cleared TTS queue ({queue_size} items removed)")
+def pcm_rms(chunk):
+    samples = array.array('h')
+    samples.frombytes(chunk[:len(chunk) - len(chunk) % 2])
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    if not samples:
+        return 0.0
+    return (sum(sample * sample for sample in samples) / len(samples)) ** 0.5
 
-        socketio.emit('stop_audio')
-        print("Sent stop_audio signal to client")
+# Detects the end of an utterance from chunk loudness. The floor drops to the quietest chunk heard, so a
+# user who starts talking at once is measured against the pause after their words; the utterance so far
+# is judged again against the current floor on every chunk.
+class EndOfSpeechDetector:
+    def __init__(self, session, sample_rate):
+        self.session = session
+        self.bytes_per_second = sample_rate * 2
+        self.elapsed = 0.0
+        self.silence = 0.0
+        self.heard_speech = False
+        self.levels = []  # (duration, rms) of every chunk of this utterance
 
-        # **Start response streaming for speech input**
-        thread = threading.Thread(target=stream_response, args=(user_input, current_token))
-        thread.daemon = True
-        thread.start()
+    # Returns True once the utterance is over
+    def update(self, chunk):
+        duration = len(chunk) / self.bytes_per_second
+        self.elapsed += duration
+        rms = pcm_rms(chunk)
+        self.levels.append((duration, rms))
+
+        floor = self.session.noise_floor
+        self.session.noise_floor = rms if floor is None else min(rms, floor * (1 + STT_NOISE_FLOOR_RISE * duration))
+
+        threshold = max(self.session.noise_floor * STT_SPEECH_FACTOR, STT_MIN_SPEECH_RMS)
+        self.silence = 0.0
+        self.heard_speech = False
+        for duration, rms in reversed(self.levels):
+            if rms > threshold:
+                self.heard_speech = True
+                break
+            self.silence += duration
+
+        if self.heard_speech:
+            return self.silence >= STT_END_SILENCE_SECONDS or self.elapsed >= STT_PHRASE_TIME_LIMIT
+        if self.elapsed >= STT_NO_SPEECH_TIMEOUT:
+            raise sr.UnknownValueError()
+        return False
+
+speculation_stats = {'started': 0, 'hits': 0, 'misses': 0, 'over_budget': 0, 'saved_seconds': 0.0}
+
+# Character-trigram similarity of two prompts, or 0 when they differ in a number or a negation
+# ("with" vs "without alcohol" would otherwise score 0.92)
+def prompt_similarity(a, b):
+    a, b = ResponseCache.normalize(a), ResponseCache.normalize(b)
+    if ResponseCache.critical_words(a) != ResponseCache.critical_words(b):
+        return 0.0
+    return ResponseCache.similarity(ResponseCache.trigrams(a), ResponseCache.trigrams(b))
+
+# An answer fetched ahead of time for a partial transcript; chunks are buffered until it is adopted
+class Speculation:
+    def __init__(self, session, prompt):
+        self.prompt = prompt
+        # The answer only fits the conversation as it was when the speculation started
+        self.version = session.conversation.version
+        self.context, _ = session.conversation.context(prompt)
+        self.usage = {}
+        self.started = time.monotonic()
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.changed = asyncio.Event()
+        self.task = answer_loop.create_task(self._fetch(session))
+
+    async def _fetch(self, session):
+        try:
+            async with contextlib.aclosing(fetch_medical_response(session, self.prompt, self.context, self.usage)) as chunks:
+                async for chunk in chunks:
+                    self.chunks.append(chunk)
+                    self.changed.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Speculative request failed: %s", e)
+            self.error = e
+        finally:
+            self.done = True
+            self.changed.set()
+
+    def cancel(self):
+        self.task.cancel()
+
+    # Yield the buffered chunks, then the rest as they arrive; closing early cancels the fetch
+    async def replay(self):
+        sent = 0
+        try:
+            while True:
+                while sent < len(self.chunks):
+                    yield self.chunks[sent]
+                    sent += 1
+                if self.done:
+                    # A failed fetch is raised even after partial content, so the answer is not taken as complete
+                    if self.error:
+                        raise self.error
+                    return
+                self.changed.clear()
+                await self.changed.wait()
+        finally:
+            if not self.done:
+                self.cancel()
+
+# Decides when a partial transcript is stable enough to speculate on, and whether the final one matches
+class Speculator:
+    def __init__(self, session):
+        self.session = session
+        self.speculation = None
+        self.last_partial = None
+        self.stable_chunks = 0
+        # Speculative requests this utterance may still start
+        self.budget = SPECULATION_BUDGET
+
+    def observe(self, partial):
+        if not SPECULATION_ENABLED or not partial:
+            return
+        if partial != self.last_partial:
+            self.last_partial = partial
+            self.stable_chunks = 0
+            return
+        self.stable_chunks += 1
+        if self.stable_chunks != SPECULATION_STABLE_CHUNKS or len(partial.split()) < SPECULATION_MIN_WORDS:
+            return
+        if self.speculation and prompt_similarity(self.speculation.prompt, partial) >= SPECULATION_MATCH_THRESHOLD:
+            return  # Already fetching an answer for (nearly) this text
+        self.cancel()
+        if self.budget <= 0:
+            speculation_stats['over_budget'] += 1
+            return
+        self.budget -= 1
+        speculation_stats['started'] += 1
+        logger.debug("Speculating on partial transcript: '%s'", partial)
+        self.speculation = Speculation(self.session, partial)
+
+    # Returns the speculation to adopt for the final transcript, or None after cancelling a mismatch
+    def resolve(self, final):
+        speculation, self.speculation = self.speculation, None
+        if speculation is None:
+            return None
+        similarity = prompt_similarity(speculation.prompt, final)
+        if speculation.error is None and similarity >= SPECULATION_MATCH_THRESHOLD:
+            saved = time.monotonic() - speculation.started
+            speculation_stats['hits'] += 1
+            speculation_stats['saved_seconds'] += saved
+            logger.info("Speculation hit (%.2f), answer started %.2fs early", similarity, saved)
+            return speculation
+        speculation_stats['misses'] += 1
+        logger.info("Speculation miss (%.2f): '%s' vs '%s'", similarity, speculation.prompt, final)
+        speculation.cancel()
+        return None
+
+    def cancel(self):
+        if self.speculation:
+            self.speculation.cancel()
+            self.speculation = None
+
+# Function to handle speech recognition of audio streamed from the browser
+async def recognize_speech(session, chunks, sample_rate):
+    speculator = Speculator(session)
+
+    # An STT slot is only held while the recognizer works, not while waiting for the client's next chunk,
+    # so people speaking slowly do not use up the pool
+    async def recognize(fn, *args):
+        async with stt_pool.slot(session):
+            return await stt_pool.run(fn, *args)
+
+    try:
+        logger.debug("Starting speech recognition for %s", session.sid)
+        session.emit('listening_status', {'status': True})
+
+        # get_speech_backend() may load a model (vosk) on first use; keep that off answer_loop
+        stream = await recognize(lambda: get_speech_backend().start(sample_rate))
+        detector = EndOfSpeechDetector(session, sample_rate)
+        last_partial = None
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.get(), STT_CHUNK_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.info("No audio received from %s, ending utterance", session.sid)
+                break
+            if chunk is None:
+                break
+            partial = await recognize(stream.accept, chunk)
+            speculator.observe(partial)
+            if partial and partial != last_partial:
+                last_partial = partial
+                session.emit('partial_transcript', {'text': partial})
+            if detector.update(chunk):
+                break
+
+        session.emit('listening_status', {'status': False})
+
+        logger.debug("Recognizing speech...")
+        with stage_metrics.span('stt', session):
+            user_input = await recognize(stream.finish)
+        logger.info("Speech recognized: '%s'", user_input)
+
+        session.emit('speech_recognized', {'text': user_input})
+
+        # **Cancel previous processing and start response streaming for speech input**
+        prefetched = speculator.resolve(user_input)
+        await asyncio.get_running_loop().run_in_executor(None, session.start_answer, user_input, prefetched)
 
     except sr.UnknownValueError:
-        print("Speech recognition could not understand audio")
-        socketio.emit('error_message', {'message': "Sorry, I couldn't understand. Please try again."})
+        logger.info("Speech recognition could not understand audio")
+        session.emit('error_message', {'message': "Sorry, I couldn't understand. Please try again."})
     except sr.RequestError as e:
-        print(f"Speech recognition service error: {e}")
-        socketio.emit('error_message', {'message': f"Error in speech recognition service: {str(e)}"})
+        logger.error("Speech recognition service error: %s", e)
+        session.emit('error_message', {'message': f"Error in speech recognition service: {str(e)}"})
+    except Busy as e:
+        logger.warning("Rejected speech recognition: %s", e)
+        session.emit('busy', {'kind': 'stt', 'message': 'Voice input is busy right now. Please try again in a moment.'})
+    except asyncio.CancelledError:
+        logger.debug("Speech recognition cancelled")
+        raise
     except Exception as e:
-        print(f"Speech recognition error: {e}")
-        import traceback
-        traceback.print_exc()
-        socketio.emit('error_message', {'message': f"An error occurred during speech recognition: {str(e)}"})
+        logger.exception("Speech recognition error: %s", e)
+        session.emit('error_message', {'message': f"An error occurred during speech recognition: {str(e)}"})
+    finally:
+        speculator.cancel()
+        session.audio_chunks = None
+        session.emit('listening_status', {'status': False})
 
-# Function to generate speech audio optimized for sentence-by-sentence processing
-def text_to_speech(text):
-    try:
-        if not text or len(text.strip()) < 2:
-            print("Empty text received, skipping TTS")
+# Content-addressed cache of synthesized audio, keyed on (normalized text, lang, engine). A key ends in
+# the engine's file extension, so files in the disk tier are named after their format.
+AUDIO_CACHE_EXTENSIONS = ('.mp3', '.wav')
+
+class AudioCache:
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> audio bytes, least recently used first
+        self.bytes = 0
+        self.disk_bytes = 0
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0}
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self.disk_bytes = sum(os.path.getsize(path) for path in self._disk_files())
+
+    @staticmethod
+    def key(text, lang, engine, extension='mp3'):
+        normalized = " ".join(text.split()).casefold()
+        return hashlib.sha256(f"{engine}\0{lang}\0{normalized}".encode('utf-8')).hexdigest() + '.' + extension
+
+    def get(self, key):
+        with self.lock:
+            audio = self.entries.get(key)
+            if audio is not None:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return audio
+
+        audio = self._disk_get(key)
+        with self.lock:
+            if audio is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['disk_hits'] += 1
+            self._memory_put(key, audio)
+        return audio
+
+    def put(self, key, audio):
+        with self.lock:
+            self._memory_put(key, audio)
+        self._disk_put(key, audio)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), bytes=self.bytes,
+                        max_bytes=self.max_bytes, disk_bytes=self.disk_bytes)
+
+    def _memory_put(self, key, audio):
+        if len(audio) > self.max_bytes:
             return
-            
-        print(f"Converting to speech: '{text}'")
-        
-        # Create temp file in a way that ensures it's accessible
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp3') as temp_file:
-            temp_filename = temp_file.name
-            print(f"Temp file created: {temp_filename}")
-        
-        # Generate and save audio
-        tts = gTTS(text=text, lang='en', slow=False)
-        tts.save(temp_filename)
-        print("Audio saved to temp file")
-        
-        # Add a small delay to ensure file is fully written
-        time.sleep(0.2)
-        
-        # Read the audio file
-        with open(temp_filename, 'rb') as audio_file:
-            audio_data = base64.b64encode(audio_file.read()).decode('utf-8')
-            print(f"Audio file read, size: {len(audio_data)} chars")
-        
-        # Clean up
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old)
+        self.entries[key] = audio
+        self.bytes += len(audio)
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= len(evicted)
+            self.stats['evictions'] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key)
+
+    def _disk_files(self):
+        return [os.path.join(self.disk_dir, name) for name in os.listdir(self.disk_dir)
+                if name.endswith(AUDIO_CACHE_EXTENSIONS)]
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                audio = f.read()
+            os.utime(path)  # Mark as recently used for eviction
+            return audio
+        except OSError:
+            return None
+
+    def _disk_put(self, key, audio):
+        if not self.disk_dir or len(audio) > self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        try:
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(audio)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning("Could not write TTS cache file: %s", e)
+            return
+        with self.lock:
+            self.disk_bytes += len(audio)
+            if self.disk_bytes <= self.disk_max_bytes:
+                return
+        self._disk_evict()
+
+    # Remove least recently used files until the disk tier is back under its limit
+    def _disk_evict(self):
+        files = []
+        for path in self._disk_files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        evicted = 0
+        for _, size, path in files:
+            if total <= self.disk_max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        with self.lock:
+            self.disk_bytes = total
+            self.stats['disk_evictions'] += evicted
+
+tts_cache = AudioCache(TTS_CACHE_MAX_BYTES, TTS_CACHE_DIR, TTS_CACHE_DISK_MAX_BYTES)
+
+# Text-to-speech engines: synthesize() returns one complete clip in the engine's mime type, and
+# stream() yields audio as the engine produces it, described by stream_format. Cancelling the
+# Cancellation passed to stream() makes it stop as soon as the engine allows.
+class TTSEngine(abc.ABC):
+    name = None
+    voice = None
+    mime = None
+    extension = None
+    stream_format = None
+
+    @abc.abstractmethod
+    def synthesize(self, text):
+        ...
+
+    @abc.abstractmethod
+    def stream(self, text, cancellation=None):
+        ...
+
+    # Join streamed chunks back into one clip, as synthesize() would have returned it
+    @abc.abstractmethod
+    def assemble(self, chunks):
+        ...
+
+# Google TTS over the network; stream() yields one self-contained MP3 per text part gTTS sends.
+# gTTS makes its own HTTP requests, so a cancelled stream finishes the part being fetched but
+# requests no further ones.
+class GTTSEngine(TTSEngine):
+    name = 'gtts'
+    mime = 'audio/mpeg'
+    extension = 'mp3'
+    stream_format = {'format': 'mp3'}
+
+    def __init__(self, lang=TTS_LANG):
+        self.voice = lang
+
+    def synthesize(self, text):
+        buffer = io.BytesIO()
+        gTTS(text=text, lang=self.voice, slow=False).write_to_fp(buffer)
+        return buffer.getvalue()
+
+    def stream(self, text, cancellation=None):
+        for audio in gTTS(text=text, lang=self.voice, slow=False).stream():
+            if cancellation is not None:
+                cancellation.check()
+            yield audio
+
+    # Concatenated MP3 frames are still a valid MP3
+    def assemble(self, chunks):
+        return b"".join(chunks)
+
+# Local engines run a command that writes 16-bit mono PCM to stdout; stream() yields it as it is read,
+# and cancelling kills the command
+class SubprocessTTSEngine(TTSEngine):
+    mime = 'audio/wav'
+    extension = 'wav'
+    sample_rate = 22050
+    read_size = 4096
+    min_chunk_size = 2048
+
+    @abc.abstractmethod
+    def command(self):
+        ...
+
+    # Strip any container header from the start of the output and return (pcm, header complete)
+    def strip_header(self, data):
+        return data, True
+
+    def stream(self, text, cancellation=None):
+        cancellation = cancellation or Cancellation()
+        process = subprocess.Popen(self.command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
         try:
-            os.unlink(temp_filename)
-            print("Temp file deleted")
+            with cancellation.on_cancel(process.kill):
+                process.stdin.write(text.encode('utf-8'))
+                process.stdin.close()
+                buffer = b""
+                header_done = False
+                while True:
+                    data = process.stdout.read1(self.read_size)
+                    if not data:
+                        break
+                    buffer += data
+                    if not header_done:
+                        buffer, header_done = self.strip_header(buffer)
+                        if not header_done:
+                            continue
+                    # Send reasonably sized chunks, cut on whole samples
+                    if len(buffer) >= self.min_chunk_size:
+                        cut = len(buffer) - len(buffer) % 2
+                        yield buffer[:cut]
+                        buffer = buffer[cut:]
+                cancellation.check()
+                if header_done and len(buffer) >= 2:
+                    yield buffer[:len(buffer) - len(buffer) % 2]
+                if process.wait() != 0:
+                    raise RuntimeError(f"{self.name} exited with status {process.returncode}")
+        except BrokenPipeError:
+            cancellation.check()
+            raise
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    @property
+    def stream_format(self):
+        return {'format': 'pcm_s16le', 'sample_rate': self.sample_rate, 'channels': 1}
+
+    def synthesize(self, text):
+        return self.assemble(self.stream(text))
+
+    def assemble(self, chunks):
+        pcm = b"".join(chunks)
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self.sample_rate)
+            wav.writeframes(pcm)
+        return buffer.getvalue()
+
+class EspeakEngine(SubprocessTTSEngine):
+    name = 'espeak'
+
+    def __init__(self, voice=ESPEAK_VOICE, words_per_minute=ESPEAK_WORDS_PER_MINUTE):
+        self.voice = voice
+        self.words_per_minute = words_per_minute
+
+    def command(self):
+        return [ESPEAK_COMMAND, '--stdout', '-v', self.voice, '-s', str(self.words_per_minute)]
+
+    # espeak-ng writes a WAV header (with unknown sizes, since stdout is a pipe) before the samples
+    def strip_header(self, data):
+        if len(data) < 12:
+            return data, False
+        position = 12
+        while position + 8 <= len(data):
+            chunk_id = data[position:position + 4]
+            chunk_size = int.from_bytes(data[position + 4:position + 8], 'little')
+            if chunk_id == b'fmt ' and position + 16 <= len(data):
+                self.sample_rate = int.from_bytes(data[position + 12:position + 16], 'little')
+            if chunk_id == b'data':
+                return data[position + 8:], True
+            position += 8 + chunk_size
+        return data, False
+
+class PiperEngine(SubprocessTTSEngine):
+    name = 'piper'
+
+    def __init__(self, model=PIPER_MODEL, sample_rate=PIPER_SAMPLE_RATE):
+        self.voice = os.path.basename(model)
+        self.model = model
+        self.sample_rate = sample_rate
+
+    def command(self):
+        return [PIPER_COMMAND, '--model', self.model, '--output_raw']
+
+TTS_ENGINES = {
+    'gtts': GTTSEngine,
+    'espeak': EspeakEngine,
+    'piper': PiperEngine,
+}
+
+_tts_engine = None
+_tts_engine_lock = threading.Lock()
+
+def get_tts_engine():
+    global _tts_engine
+    with _tts_engine_lock:
+        if _tts_engine is None:
+            _tts_engine = TTS_ENGINES[TTS_ENGINE]()
+            logger.info("Text-to-speech engine: %s", _tts_engine.name)
+        return _tts_engine
+
+# Function to generate audio for one sentence, entirely in memory
+def generate_speech_audio(text):
+    logger.debug("Converting to speech: '%s'", text)
+    
+    audio = get_tts_engine().synthesize(text)
+    logger.debug("Audio generated, size: %d bytes", len(audio))
+
+    return audio
+
+def is_speakable(text):
+    return bool(text) and len(text.strip()) >= 2
+
+def speech_cache_key(text):
+    engine = get_tts_engine()
+    return AudioCache.key(text, engine.voice, engine.name, engine.extension)
+
+# Cache access from answer_loop. With a disk tier a lookup reads and touches files and a write can scan the
+# whole directory to evict, so both go to the TTS executor; writes are not waited for.
+async def get_cached_speech(key):
+    if not tts_cache.disk_dir:
+        return tts_cache.get(key)
+    return await tts_pool.run(tts_cache.get, key)
+
+def cache_speech(key, audio):
+    if not tts_cache.disk_dir:
+        tts_cache.put(key, audio)
+    else:
+        tts_pool.executor.submit(tts_cache.put, key, audio)
+
+# Function to get speech audio for one sentence in the engine's format, or None for empty text
+def synthesize_speech(text):
+    if not is_speakable(text):
+        logger.debug("Empty text received, skipping TTS")
+        return None
+
+    key = speech_cache_key(text)
+    audio = tts_cache.get(key)
+    if audio is None:
+        audio = generate_speech_audio(text)
+        tts_cache.put(key, audio)
+    else:
+        logger.debug("TTS cache hit: '%s'", text)
+
+    return audio
+
+# Pre-synthesize common phrases so their first use is served from the cache
+def warm_tts_cache(phrases=None):
+    phrases = TTS_WARMUP_PHRASES if phrases is None else phrases
+    logger.info("Warming TTS cache with %d phrases", len(phrases))
+    for phrase in phrases:
+        try:
+            synthesize_speech(phrase)
         except Exception as e:
-            print(f"Warning: Could not delete temp file: {str(e)}")
+            logger.warning("Could not warm TTS cache for '%s': %s", phrase, e)
+    logger.info("TTS cache warm-up done: %s", tts_cache.snapshot())
+
+# Function to generate speech audio and send it straight to the client
+def text_to_speech(text, emit=socketio.emit):
+    try:
+        audio = synthesize_speech(text)
+        if audio is None:
+            return
         
         # Send the audio data to the client
-        print("Sending audio data to client")
-        socketio.emit('play_audio', {'audio_data': audio_data})
-        print("Audio data sent")
+        logger.debug("Sending audio data to client")
+        emit('play_audio', {'audio_data': base64.b64encode(audio).decode('utf-8')})
+        logger.debug("Audio data sent")
     
     except Exception as e:
-        print(f"TTS Error: {str(e)}")
-        socketio.emit('error_message', {'message': f'Error generating speech: {str(e)}'})
+        logger.error("TTS Error: %s", e)
+        emit('error_message', {'message': f'Error generating speech: {str(e)}'})
 
-# TTS worker thread: processes items from the queue if they belong to the current message
-def tts_worker():
-    global current_token
-    print("TTS worker thread started")
-    while True:
+# Synthesize a whole clip through the engine's stream, so it can be cancelled like a streamed one
+async def synthesize_clip(text):
+    key = speech_cache_key(text)
+    audio = await get_cached_speech(key)
+    if audio is None:
+        chunks = [chunk async for chunk in stream_speech(text, key)]
+        audio = get_tts_engine().assemble(chunks) if chunks else None
+    yield audio
+
+# Yield a sentence's audio as the engine produces it, and cache the assembled clip once it is complete
+async def stream_speech(text, key):
+    logger.debug("Streaming speech: '%s'", text)
+    engine = get_tts_engine()
+    cancellation = Cancellation()
+    chunks = []
+    async for chunk in iterate_in_executor(iter(engine.stream(text, cancellation)), tts_pool.executor, cancellation):
+        chunks.append(chunk)
+        yield chunk
+    if chunks:
+        cache_speech(key, engine.assemble(chunks))
+
+# TTS pipeline: synthesizes the sentences of a response in parallel on the TTS pool, but sends their
+# audio strictly in sentence order. A sentence is sent either as one play_audio clip (cache hits,
+# TTS_STREAM_AUDIO off) or as play_audio_chunk messages forwarded as soon as the engine produces
+# them; both carry the sentence's sequence number, and chunks also carry their own chunk_seq.
+class TTSPipeline:
+    def __init__(self, session):
+        self.session = session
+        self.token = None
+        self.next_seq = 0   # sequence number for the next submitted sentence
+        self.emit_seq = 0   # sequence number of the sentence currently being sent
+        self.sentences = {} # seq -> audio produced so far for sentences not completely sent
+        self.tasks = {}     # seq -> Task still synthesizing
+        self.final_seq = None  # number of sentences in the response, once it is complete
+        self.wire_bytes = 0
+        self.encode_time = 0.0
+
+    def submit(self, token, sentence):
+        if token != self.token:
+            self._reset(token)
+        seq = self.next_seq
+        self.next_seq += 1
+        self.sentences[seq] = {'audio': [], 'chunks_sent': 0, 'done': False, 'error': None}
+        self.tasks[seq] = answer_loop.create_task(self._synthesize(token, seq, sentence))
+
+    # Mark the response complete so its audio totals are reported once the last sentence is sent
+    def finish(self, token):
+        if token == self.token:
+            self.final_seq = self.next_seq
+            self._report()
+
+    # Number of sentences submitted but not yet sent to the client
+    def pending(self):
+        return self.next_seq - self.emit_seq
+
+    # Drop queued and in-flight work; returns how many sentences were dropped
+    def cancel(self):
+        dropped = self.next_seq - self.emit_seq
+        self._reset(None)
+        return dropped
+
+    def _reset(self, token):
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+        self.sentences.clear()
+        self.token = token
+        self.next_seq = 0
+        self.emit_seq = 0
+        self.final_seq = None
+        self.wire_bytes = 0
+        self.encode_time = 0.0
+
+    async def _synthesize(self, token, seq, sentence):
+        error = None
         try:
-            print("Waiting for sentence in TTS queue...")
-            token, text = tts_queue.get()
-            print(f"Got sentence from queue (token {token}): '{text}'")
-            
-            if token != current_token:
-                print(f"Skipping TTS for outdated token {token} (current token is {current_token})")
-                tts_queue.task_done()
-                continue
-                
-            text_to_speech(text)
-            tts_queue.task_done()
+            async with tts_pool.slot(self.session):
+                with stage_metrics.span('tts_synthesis', self.session, token):
+                    if TTS_STREAM_AUDIO:
+                        await self._stream(token, seq, sentence)
+                    else:
+                        await self._clip(token, seq, sentence)
+        except Busy as e:
+            # Skip this sentence's audio but keep the rest of the answer in order
+            logger.warning("Dropped TTS for sentence %d: %s", seq, e)
+            self.session.emit('busy', {'kind': 'tts', 'message': 'Speech is busy right now, some audio was skipped.'})
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            print(f"Error in TTS worker: {str(e)}")
-            try:
-                tts_queue.task_done()
-            except:
-                pass
+            logger.error("TTS Error: %s", e)
+            error = str(e)
+        self._complete(token, seq, error)
+
+    async def _clip(self, token, seq, sentence):
+        if not is_speakable(sentence):
+            return
+        call = tts_flights.join(('clip', speech_cache_key(sentence)), lambda info: synthesize_clip(sentence))
+        async with contextlib.aclosing(call.replay()) as clips:
+            async for clip in clips:
+                self._add(token, seq, 'clip', clip)
+
+    async def _stream(self, token, seq, sentence):
+        if not is_speakable(sentence):
+            return
+        key = speech_cache_key(sentence)
+        cached = await get_cached_speech(key)
+        if cached is not None:
+            self._add(token, seq, 'clip', cached)
+            return
+
+        call = tts_flights.join(('stream', key), lambda info: stream_speech(sentence, key))
+        first = True
+        start = time.perf_counter()
+        async with contextlib.aclosing(call.replay()) as chunks:
+            async for chunk in chunks:
+                if first:
+                    stage_metrics.observe('tts_first_chunk', time.perf_counter() - start, self.session, token)
+                    first = False
+                self._add(token, seq, 'chunk', chunk)
+
+    # The session token moves on (and stop_audio goes out) before the pipeline is reset on answer_loop,
+    # so audio is checked against the session as well as the pipeline
+    def _add(self, token, seq, kind, audio):
+        if token != self.token or not self.session.is_current(token) or not audio:
+            return
+        self.sentences[seq]['audio'].append((kind, audio))
+        self._flush()
+
+    def _complete(self, token, seq, error):
+        if token != self.token:
+            return
+        self.tasks.pop(seq, None)
+        self.sentences[seq]['done'] = True
+        self.sentences[seq]['error'] = error
+        self._flush()
+
+    # Send everything that is now in order: the current sentence's audio so far, and any
+    # following sentences that are already complete
+    def _flush(self):
+        if not self.session.is_current(self.token):
+            return
+        while self.emit_seq in self.sentences:
+            entry = self.sentences[self.emit_seq]
+            for kind, audio in entry['audio']:
+                if kind == 'clip':
+                    self._send('play_audio', audio, mime=get_tts_engine().mime, seq=self.emit_seq, token=self.token)
+                else:
+                    self._send('play_audio_chunk', audio, seq=self.emit_seq, chunk_seq=entry['chunks_sent'],
+                               token=self.token, **get_tts_engine().stream_format)
+                    entry['chunks_sent'] += 1
+            entry['audio'].clear()
+            if not entry['done']:
+                break
+            if entry['error']:
+                self.session.emit('error_message', {'message': f"Error generating speech: {entry['error']}"})
+            del self.sentences[self.emit_seq]
+            self.emit_seq += 1
+        self._report()
+
+    def _send(self, event, audio, **fields):
+        payload, size, encode_time = self.session.audio_payload(audio, **fields)
+        stage_metrics.observe('encode', encode_time, self.session, self.token)
+        with stage_metrics.span('emit', self.session, self.token):
+            self.session.emit(event, payload)
+        self.wire_bytes += size
+        self.encode_time += encode_time
+
+    def _report(self):
+        if self.final_seq is not None and self.emit_seq == self.final_seq:
+            mode = 'binary' if self.session.binary_audio else 'base64'
+            logger.info("Audio for token %s (%s): %d sentences, %d bytes on the wire, %.2f ms encoding",
+                        self.token, mode, self.final_seq, self.wire_bytes, self.encode_time * 1000)
+            self.final_seq = None
+
+# Client assets: files under static/ are served at /assets/<name>.<hash>.<ext> and cached for a year,
+# since a changed file gets a new URL. The page is rendered once and revalidated through its ETag.
+# Text assets are compressed once, with gzip and (if the brotli package is installed) Brotli.
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+ASSET_COMPRESS_MIN_BYTES = 512
 
-# Start TTS worker thread
-print("Starting TTS worker thread")
-tts_thread = threading.Thread(target=tts_worker)
-tts_thread.daemon = True
-tts_thread.start()
+class Asset:
+    def __init__(self, body, content_type, cache_control):
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+        self.variants = {'identity': body}
+        if len(body) >= ASSET_COMPRESS_MIN_BYTES and self.compressible(content_type):
+            self.variants['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.variants['br'] = brotli.compress(body, quality=11)
+
+    @staticmethod
+    def compressible(mimetype):
+        return mimetype.startswith('text/') or mimetype.split(';')[0] in ('application/javascript', 'application/json', 'image/svg+xml')
+
+    # Pick the smallest variant the client accepts; each encoding has its own ETag
+    def response(self):
+        encoding = min((name for name in self.variants if name == 'identity' or request.accept_encodings[name]),
+                       key=lambda name: len(self.variants[name]))
+        etag = self.etag if encoding == 'identity' else f"{self.etag}-{encoding}"
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            # content_type already carries the charset; mimetype= would make Werkzeug add a second one
+            response = Response(self.variants[encoding], content_type=self.content_type)
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = self.cache_control
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+_assets = None
+_assets_lock = threading.Lock()
+
+# Hash and compress everything under static/ and render the page against the hashed URLs, once
+def get_assets():
+    global _assets
+    with _assets_lock:
+        if _assets is None:
+            assets = {}
+            urls = {}
+            for root, _, files in os.walk(STATIC_DIR):
+                for filename in files:
+                    path = os.path.join(root, filename)
+                    name = os.path.relpath(path, STATIC_DIR).replace(os.sep, '/')
+                    with open(path, 'rb') as f:
+                        body = f.read()
+                    stem, ext = os.path.splitext(name)
+                    urls[name] = f"/assets/{stem}.{hashlib.sha256(body).hexdigest()[:12]}{ext}"
+                    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+                    if Asset.compressible(content_type):
+                        content_type += '; charset=utf-8'
+                    assets[urls[name]] = Asset(body, content_type, f"public, max-age={ASSET_MAX_AGE}, immutable")
+            with app.app_context():
+                page = render_template('index.html', asset_url=urls.__getitem__)
+            assets['/'] = Asset(page.encode('utf-8'), 'text/html; charset=utf-8', 'no-cache')
+            logger.info("Built %d client assets", len(assets))
+            _assets = assets
+        return _assets
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return get_assets()['/'].response()
+
+@app.route('/assets/<path:name>')
+def asset(name):
+    asset = get_assets().get(f"/assets/{name}")
+    if asset is None:
+        return Response("Not found", status=404, mimetype='text/plain')
+    return asset.response()
 
 @app.route('/test_tts')
 def test_tts():
-    print("Testing TTS functionality")
+    logger.info("Testing TTS functionality")
     text_to_speech("This is a test of the text to speech system.")
     return "Testing TTS functionality. Check console for logs."
 
-@app.route('/test_mic')
-def test_mic():
-    print("Testing microphone setup")
+@app.route('/tts_cache')
+def tts_cache_stats():
+    return jsonify(tts_cache.snapshot())
+
+@app.route('/response_cache')
+def response_cache_stats():
+    return jsonify(response_cache.snapshot())
+
+@app.route('/metrics')
+def metrics():
+    return Response(stage_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/pools')
+def pool_stats():
+    return jsonify({pool.name: pool.snapshot() for pool in (llm_pool, tts_pool, stt_pool)})
+
+@app.route('/flights')
+def flight_stats():
+    return jsonify({flights.name: flights.snapshot() for flights in (llm_flights, tts_flights)})
+
+@app.route('/speculation')
+def speculation_report():
+    completed = speculation_stats['hits'] + speculation_stats['misses']
+    return jsonify(dict(speculation_stats,
+                        hit_rate=speculation_stats['hits'] / completed if completed else None,
+                        mean_saved_seconds=speculation_stats['saved_seconds'] / speculation_stats['hits'] if speculation_stats['hits'] else None))
+
+# Start workers copies of this app on consecutive ports, sharing a Socket.IO message queue and a session
+# store (sqlite files in a private directory made for this run, unless given), and stop them all when one
+# exits or on Ctrl+C.
+# Put a load balancer with sticky sessions (e.g. nginx ip_hash) in front of the ports.
+# Workers are served by gunicorn's threaded worker when it is installed (pip install gunicorn), with a thread
+# for each of up to WORKER_THREADS sockets, and a control socket of its own where gunicorn has one. Without
+# it they fall back to the Werkzeug development server, which Flask-SocketIO refuses to start unless run
+# from a terminal.
+WORKER_THREADS = 500
+
+def worker_command(args, port, state_dir):
+    if gunicorn is None:
+        return [sys.executable, os.path.abspath(__file__), '--host', args.host, '--port', str(port), '--no-debug']
+    command = [sys.executable, '-m', 'gunicorn', '--bind', f"{args.host}:{port}", '--worker-class', 'gthread',
+               '--workers', '1', '--threads', str(WORKER_THREADS), '--chdir', os.path.dirname(os.path.abspath(__file__))]
+    if hasattr(gunicorn.config, 'ControlSocket'):
+        command += ['--control-socket', os.path.join(state_dir, f"gunicorn-{port}.ctl")]
+    return command + [f"{os.path.splitext(os.path.basename(__file__))[0]}:app"]
+
+def run_workers(args):
+    state_dir = tempfile.mkdtemp(prefix='medical-assistant-')
+    env = dict(os.environ,
+               SOCKETIO_MESSAGE_QUEUE=args.message_queue or SOCKETIO_MESSAGE_QUEUE
+               or f"sqlite:///{os.path.join(state_dir, 'medical-assistant-queue.db')}",
+               SESSION_STORE_URL=args.session_store or SESSION_STORE_URL
+               or f"sqlite:///{os.path.join(state_dir, 'medical-assistant-sessions.db')}")
+    logger.info("Message queue: %s, session store: %s", env['SOCKETIO_MESSAGE_QUEUE'], env['SESSION_STORE_URL'])
+    if gunicorn is None:
+        logger.warning("gunicorn is not installed, workers use the Werkzeug development server")
+    workers = []
+    for i in range(args.workers):
+        port = args.port + i
+        workers.append(subprocess.Popen(worker_command(args, port, state_dir), env=env))
+        logger.info("Worker %d (pid %d) on http://%s:%d", i, workers[-1].pid, args.host, port)
+    status = 0
     try:
-        mic_list = sr.Microphone.list_microphone_names()
-        return jsonify({
-            'status': 'success',
-            'microphones': mic_list,
-            'count': len(mic_list)
-        })
-    except Exception as e:
-        import traceback
-        error_trace = traceback.format_exc()
-        return jsonify({
-            'status': 'error',
-            'message': str(e),
-            'traceback': error_trace
-        })
+        while all(worker.poll() is None for worker in workers):
+            time.sleep(0.5)
+        logger.error("A worker exited, stopping the others")
+        status = 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+        for worker in workers:
+            worker.wait()
+        shutil.rmtree(state_dir, ignore_errors=True)
+    return status
 
 @socketio.on('send_message')
 def handle_message(data):
-    global current_token, tts_queue
+    session = get_session(request.sid)
     user_input = data['message'].strip()
     if not user_input:
         return
     
-    print(f"Received new message: '{user_input}'")
-    
-    # Cancel previous processing
-    current_token += 1
-    print(f"Cancelling previous processing, new token: {current_token}")
-    
-    with tts_queue.mutex:
-        queue_size = len(tts_queue.queue)
-        tts_queue.queue.clear()
-        print(f"Cleared TTS queue ({queue_size} items removed)")
+    logger.info("Received new message from %s: '%s'", session.sid, user_input)
     
-    # Notify client to stop audio immediately
-    socketio.emit('stop_audio')
-    print("Sent stop_audio signal to client")
-    
-    # Start new processing thread
-    print(f"Starting new processing thread for token {current_token}")
-    thread = threading.Thread(target=stream_response, args=(user_input, current_token))
-    thread.daemon = True
-    thread.start()
+    # Cancel previous processing and start the new answer
+    session.start_answer(user_input)
+
+# Stop the current answer without asking anything new. Only the client connected with the session id can
+# send it; the shared token lets whichever worker is streaming the answer see the cancel.
+@socketio.on('stop_answer')
+def handle_stop_answer():
+    session = get_session(request.sid)
+    logger.info("Stopping answer for %s", session.sid)
+    session.cancel()
 
 @socketio.on('start_voice_input')
-def handle_voice_input():
-    print("Starting voice input")
-    thread = threading.Thread(target=recognize_speech)
-    thread.daemon = True
-    thread.start()
+def handle_voice_input(data=None):
+    logger.debug("Starting voice input for %s", request.sid)
+    sample_rate = int((data or {}).get('sample_rate', STT_SAMPLE_RATE))
+    get_session(request.sid).start_listening(sample_rate)
+
+@socketio.on('audio_chunk')
+def handle_audio_chunk(chunk):
+    if isinstance(chunk, (bytes, bytearray)):
+        get_session(request.sid).feed_audio(bytes(chunk))
+
+@socketio.on('end_voice_input')
+def handle_end_voice_input():
+    get_session(request.sid).feed_audio(None)
+
+@socketio.on('client_capabilities')
+def handle_client_capabilities(data):
+    session = get_session(request.sid)
+    session.binary_audio = bool(data.get('binary_audio'))
+    logger.info("Client %s audio transport: %s", session.sid, 'binary' if session.binary_audio else 'base64')
+
+@socketio.on('playback_status')
+def handle_playback_status(data):
+    get_session(request.sid).set_client_queue_depth(int(data.get('queue_depth', 0)))
+
+# The client reports when the first audio of an answer is scheduled, and how far ahead of playing
+@socketio.on('playback_started')
+def handle_playback_started(data):
+    session = get_session(request.sid)
+    token, started = session.answer_started
+    if started is None or data.get('token') != token:
+        return
+    session.answer_started = (token, None)
+    starts_in = min(max(float(data.get('starts_in', 0)), 0.0), BACKPRESSURE_MAX_WAIT)
+    stage_metrics.observe('playback_start', time.perf_counter() - started + starts_in, session, token)
 
 @socketio.on('connect')
-def handle_connect():
-    print("Client connected")
+def handle_connect(auth=None):
+    # Each page picks its own session id so a reconnect, possibly to another worker, resumes the same session
+    key = (auth or {}).get('session_id') if isinstance(auth, dict) else None
+    if not isinstance(key, str) or not SESSION_ID_PATTERN.fullmatch(key):
+        key = request.sid
+    with sessions_lock:
+        session_keys[request.sid] = key
+    join_room(key)
+    session_store.attach(key, request.sid)
+    get_session(request.sid)
+    logger.info("Client connected: %s (session %s)", request.sid, key)
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    print("Client disconnected")
+    with sessions_lock:
+        key = session_keys.pop(request.sid, None)
+    if key is not None:
+        # Give the client a moment to reconnect before dropping its answer
+        timer = threading.Timer(SESSION_RECONNECT_GRACE, release_session, (key, request.sid))
+        timer.daemon = True
+        timer.start()
+    logger.info("Client disconnected: %s", request.sid)
 
 if __name__ == '__main__':
-    os.makedirs('templates', exist_ok=True)
-    
-    # Updated HTML template with improved audio handling and debugging
-    html_content = '''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Medical Assistant</title>
-    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/css/bootstrap.min.css" rel="stylesheet">
-    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css">
-    <style>
-        body { background-color: #f8f9fa; font-family: 'Arial', sans-serif; }
-        .chat-container { max-width: 800px; margin: 0 auto; padding: 20px; background-color: white; border-radius: 15px; box-shadow: 0 0 20px rgba(0, 0, 0, 0.1); display: flex; flex-direction: column; height: 85vh; }
-        .chat-header { background: linear-gradient(135deg, #43a047, #2e7d32); color: white; padding: 15px; border-radius: 10px 10px 0 0; font-size: 1.5rem; text-align: center; margin-bottom: 15px; }
-        .chat-messages { flex-grow: 1; overflow-y: auto; padding: 10px; margin-bottom: 15px; border-radius: 10px; border: 1px solid #e0e0e0; }
-        .message { margin-bottom: 15px; padding: 10px 15px; border-radius: 10px; max-width: 75%; word-wrap: break-word; }
-        .user-message { background-color: #e3f2fd; color: #0d47a1; margin-left: auto; border-bottom-right-radius: 0; }
-        .bot-message { background-color: #e8f5e9; color: #1b5e20; margin-right: auto; border-bottom-left-radius: 0; }
-        .system-message { background-color: #f5f5f5; color: #757575; text-align: center; margin: 10px auto; font-style: italic; max-width: 50%; }
-        .thinking { display: flex; align-items: center; margin-bottom: 15px; }
-        .thinking-dots { display: flex; margin-left: 10px; }
-        .thinking-dot { height: 10px; width: 10px; margin: 0 3px; background-color: #1b5e20; border-radius: 50%; animation: pulse 1.5s infinite; }
-        .thinking-dot:nth-child(2) { animation-delay: 0.2s; }
-        .thinking-dot:nth-child(3) { animation-delay: 0.4s; }
-        .input-container { display: flex; margin-top: 10px; }
-        .message-input { flex-grow: 1; padding: 12px; border: 1px solid #ccc; border-radius: 25px; font-size: 1rem; outline: none; transition: border 0.3s; }
-        .message-input:focus { border-color: #43a047; }
-        .send-button, .voice-button { padding: 10px 15px; margin-left: 10px; border: none; border-radius: 25px; cursor: pointer; outline: none; transition: background-color 0.3s; }
-        .send-button { background-color: #43a047; color: white; }
-        .voice-button { background-color: #2196f3; color: white; }
-        .send-button:hover { background-color: #2e7d32; }
-        .voice-button:hover { background-color: #1976d2; }
-        .voice-button.listening { animation: pulse 1.5s infinite; background-color: #f44336; }
-        @keyframes pulse { 0% { transform: scale(1); opacity: 1; } 50% { transform: scale(1.1); opacity: 0.7; } 100% { transform: scale(1); opacity: 1; } }
-        .status-bar { margin-top: 15px; padding: 5px 10px; background-color: #f5f5f5; border-radius: 5px; font-size: 0.85rem; color: #757575; }
-        @media (max-width: 576px) { .chat-container { height: 95vh; border-radius: 0; box-shadow: none; } .message { max-width: 85%; } }
-        .debug-panel { padding: 10px; background-color: #f0f0f0; border-radius: 5px; margin-top: 10px; font-family: monospace; font-size: 0.8rem; max-height: 100px; overflow-y: auto; display: none; }
-        .mic-status { background-color: #f5f5f5; padding: 10px; margin-top: 10px; border-radius: 5px; }
-    </style>
-</head>
-<body>
-    <div class="container mt-4">
-        <div class="chat-container">
-            <div class="chat-header">
-                <i class="fas fa-notes-medical me-2"></i> Medical Assistant
-            </div>
-            <div class="chat-messages" id="chatMessages">
-                <div class="message bot-message">
-                    Hello! I'm your medical assistant. How can I help you today?
-                </div>
-            </div>
-            <div class="input-container">
-                <input type="text" class="message-input" id="messageInput" placeholder="Type your message here...">
-                <button class="send-button" id="sendButton">
-                    <i class="fas fa-paper-plane"></i>
-                </button>
-                <button class="voice-button" id="voiceButton">
-                    <i class="fas fa-microphone"></i>
-                </button>
-            </div>
-            <div class="status-bar" id="statusBar">Ready</div>
-            <div class="debug-panel" id="debugPanel"></div>
-            <div class="mic-status" id="micStatus" style="display: none;"></div>
-        </div>
-    </div>
-    <script src="https://cdn.socket.io/4.4.1/socket.io.min.js"></script>
-    <script>
-        document.addEventListener('DOMContentLoaded', function() {
-            const socket = io();
-            const chatMessages = document.getElementById('chatMessages');
-            const messageInput = document.getElementById('messageInput');
-            const sendButton = document.getElementById('sendButton');
-            const voiceButton = document.getElementById('voiceButton');
-            const statusBar = document.getElementById('statusBar');
-            const debugPanel = document.getElementById('debugPanel');
-            const micStatus = document.getElementById('micStatus');
-            
-            // Uncomment to enable debug panel
-            // debugPanel.style.display = 'block';
-            
-            let isThinking = false;
-            let isListening = false;
-            let currentBotMessage = null;
-            let currentThinking = null;
-            let audioQueue = [];
-            let isPlayingAudio = false;
-            let currentAudio = null;
-            let audioContext = null;
-            
-            // Debug log function
-            function debugLog(message) {
-                console.log(message);
-                const timestamp = new Date().toISOString().substr(11, 8);
-                debugPanel.innerHTML += `<div>[${timestamp}] ${message}</div>`;
-                debugPanel.scrollTop = debugPanel.scrollHeight;
-            }
-            
-            // Initialize audio context with user interaction
-            function initAudioContext() {
-                if (!audioContext) {
-                    try {
-                        audioContext = new (window.AudioContext || window.webkitAudioContext)();
-                        debugLog("Audio context initialized");
-                    } catch (e) {
-                        debugLog("Error initializing audio context: " + e);
-                    }
-                }
-            }
-            
-            // Check microphone availability
-            async function checkMicrophone() {
-                try {
-                    // Check if microphone is available
-                    const devices = await navigator.mediaDevices.enumerateDevices();
-                    const hasMic = devices.some(device => device.kind === 'audioinput');
-                    
-                    if (!hasMic) {
-                        debugLog("No microphone detected!");
-                        micStatus.textContent = "❌ No microphone detected. Voice input will not work.";
-                        micStatus.style.display = "block";
-                        micStatus.style.color = "#f44336";
-                        voiceButton.disabled = true;
-                        voiceButton.title = "No microphone available";
-                        return false;
-                    }
-                    
-                    // Check if we have permission
-                    try {
-                        const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
-                        stream.getTracks().forEach(track => track.stop());
-                        micStatus.textContent = "✅ Microphone available and permission granted.";
-                        micStatus.style.color = "#4CAF50";
-                        debugLog("Microphone permission granted");
-                        return true;
-                    } catch (err) {
-                        debugLog("Microphone permission denied: " + err);
-                        micStatus.textContent = "⚠️ Microphone permission denied. Voice input will not work.";
-                        micStatus.style.color = "#FF9800";
-                        voiceButton.title = "Microphone permission required";
-                        return false;
-                    }
-                } catch (err) {
-                    debugLog("Error checking microphone: " + err);
-                    micStatus.textContent = "⚠️ Cannot check microphone status. Voice input may not work.";
-                    micStatus.style.color = "#FF9800";
-                    return false;
-                } finally {
-                    micStatus.style.display = "block";
-                }
-            }
-            
-            // Test server-side microphone detection
-            function testServerMicrophone() {
-                fetch('/test_mic')
-                    .then(response => response.json())
-                    .then(data => {
-                        if (data.status === 'success') {
-                            debugLog(`Server detected ${data.count} microphones: ${data.microphones.join(', ')}`);
-                            micStatus.innerHTML += `<br>Server-side: ${data.count} microphone(s) detected.`;
-                        } else {
-                            debugLog(`Server-side microphone error: ${data.message}`);
-                            micStatus.innerHTML += `<br>Server-side error: ${data.message}`;
-                        }
-                    })
-                    .catch(error => {
-                        debugLog("Error testing server microphone: " + error);
-                    });
-            }
-            
-            function sendMessage() {
-                const message = messageInput.value.trim();
-                if (message && !isThinking && !isListening) {
-                    initAudioContext(); // Initialize audio context with user interaction
-                    
-                    const userMessageElement = document.createElement('div');
-                    userMessageElement.className = 'message user-message';
-                    userMessageElement.textContent = message;
-                    chatMessages.appendChild(userMessageElement);
-                    messageInput.value = '';
-                    chatMessages.scrollTop = chatMessages.scrollHeight;
-                    
-                    debugLog("Sending message: " + message);
-                    socket.emit('send_message', { message: message });
-                }
-            }
-            
-            function showThinking() {
-                const thinkingElement = document.createElement('div');
-                thinkingElement.className = 'thinking';
-                thinkingElement.innerHTML = `
-                    <div class="message bot-message" style="margin-bottom: 0; padding-right: 20px;">
-                        <div class="thinking-dots">
-                            <div class="thinking-dot"></div>
-                            <div class="thinking-dot"></div>
-                            <div class="thinking-dot"></div>
-                        </div>
-                    </div>
-                `;
-                chatMessages.appendChild(thinkingElement);
-                chatMessages.scrollTop = chatMessages.scrollHeight;
-                return thinkingElement;
-            }
-            
-            // Run microphone checks on startup
-            checkMicrophone().then(micAvailable => {
-                if (micAvailable) {
-                    testServerMicrophone();
-                }
-            });
-            
-            sendButton.addEventListener('click', sendMessage);
-            
-            messageInput.addEventListener('keypress', function(e) {
-                if (e.key === 'Enter') {
-                    sendMessage();
-                }
-            });
-            
-            voiceButton.addEventListener('click', function() {
-                if (!isListening && !isThinking) {
-                    initAudioContext(); // Initialize audio context with user interaction
-                    
-                    // Check microphone permission again when button is clicked
-                    navigator.mediaDevices.getUserMedia({ audio: true })
-                        .then(stream => {
-                            stream.getTracks().forEach(track => track.stop());
-                            debugLog("Starting voice input");
-                            socket.emit('start_voice_input');
-                        })
-                        .catch(err => {
-                            debugLog("Microphone permission denied when activating: " + err);
-                            const errorElement = document.createElement('div');
-                            errorElement.className = 'message system-message';
-                            errorElement.textContent = 'Microphone access denied. Please allow microphone access in your browser settings.';
-                            chatMessages.appendChild(errorElement);
-                            chatMessages.scrollTop = chatMessages.scrollHeight;
-                        });
-                }
-            });
-            
-            socket.on('connect', function() {
-                debugLog("Connected to server");
-            });
-            
-            socket.on('disconnect', function() {
-                debugLog("Disconnected from server");
-            });
-            
-            socket.on('thinking_status', function(data) {
-                isThinking = data.status;
-                debugLog("Thinking status: " + data.status);
-                if (isThinking) {
-                    statusBar.textContent = 'Thinking...';
-                    currentThinking = showThinking();
-                } else {
-                    statusBar.textContent = 'Ready';
-                }
-            });
-            
-            socket.on('listening_status', function(data) {
-                isListening = data.status;
-                debugLog("Listening status: " + data.status);
-                if (isListening) {
-                    voiceButton.classList.add('listening');
-                    const listeningElement = document.createElement('div');
-                    listeningElement.className = 'message system-message';
-                    listeningElement.id = 'listeningMessage';
-                    listeningElement.textContent = 'Listening...';
-                    chatMessages.appendChild(listeningElement);
-                    chatMessages.scrollTop = chatMessages.scrollHeight;
-                    statusBar.textContent = 'Listening...';
-                } else {
-                    voiceButton.classList.remove('listening');
-                    const listeningElement = document.getElementById('listeningMessage');
-                    if (listeningElement) { listeningElement.remove(); }
-                    statusBar.textContent = 'Ready';
-                }
-            });
-            
-            socket.on('speech_recognized', function(data) {
-                debugLog("Speech recognized: " + data.text);
-                const userMessageElement = document.createElement('div');
-                userMessageElement.className = 'message user-message';
-                userMessageElement.textContent = data.text;
-                chatMessages.appendChild(userMessageElement);
-                messageInput.value = data.text;
-                chatMessages.scrollTop = chatMessages.scrollHeight;
-            });
-            
-            socket.on('response_stream', function(data) {
-                debugLog("Response stream: " + (data.is_final ? "final" : "partial"));
-                if (currentThinking) {
-                    currentThinking.remove();
-                    currentThinking = null;
-                }
-                if (!currentBotMessage) {
-                    currentBotMessage = document.createElement('div');
-                    currentBotMessage.className = 'message bot-message';
-                    chatMessages.appendChild(currentBotMessage);
-                }
-                currentBotMessage.textContent = data.text;
-                chatMessages.scrollTop = chatMessages.scrollHeight;
-                if (data.is_final) { 
-                    debugLog("Response complete");
-                    currentBotMessage = null; 
-                }
-            });
-            
-            socket.on('error_message', function(data) {
-                debugLog("Error: " + data.message);
-                const errorElement = document.createElement('div');
-                errorElement.className = 'message system-message';
-                errorElement.textContent = data.message;
-                chatMessages.appendChild(errorElement);
-                chatMessages.scrollTop = chatMessages.scrollHeight;
-                statusBar.textContent = 'Ready';
-            });
-            
-            // Audio playback handling with improved logging
-            socket.on('play_audio', function(data) {
-                debugLog("Received audio data: " + data.audio_data.substring(0, 20) + "... (" + data.audio_data.length + " chars)");
-                
-                const audioSrc = 'data:audio/mp3;base64,' + data.audio_data;
-                audioQueue.push(audioSrc);
-                
-                debugLog("Added to audio queue. Queue length: " + audioQueue.length);
-                
-                if (!isPlayingAudio) {
-                    playNextInQueue();
-                }
-            });
-            
-            // Stop audio event handler: clears the queue and stops current playback
-            socket.on('stop_audio', function() {
-                debugLog("Received stop_audio signal");
-                const queueLength = audioQueue.length;
-                audioQueue = [];
-                
-                if (currentAudio) {
-                    debugLog("Stopping current audio playback");
-                    currentAudio.pause();
-                    currentAudio.currentTime = 0;
-                    currentAudio = null;
-                }
-                
-                debugLog(`Audio stopped, cleared queue (${queueLength} items)`);
-                isPlayingAudio = false;
-            });
-            
-            function playNextInQueue() {
-                if (audioQueue.length === 0) {
-                    debugLog("Audio queue empty, playback complete");
-                    isPlayingAudio = false;
-                    return;
-                }
-                
-                isPlayingAudio = true;
-                const nextAudioSrc = audioQueue.shift();
-                
-                debugLog("Playing next audio in queue, remaining: " + audioQueue.length);
-                
-                try {
-                    currentAudio = new Audio(nextAudioSrc);
-                    
-                    currentAudio.oncanplaythrough = function() {
-                        debugLog("Audio ready to play");
-                        try {
-                            const playPromise = currentAudio.play();
-                            if (playPromise !== undefined) {
-                                playPromise.catch(e => {
-                                    debugLog("Playback failed with promise error: " + e);
-                                    currentAudio = null;
-                                    setTimeout(playNextInQueue, 200);
-                                });
-                            }
-                        } catch (e) {
-                            debugLog("Play error: " + e);
-                            currentAudio = null;
-                            setTimeout(playNextInQueue, 200);
-                        }
-                    };
-                    
-                    currentAudio.onended = function() {
-                        debugLog("Audio playback completed");
-                        currentAudio = null;
-                        setTimeout(playNextInQueue, 200);
-                    };
-                    
-                    currentAudio.onerror = function(e) {
-                        debugLog("Audio playback error: " + e);
-                        currentAudio = null;
-                        setTimeout(playNextInQueue, 200);
-                    };
-                    
-                    currentAudio.volume = 1.0;
-                    
-                } catch (e) {
-                    debugLog("Audio creation error: " + e);
-                    currentAudio = null;
-                    setTimeout(playNextInQueue, 200);
-                }
-            }
-            
-            // Initialize UI
-            debugLog("Medical Assistant UI initialized");
-        });
-    </script>
-</body>
-</html>
-    '''
-    
-    with open('templates/index.html', 'w', encoding='utf-8') as f:
-        f.write(html_content)
+    parser = argparse.ArgumentParser(description="Medical Assistant Web App")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes, listening on consecutive ports from --port")
+    parser.add_argument('--message-queue', help="Socket.IO message queue URL shared by the workers")
+    parser.add_argument('--session-store', help="session store URL shared by the workers")
+    parser.add_argument('--debug', action=argparse.BooleanOptionalAction, default=True,
+                        help="run with the Flask debugger and reloader (single process only)")
+    args = parser.parse_args()
+    if args.workers > 1 or args.message_queue or args.session_store:
+        sys.exit(run_workers(args))
+
+    # Hash and compress the client assets before the first page view
+    get_assets()
+
+    # Warm the TTS cache in the background so startup is not delayed
+    warmup_thread = threading.Thread(target=warm_tts_cache)
+    warmup_thread.daemon = True
+    warmup_thread.start()
     
-    print("Starting Medical Assistant Web App...")
-    print("Open your browser and go to http://127.0.0.1:5000")
-    socketio.run(app, debug=True)
+    logger.info("Starting Medical Assistant Web App...")
+    logger.info("Open your browser and go to http://%s:%d", args.host, args.port)
+    # Assets are built once, so let the debug reloader restart on client changes too
+    client_files = [os.path.join(root, filename) for folder in (STATIC_DIR, os.path.join(app.root_path, app.template_folder))
+                    for root, _, files in os.walk(folder) for filename in files]
+    # Only the debug server may run on Werkzeug unattended; otherwise Flask-SocketIO insists on a terminal
+    socketio.run(app, host=args.host, port=args.port, debug=args.debug, allow_unsafe_werkzeug=args.debug,
+                 extra_files=client_files if args.debug else None)
@@ -0,0 +1,5 @@
+#!/bin/sh
+# Run 4 worker processes on ports 5000-5003, sharing a local sqlite message queue and session store.
+# Pass --message-queue redis://localhost:6379/0 --session-store redis://localhost:6379/0 to use Redis.
+# Install gunicorn (pip install gunicorn) to serve the workers with it instead of the development server.
+exec python "$(dirname "$0")/python.py" --workers 4 "$@"
@@ -0,0 +1,515 @@
+document.addEventListener('DOMContentLoaded', function() {
+    // One session id per page, kept across reconnects so the server can resume the session. It lives only
+    // in memory: sessionStorage would be copied into a duplicated tab, which would then share the session.
+    const sessionId = Array.from(crypto.getRandomValues(new Uint8Array(16)), b => b.toString(16).padStart(2, '0')).join('');
+    const socket = io({ auth: { session_id: sessionId } });
+    const chatMessages = document.getElementById('chatMessages');
+    const messageInput = document.getElementById('messageInput');
+    const sendButton = document.getElementById('sendButton');
+    const voiceButton = document.getElementById('voiceButton');
+    const statusBar = document.getElementById('statusBar');
+    const debugPanel = document.getElementById('debugPanel');
+    const micStatus = document.getElementById('micStatus');
+
+    // Uncomment to enable debug panel
+    // debugPanel.style.display = 'block';
+
+    let isThinking = false;
+    let isListening = false;
+    let currentBotMessage = null;
+    let currentMessageId = null;
+    let nextStreamSeq = 0;
+    let currentThinking = null;
+    let audioContext = null;
+
+    // Playback engine state: clips are decoded as soon as they arrive and scheduled
+    // back to back on the audio context timeline
+    let decodeChain = Promise.resolve();
+    let scheduledSources = [];
+    let nextStartTime = 0;
+    let playbackGeneration = 0;
+    let lastClipToken = null;
+    // Latest answer token announced by the server; audio for older tokens is dropped
+    let answerToken = 0;
+    let gapStats = { clips: 0, maxGapMs: 0, over20Ms: 0 };
+    let pendingDecodes = 0;
+    let reportedQueueDepth = 0;
+
+    // Debug log function
+    function debugLog(message) {
+        console.log(message);
+        const timestamp = new Date().toISOString().substr(11, 8);
+        debugPanel.innerHTML += `<div>[${timestamp}] ${message}</div>`;
+        debugPanel.scrollTop = debugPanel.scrollHeight;
+    }
+
+    // Initialize audio context with user interaction
+    function initAudioContext() {
+        if (!audioContext) {
+            try {
+                audioContext = new (window.AudioContext || window.webkitAudioContext)();
+                debugLog("Audio context initialized");
+            } catch (e) {
+                debugLog("Error initializing audio context: " + e);
+            }
+        }
+    }
+
+    // Check microphone availability
+    async function checkMicrophone() {
+        try {
+            // Check if microphone is available
+            const devices = await navigator.mediaDevices.enumerateDevices();
+            const hasMic = devices.some(device => device.kind === 'audioinput');
+
+            if (!hasMic) {
+                debugLog("No microphone detected!");
+                micStatus.textContent = "❌ No microphone detected. Voice input will not work.";
+                micStatus.style.display = "block";
+                micStatus.style.color = "#f44336";
+                voiceButton.disabled = true;
+                voiceButton.title = "No microphone available";
+                return false;
+            }
+
+            // Check if we have permission
+            try {
+                const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
+                stream.getTracks().forEach(track => track.stop());
+                micStatus.textContent = "✅ Microphone available and permission granted.";
+                micStatus.style.color = "#4CAF50";
+                debugLog("Microphone permission granted");
+                return true;
+            } catch (err) {
+                debugLog("Microphone permission denied: " + err);
+                micStatus.textContent = "⚠️ Microphone permission denied. Voice input will not work.";
+                micStatus.style.color = "#FF9800";
+                voiceButton.title = "Microphone permission required";
+                return false;
+            }
+        } catch (err) {
+            debugLog("Error checking microphone: " + err);
+            micStatus.textContent = "⚠️ Cannot check microphone status. Voice input may not work.";
+            micStatus.style.color = "#FF9800";
+            return false;
+        } finally {
+            micStatus.style.display = "block";
+        }
+    }
+
+    function sendMessage() {
+        const message = messageInput.value.trim();
+        if (message && !isThinking && !isListening) {
+            initAudioContext(); // Initialize audio context with user interaction
+
+            const userMessageElement = document.createElement('div');
+            userMessageElement.className = 'message user-message';
+            userMessageElement.textContent = message;
+            chatMessages.appendChild(userMessageElement);
+            messageInput.value = '';
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+
+            debugLog("Sending message: " + message);
+            socket.emit('send_message', { message: message });
+        }
+    }
+
+    function showThinking() {
+        const thinkingElement = document.createElement('div');
+        thinkingElement.className = 'thinking';
+        thinkingElement.innerHTML = `
+            <div class="message bot-message" style="margin-bottom: 0; padding-right: 20px;">
+                <div class="thinking-dots">
+                    <div class="thinking-dot"></div>
+                    <div class="thinking-dot"></div>
+                    <div class="thinking-dot"></div>
+                </div>
+            </div>
+        `;
+        chatMessages.appendChild(thinkingElement);
+        chatMessages.scrollTop = chatMessages.scrollHeight;
+        return thinkingElement;
+    }
+
+    // Run microphone checks on startup
+    checkMicrophone();
+
+    sendButton.addEventListener('click', sendMessage);
+
+    messageInput.addEventListener('keypress', function(e) {
+        if (e.key === 'Enter') {
+            sendMessage();
+        }
+    });
+
+    // Microphone capture: the browser records, converts to 16 kHz 16-bit mono PCM and
+    // streams chunks to the server, which recognizes them incrementally
+    const STT_SAMPLE_RATE = 16000;
+    let micStream = null;
+    let micSource = null;
+    let micProcessor = null;
+
+    function downsampleToInt16(input, inputRate, outputRate) {
+        const ratio = inputRate / outputRate;
+        const outputLength = Math.floor(input.length / ratio);
+        const output = new Int16Array(outputLength);
+        for (let i = 0; i < outputLength; i++) {
+            const start = Math.floor(i * ratio);
+            const end = Math.min(Math.floor((i + 1) * ratio), input.length);
+            let sum = 0;
+            for (let j = start; j < end; j++) {
+                sum += input[j];
+            }
+            const sample = Math.max(-1, Math.min(1, sum / Math.max(1, end - start)));
+            output[i] = sample * 0x7fff;
+        }
+        return output;
+    }
+
+    function startVoiceCapture(stream) {
+        micStream = stream;
+        micSource = audioContext.createMediaStreamSource(stream);
+        micProcessor = audioContext.createScriptProcessor(4096, 1, 1);
+        micProcessor.onaudioprocess = function(e) {
+            const pcm = downsampleToInt16(e.inputBuffer.getChannelData(0), audioContext.sampleRate, STT_SAMPLE_RATE);
+            socket.emit('audio_chunk', pcm.buffer);
+        };
+        micSource.connect(micProcessor);
+        // The processor only runs while connected to an output; it writes silence
+        micProcessor.connect(audioContext.destination);
+        socket.emit('start_voice_input', { sample_rate: STT_SAMPLE_RATE });
+    }
+
+    function stopVoiceCapture(notifyServer) {
+        if (!micStream) {
+            return;
+        }
+        micProcessor.onaudioprocess = null;
+        micSource.disconnect();
+        micProcessor.disconnect();
+        micStream.getTracks().forEach(track => track.stop());
+        micStream = null;
+        micSource = null;
+        micProcessor = null;
+        if (notifyServer) {
+            socket.emit('end_voice_input');
+        }
+        debugLog("Voice capture stopped");
+    }
+
+    voiceButton.addEventListener('click', function() {
+        if (micStream) {
+            // Second click ends the utterance early
+            stopVoiceCapture(true);
+            return;
+        }
+        if (!isListening && !isThinking) {
+            initAudioContext(); // Initialize audio context with user interaction
+            if (!audioContext) {
+                return;
+            }
+            if (audioContext.state === 'suspended') {
+                audioContext.resume();
+            }
+
+            navigator.mediaDevices.getUserMedia({ audio: { channelCount: 1, echoCancellation: true, noiseSuppression: true } })
+                .then(stream => {
+                    debugLog("Starting voice input");
+                    startVoiceCapture(stream);
+                })
+                .catch(err => {
+                    debugLog("Microphone permission denied when activating: " + err);
+                    const errorElement = document.createElement('div');
+                    errorElement.className = 'message system-message';
+                    errorElement.textContent = 'Microphone access denied. Please allow microphone access in your browser settings.';
+                    chatMessages.appendChild(errorElement);
+                    chatMessages.scrollTop = chatMessages.scrollHeight;
+                });
+        }
+    });
+
+    // Raw MP3 bytes can be decoded straight from binary attachments; otherwise fall back to base64
+    const supportsBinaryAudio = typeof ArrayBuffer !== 'undefined' && !!(window.AudioContext || window.webkitAudioContext);
+
+    socket.on('connect', function() {
+        debugLog("Connected to server");
+        socket.emit('client_capabilities', { binary_audio: supportsBinaryAudio });
+    });
+
+    socket.on('disconnect', function() {
+        debugLog("Disconnected from server");
+    });
+
+    socket.on('thinking_status', function(data) {
+        isThinking = data.status;
+        debugLog("Thinking status: " + data.status);
+        if (isThinking) {
+            statusBar.textContent = 'Thinking...';
+            currentThinking = showThinking();
+        } else {
+            statusBar.textContent = 'Ready';
+        }
+    });
+
+    socket.on('listening_status', function(data) {
+        isListening = data.status;
+        debugLog("Listening status: " + data.status);
+        if (isListening) {
+            voiceButton.classList.add('listening');
+            const listeningElement = document.createElement('div');
+            listeningElement.className = 'message system-message';
+            listeningElement.id = 'listeningMessage';
+            listeningElement.textContent = 'Listening...';
+            chatMessages.appendChild(listeningElement);
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+            statusBar.textContent = 'Listening...';
+        } else {
+            stopVoiceCapture(false);
+            voiceButton.classList.remove('listening');
+            const listeningElement = document.getElementById('listeningMessage');
+            if (listeningElement) { listeningElement.remove(); }
+            statusBar.textContent = 'Ready';
+        }
+    });
+
+    socket.on('partial_transcript', function(data) {
+        const listeningElement = document.getElementById('listeningMessage');
+        if (listeningElement) {
+            listeningElement.textContent = 'Listening... ' + data.text;
+            chatMessages.scrollTop = chatMessages.scrollHeight;
+        }
+    });
+
+    socket.on('speech_recognized', function(data) {
+        debugLog("Speech recognized: " + data.text);
+        const userMessageElement = document.createElement('div');
+        userMessageElement.className = 'message user-message';
+        userMessageElement.textContent = data.text;
+        chatMessages.appendChild(userMessageElement);
+        messageInput.value = data.text;
+        chatMessages.scrollTop = chatMessages.scrollHeight;
+    });
+
+    socket.on('response_stream', function(data) {
+        debugLog("Response stream: " + (data.is_final ? "final" : "partial"));
+        if (currentThinking) {
+            currentThinking.remove();
+            currentThinking = null;
+        }
+        if (!currentBotMessage || currentMessageId !== data.message_id) {
+            currentBotMessage = document.createElement('div');
+            currentBotMessage.className = 'message bot-message';
+            chatMessages.appendChild(currentBotMessage);
+            currentMessageId = data.message_id;
+            answerToken = Math.max(answerToken, data.message_id);
+            nextStreamSeq = 0;
+        }
+        if (data.seq !== nextStreamSeq) {
+            debugLog(`Response stream out of sequence: expected ${nextStreamSeq}, got ${data.seq}`);
+        }
+        nextStreamSeq = data.seq + 1;
+        if (data.delta) {
+            currentBotMessage.appendChild(document.createTextNode(data.delta));
+        }
+        chatMessages.scrollTop = chatMessages.scrollHeight;
+        if (data.is_final) { 
+            if (currentBotMessage.textContent !== data.text) {
+                debugLog("Response text out of sync, replacing with final text");
+                currentBotMessage.textContent = data.text;
+            }
+            debugLog("Response complete");
+            currentBotMessage = null; 
+            currentMessageId = null;
+        }
+    });
+
+    socket.on('busy', function(data) {
+        debugLog("Server busy (" + data.kind + ")");
+        if (currentThinking && data.kind !== 'tts') {
+            currentThinking.remove();
+            currentThinking = null;
+        }
+        const busyElement = document.createElement('div');
+        busyElement.className = 'message system-message';
+        busyElement.textContent = data.message;
+        chatMessages.appendChild(busyElement);
+        chatMessages.scrollTop = chatMessages.scrollHeight;
+    });
+
+    socket.on('error_message', function(data) {
+        debugLog("Error: " + data.message);
+        const errorElement = document.createElement('div');
+        errorElement.className = 'message system-message';
+        errorElement.textContent = data.message;
+        chatMessages.appendChild(errorElement);
+        chatMessages.scrollTop = chatMessages.scrollHeight;
+        statusBar.textContent = 'Ready';
+    });
+
+    // Report how many clips are waiting to play so the server can pace the text stream
+    function reportQueueDepth() {
+        // Streamed sentences arrive as many chunks, so count sentences rather than sources
+        const depth = pendingDecodes + new Set(scheduledSources.map(source => source.sentence)).size;
+        if (depth !== reportedQueueDepth) {
+            reportedQueueDepth = depth;
+            socket.emit('playback_status', { queue_depth: depth });
+        }
+    }
+
+    // Audio payloads arrive either as raw bytes (binary transport) or base64 text
+    function audioPayloadToArrayBuffer(data) {
+        if (data.audio) {
+            // decodeAudioData detaches its input, so hand it a copy
+            return data.audio.slice(0);
+        }
+        const binary = atob(data.audio_data);
+        const bytes = new Uint8Array(binary.length);
+        for (let i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        return bytes.buffer;
+    }
+
+    function decodeAudio(data) {
+        return new Promise((resolve, reject) => {
+            audioContext.decodeAudioData(audioPayloadToArrayBuffer(data), resolve, reject);
+        });
+    }
+
+    // Raw 16-bit PCM chunks go straight into an AudioBuffer, no decoding needed
+    function pcmToAudioBuffer(data) {
+        const samples = new Int16Array(audioPayloadToArrayBuffer(data));
+        const buffer = audioContext.createBuffer(1, Math.max(1, samples.length), data.sample_rate);
+        const channel = buffer.getChannelData(0);
+        for (let i = 0; i < samples.length; i++) {
+            channel[i] = samples[i] / 0x8000;
+        }
+        return buffer;
+    }
+
+    // Audio playback handling: whole clips per sentence, decoded ahead
+    socket.on('play_audio', function(data) {
+        if (!preparePlayback(data)) {
+            return;
+        }
+        const size = data.audio ? data.audio.byteLength + " bytes" : data.audio_data.length + " chars";
+        debugLog("Received audio #" + data.seq + " (" + size + ")");
+        enqueueAudio(decodeAudio(data), data.seq, data.token);
+    });
+
+    // Streamed audio: chunks of a sentence, played on the same timeline as they arrive
+    socket.on('play_audio_chunk', function(data) {
+        if (!preparePlayback(data)) {
+            return;
+        }
+        const label = data.seq + "." + data.chunk_seq;
+        if (data.chunk_seq === 0) {
+            debugLog("Receiving streamed audio #" + data.seq + " (" + data.format + ")");
+        }
+        const buffer = data.format === 'pcm_s16le' ? Promise.resolve(pcmToAudioBuffer(data)) : decodeAudio(data);
+        enqueueAudio(buffer, label, data.token);
+    });
+
+    function preparePlayback(data) {
+        if (data.token < answerToken) {
+            debugLog("Dropping audio #" + data.seq + " of cancelled answer " + data.token);
+            return false;
+        }
+        initAudioContext();
+        if (!audioContext) {
+            debugLog("No audio context, dropping audio #" + data.seq);
+            return false;
+        }
+        if (audioContext.state === 'suspended') {
+            audioContext.resume();
+        }
+        return true;
+    }
+
+    // Start decoding immediately; the chain only orders the scheduling step
+    function enqueueAudio(decoded, label, token) {
+        const generation = playbackGeneration;
+        pendingDecodes += 1;
+        reportQueueDepth();
+        decodeChain = decodeChain
+            .then(() => decoded)
+            .then(buffer => {
+                if (generation === playbackGeneration) {
+                    pendingDecodes -= 1;
+                    scheduleClip(buffer, label, token);
+                }
+            })
+            .catch(e => {
+                if (generation === playbackGeneration) {
+                    pendingDecodes -= 1;
+                }
+                debugLog("Audio decode error: " + e);
+            })
+            .then(reportQueueDepth);
+    }
+
+    function scheduleClip(buffer, seq, token) {
+        const now = audioContext.currentTime;
+        const startAt = Math.max(now, nextStartTime);
+
+        // Gap between the end of the previous clip of this answer and the start of this one
+        if (token === lastClipToken && nextStartTime > 0) {
+            const gapMs = (startAt - nextStartTime) * 1000;
+            gapStats.maxGapMs = Math.max(gapStats.maxGapMs, gapMs);
+            if (gapMs > 20) {
+                gapStats.over20Ms += 1;
+            }
+            debugLog(`Scheduled audio #${seq} in ${((startAt - now) * 1000).toFixed(0)} ms, gap ${gapMs.toFixed(1)} ms`);
+        } else {
+            gapStats = { clips: 0, maxGapMs: 0, over20Ms: 0 };
+            debugLog(`Scheduled audio #${seq} to start now`);
+            // First audio of this answer: lets the server time the whole path up to playback
+            socket.emit('playback_started', { token: token, starts_in: startAt - now });
+        }
+        lastClipToken = token;
+        gapStats.clips += 1;
+
+        const source = audioContext.createBufferSource();
+        source.buffer = buffer;
+        source.sentence = String(seq).split('.')[0];
+        source.connect(audioContext.destination);
+        source.onended = function() {
+            scheduledSources = scheduledSources.filter(s => s !== source);
+            reportQueueDepth();
+            if (scheduledSources.length === 0) {
+                debugLog(`Playback complete: ${gapStats.clips} clips, max gap ${gapStats.maxGapMs.toFixed(1)} ms, ${gapStats.over20Ms} gaps over 20 ms`);
+            }
+        };
+        source.start(startAt);
+        scheduledSources.push(source);
+        nextStartTime = startAt + buffer.duration;
+    }
+
+    // Stop audio event handler: drops pending decodes and stops everything scheduled
+    socket.on('stop_audio', function(data) {
+        debugLog("Received stop_audio signal");
+        if (data && data.token > answerToken) {
+            answerToken = data.token;
+        }
+        playbackGeneration += 1;
+        const clipCount = scheduledSources.length;
+        scheduledSources.forEach(source => {
+            source.onended = null;
+            try {
+                source.stop();
+            } catch (e) {
+                // Already stopped
+            }
+        });
+        scheduledSources = [];
+        pendingDecodes = 0;
+        nextStartTime = 0;
+        lastClipToken = null;
+        // The server resets its view of the queue when it sends stop_audio
+        reportedQueueDepth = 0;
+        debugLog(`Audio stopped, cleared ${clipCount} scheduled clips`);
+    });
+
+    // Initialize UI
+    debugLog("Medical Assistant UI initialized");
+});
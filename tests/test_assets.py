@@ -0,0 +1,26 @@
+import re
+
+import python
+
+def test_page_and_assets_have_a_single_charset():
+    client = python.app.test_client()
+    page = client.get('/')
+    assert page.status_code == 200
+    assert page.headers['Content-Type'] == 'text/html; charset=utf-8'
+
+    urls = re.findall(r'/assets/[^"\']+', page.get_data(as_text=True))
+    assert urls
+    for url in urls:
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.headers['Content-Type'].count('charset') <= 1, url
+
+def test_compressed_asset_keeps_content_type():
+    client = python.app.test_client()
+    page = client.get('/').get_data(as_text=True)
+    script = next(url for url in re.findall(r'/assets/[^"\']+', page) if url.endswith('.js') and 'vendor' not in url)
+    response = client.get(script, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Content-Type'] == 'text/javascript; charset=utf-8'
+    revalidated = client.get(script, headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+    assert revalidated.status_code == 304
@@ -0,0 +1,87 @@
+import json
+import os
+import subprocess
+import sys
+
+import python as app
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run_benchmark(tmp_path, *args):
+    output = tmp_path / 'results.json'
+    completed = subprocess.run([sys.executable, os.path.join(ROOT, 'benchmark.py'), '--output', str(output),
+                                '--llm-first-byte', '0.05', '--llm-token-delay', '0.005', '--tts-latency', '0.02',
+                                '--audio-quiet', '0.3', *args], cwd=ROOT, capture_output=True, text=True, timeout=300)
+    assert completed.returncode == 0, completed.stderr
+    return json.loads(output.read_text())['scenarios']
+
+def test_concurrent_sessions_only_receive_their_own_answers(tmp_path):
+    results = run_benchmark(tmp_path, '--scenario', 'text', '--scenario', 'voice', '--sessions', '4', '--messages', '2')
+    for scenario in ('text', 'voice'):
+        assert results[scenario]['completed'] == 8
+        assert results[scenario]['isolation_checked'] > 0
+        assert results[scenario]['isolation_violations'] == 0
+
+def test_segmenter_makes_fewer_and_fewer_short_tts_calls_than_sentence_splitting(tmp_path):
+    results = run_benchmark(tmp_path, '--scenario', 'segmenter')['segmenter']
+    baseline = results['sentence_split']
+    assert results['tts_calls'] < baseline['tts_calls']
+    assert results['chunks_under_min_duration'] < baseline['chunks_under_min_duration']
+    assert results['modeled_time_to_first_audio']['p50'] <= baseline['modeled_time_to_first_audio']['p50']
+
+def test_interrupted_answers_free_workers_and_abort_upstream(tmp_path):
+    token_delay, abort_deadline = 0.02, 0.05
+    results = run_benchmark(tmp_path, '--scenario', 'cancel', '--sessions', '2', '--messages', '3',
+                            '--llm-token-delay', str(token_delay), '--abort-deadline', str(abort_deadline),
+                            '--interrupt-after', '0.15')['cancel']
+    assert results['interruptions'] == 6
+    assert results['work_running_at_interrupt'] > 0 and results['upstream_running_at_interrupt'] > 0
+    assert results['over_abort_deadline'] == 0
+    assert results['upstream_aborted'] == results['upstream_running_at_interrupt']
+    # Once aborted, the upstream streams no more than the tokens due before the abort deadline
+    per_interrupt = abort_deadline / token_delay + 1
+    assert results['upstream_tokens_after_interrupt'] <= results['upstream_running_at_interrupt'] * per_interrupt
+    assert results['isolation_violations'] == 0
+
+def test_backpressure_streams_text_sooner_and_keeps_audio_in_sync(tmp_path):
+    results = run_benchmark(tmp_path, '--scenario', 'pacing', '--sessions', '2', '--messages', '2',
+                            '--playback-speed', '8', '--audio-quiet', '1')['pacing']
+    paced, fixed = results['backpressure'], results['fixed']
+    assert paced['completed'] == fixed['completed'] == 4
+    assert paced['time_to_final_text']['p50'] < fixed['time_to_final_text']['p50'] - 0.5
+    assert paced['time_to_playback_end']['p50'] < fixed['time_to_playback_end']['p50'] * 1.2
+    # Every sentence's audio arrives after its text and in order, and the text never runs further
+    # ahead of the speech than the backpressure limits allow
+    assert paced['audio_before_text'] == paced['sentences_without_audio'] == paced['audio_out_of_order'] == 0
+    assert paced['text_ahead_of_speech_sentences']['max'] <= app.MAX_CLIENT_AUDIO_QUEUE + app.MAX_TTS_PIPELINE_LAG + 1
+
+def test_backpressure_holds_text_back_to_the_configured_limits(tmp_path):
+    results = run_benchmark(tmp_path, '--scenario', 'pacing', '--sessions', '2', '--messages', '1',
+                            '--playback-speed', '4', '--audio-quiet', '1',
+                            '--max-client-audio-queue', '1', '--max-tts-pipeline-lag', '1')['pacing']
+    paced = results['backpressure']
+    assert paced['completed'] == 2
+    assert paced['audio_before_text'] == paced['sentences_without_audio'] == paced['audio_out_of_order'] == 0
+    assert paced['text_ahead_of_speech_sentences']['max'] <= 3
+
+def test_asyncio_core_starts_no_threads_per_message(tmp_path):
+    results = run_benchmark(tmp_path, '--scenario', 'scale', '--scale-sockets', '100', '--scale-ramp', '2',
+                            '--messages', '1')['scale']
+    core, baseline = results['asyncio'], results['thread_per_message']
+    for mode in (core, baseline):
+        assert mode['connected'] == 100 and mode['client_errors'] == 0
+        assert mode['completed'] + mode['busy'] == 100
+        assert mode['isolation_violations'] == 0
+    # The threading transport holds threads per socket; beyond those, only the fixed-size executors add threads
+    pools = app.LLM_WORKERS + app.TTS_WORKERS + app.STT_WORKERS
+    assert core['server_threads']['peak'] <= core['server_threads']['connected'] + pools + 8
+    assert baseline['server_threads']['peak'] > core['server_threads']['peak']
+
+def test_tts_pipeline_synthesizes_an_answer_in_about_one_round(tmp_path):
+    # Later arguments win, so the synthesis latency dwarfs the scheduling overhead
+    results = run_benchmark(tmp_path, '--scenario', 'tts_pipeline', '--tts-latency', '0.2',
+                            '--tts-pipeline-runs', '3')['tts_pipeline']
+    assert results['sentences'] == 6
+    assert app.TTS_PER_SESSION > app.MAX_TTS_PIPELINE_LAG
+    assert results['pipeline']['synthesis_rounds'] < 1.5
+    assert results['one_worker']['synthesis_rounds'] > 5
@@ -0,0 +1,52 @@
+import asyncio
+import threading
+
+import python
+
+class RecordingStore(python.MemorySessionStore):
+    shared = True
+
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+
+    def get_conversation(self, key):
+        self.threads.append(threading.current_thread())
+        return super().get_conversation(key)
+
+    def put_conversation(self, key, state):
+        self.threads.append(threading.current_thread())
+        super().put_conversation(key, state)
+
+def test_conversation_store_calls_run_off_the_event_loop(monkeypatch):
+    store = RecordingStore()
+    monkeypatch.setattr(python, 'session_store', store)
+    session = python.Session('conversation-1')
+    store.threads.clear()
+
+    async def answer():
+        await session.record_turn("I have a cold", "Rest and drink fluids.")
+        return await session.sync_conversation()
+
+    loop = asyncio.new_event_loop()
+    try:
+        conversation = loop.run_until_complete(answer())
+    finally:
+        loop.close()
+    assert len(store.threads) == 2
+    assert threading.current_thread() not in store.threads
+    assert store.get_conversation('conversation-1')['turns'] == [["I have a cold", "Rest and drink fluids."]]
+    assert conversation.version == 1
+
+def test_sync_keeps_a_newer_local_conversation(monkeypatch):
+    store = RecordingStore()
+    monkeypatch.setattr(python, 'session_store', store)
+    session = python.Session('conversation-2')
+    store.put_conversation('conversation-2', {'turns': [], 'notes': [], 'version': 0})
+    session.conversation.add_turn("I have a cold", "Rest and drink fluids.")
+    conversation = asyncio.run(session.sync_conversation())
+    assert conversation.version == 1
+
+    store.put_conversation('conversation-2', {'turns': [["a", "b"], ["c", "d"]], 'notes': [], 'version': 2})
+    conversation = asyncio.run(session.sync_conversation())
+    assert conversation.turns == [("a", "b"), ("c", "d")]
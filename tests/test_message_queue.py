@@ -0,0 +1,40 @@
+import os
+import pickle
+import threading
+import time
+
+import python
+
+class Exploit:
+    def __init__(self, path):
+        self.path = path
+
+    def __reduce__(self):
+        return (open, (self.path, 'w'))
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+def test_sqlite_queue_carries_json_and_never_unpickles(tmp_path):
+    url = f"sqlite:///{tmp_path / 'queue.db'}"
+    publisher = python.SqlitePubSubManager(url)
+    listener = python.SqlitePubSubManager(url)
+    handled = []
+    listener._handle_emit = handled.append
+    threading.Thread(target=listener._thread, daemon=True).start()
+    time.sleep(0.2)
+
+    # A row planted by another local user must not run code in the worker
+    marker = tmp_path / 'pwned'
+    publisher._connection().execute('INSERT INTO socketio_messages (channel, created, data) VALUES (?, ?, ?)',
+                                    (publisher.channel, time.time(), pickle.dumps({'method': 'emit', 'x': Exploit(str(marker))})))
+    message = {'method': 'emit', 'event': 'play_audio', 'data': [{'audio': 'U1RVQg=='}], 'binary': False,
+               'namespace': '/', 'room': 'session', 'skip_sid': None, 'callback': None, 'host_id': publisher.host_id}
+    publisher._publish(message)
+
+    wait_for(lambda: handled)
+    assert handled == [message]
+    assert not os.path.exists(marker)
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import threading
+from argparse import Namespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import benchmark
+import python
+
+# Raw UTF-8 events with no charset in the Content-Type, split so a multi-byte character straddles two writes
+EVENTS = [{'choices': [{'delta': {'content': "A fever of 38.5°C – "}}]},
+          {'choices': [{'delta': {'content': "drink fluids, 休息."}}]}]
+
+class SSEHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = b''.join(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8') for event in EVENTS)
+        body += b'data: [DONE]\n\n'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        middle = body.index('°'.encode('utf-8')) + 1
+        self.wfile.write(body[:middle])
+        self.wfile.flush()
+        self.wfile.write(body[middle:])
+
+@pytest.fixture
+def sse_endpoint(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SSEHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(python.mistral_client, 'endpoint', f"http://127.0.0.1:{server.server_port}/v1/chat/completions")
+    yield
+    server.shutdown()
+
+def test_stream_decodes_events_as_utf8(sse_endpoint):
+    text = "".join(python.stream_medical_response("I have a fever"))
+    assert text == "A fever of 38.5°C – drink fluids, 休息."
+
+# Streams the first sentence of an answer, then drops the connection in the middle of the chunked body
+class TruncatingHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        event = f"data: {json.dumps({'choices': [{'delta': {'content': 'Rest and drink fluids. '}}]})}\n\n".encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+        self.wfile.flush()
+        self.close_connection = True
+
+@pytest.fixture
+def truncating_endpoint(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TruncatingHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(python.mistral_client, 'endpoint', f"http://127.0.0.1:{server.server_port}/v1/chat/completions")
+    monkeypatch.setattr(python, 'MISTRAL_STREAM', True)
+    yield
+    server.shutdown()
+
+def test_stream_raises_when_the_answer_is_cut_off(truncating_endpoint):
+    chunks = []
+    with pytest.raises(python.MistralError):
+        for chunk in python.stream_medical_response("I have a cold"):
+            chunks.append(chunk)
+    assert chunks == ['Rest and drink fluids. ']
+
+def test_cut_off_answer_is_neither_cached_nor_remembered(truncating_endpoint, monkeypatch):
+    monkeypatch.setattr(python, 'response_cache', python.ResponseCache())
+    session = python.Session('truncated-answer')
+    events = []
+    monkeypatch.setattr(session, 'emit', lambda event, data=None: events.append((event, data)))
+    monkeypatch.setattr(session, 'queue_tts', lambda token, sentence: None)
+    token = session.next_token()
+
+    asyncio.run_coroutine_threadsafe(python.stream_response(session, "I have a cold", token), python.answer_loop).result(10)
+    errors = [data['message'] for event, data in events if event == 'error_message']
+    assert len(errors) == 1 and errors[0].startswith(python.MISTRAL_ERROR_PREFIX)
+    texts = [data.get('delta') for event, data in events if event == 'response_stream']
+    assert not any(python.MISTRAL_ERROR_PREFIX in (text or '') for text in texts)
+    assert not any(data.get('is_final') for event, data in events if event == 'response_stream')
+    assert python.response_cache.get("I have a cold") is None
+    assert session.conversation.is_empty()
+
+@pytest.mark.parametrize('reuse, connections', [(True, 1), (False, 3)])
+def test_connection_reuse_can_be_turned_off(reuse, connections):
+    args = Namespace(llm_first_byte=0.0, llm_token_delay=0.0, jitter=0.0, llm_connect_delay=0.0)
+    server = benchmark.start_stub_mistral(args, benchmark.load_corpus())
+    try:
+        client = python.MistralClient(f"http://127.0.0.1:{server.server_port}/v1/chat/completions",
+                                      reuse_connections=reuse)
+        for question in benchmark.QUESTIONS[:3]:
+            headers, data = python.build_mistral_request(question)
+            assert client.post(data, headers).json()['choices']
+        assert server.connections == connections
+    finally:
+        server.shutdown()
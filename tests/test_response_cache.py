@@ -0,0 +1,43 @@
+import pytest
+
+from python import ResponseCache
+
+@pytest.mark.parametrize('cached, asked', [
+    ("Can I take ibuprofen while pregnant?", "Can I take ibuprofen while not pregnant?"),
+    ("How much aspirin can a 12 year old take?", "How much aspirin can a 2 year old take?"),
+    ("Is it safe to take aspirin with alcohol?", "Is it safe to take aspirin without alcohol?"),
+    ("Can I take ibuprofen with warfarin?", "Can I take aspirin with warfarin?"),
+    ("Should I take paracetamol for a fever?", "Should I not take paracetamol for a fever?"),
+    ("I don't have a fever, should I worry?", "I have a fever, should I worry?"),
+])
+def test_near_duplicates_must_agree_on_meaning(cached, asked):
+    cache = ResponseCache()
+    cache.put(cached, "cached answer")
+    assert cache.get(asked) is None
+    assert cache.stats['similar_hits'] == 0
+
+@pytest.mark.parametrize('cached, asked', [
+    ("Can I take ibuprofen while pregnant?", "can i take ibuprofen while pregnant"),
+    ("What helps a sore throat?", "Hi, what really helps for a sore throat please?"),
+    ("Is aspirin safe with alcohol?", "Is alcohol safe with aspirin?"),
+])
+def test_rephrasings_hit(cached, asked):
+    cache = ResponseCache()
+    cache.put(cached, "cached answer")
+    assert cache.get(asked) == "cached answer"
+
+def test_lower_threshold_still_requires_numbers_and_negations():
+    cache = ResponseCache(threshold=0.5)
+    cache.put("How much aspirin can a 12 year old take?", "cached answer")
+    cache.put("Is it safe to take aspirin with alcohol?", "other answer")
+    assert cache.get("How much aspirin can a 2 year old take?") is None
+    assert cache.get("Is it safe to take aspirin without alcohol?") is None
+    assert cache.get("How much aspirin can a 12 year old child take?") == "cached answer"
+
+def test_eviction_clears_index():
+    cache = ResponseCache(max_entries=1)
+    cache.put("What helps a sore throat?", "first")
+    cache.put("What helps a headache?", "second")
+    assert cache.get("What helps a sore throat?") is None
+    assert 'sore' not in cache.index
+    assert cache.stats['evictions'] == 1
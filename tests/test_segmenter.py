@@ -0,0 +1,54 @@
+import re
+
+import pytest
+
+import python
+
+# Feed the text a word at a time, the way Mistral streams it, then flush
+def segment(text):
+    segmenter = python.SpeechSegmenter()
+    chunks = []
+    for token in re.findall(r'\s*\S+', text):
+        chunks += segmenter.feed(token)
+    return chunks + segmenter.flush()
+
+@pytest.mark.parametrize('text, chunks', [
+    ("Please see Dr. Smith about the rash. He can check whether it needs a cream or tablets.",
+     ["Please see Dr. Smith about the rash.", "He can check whether it needs a cream or tablets."]),
+    ("You can take a pain reliever, e.g. Ibuprofen, with food. Do not take more than the label says.",
+     ["You can take a pain reliever, e.g. Ibuprofen, with food.", "Do not take more than the label says."]),
+    ("Give 0.5 mg per kilogram of body weight. Repeat every six hours if needed.",
+     ["Give 0.5 mg per kilogram of body weight.", "Repeat every six hours if needed."]),
+])
+def test_abbreviations_and_decimals_do_not_end_a_sentence(text, chunks):
+    assert segment(text) == chunks
+
+def test_list_numbers_stay_with_their_item():
+    text = ("Try these steps for a sprain:\n1. Rest the ankle for two days.\n"
+            "2. Ice it for twenty minutes at a time.\n3. Keep it raised.")
+    assert segment(text) == ["Try these steps for a sprain:", "1. Rest the ankle for two days.",
+                             "2. Ice it for twenty minutes at a time.", "3. Keep it raised."]
+
+def test_short_sentences_are_merged_after_the_first():
+    chunks = segment("Rest. Drink water. Sleep well. Eat soup. Stay warm. Call us. Take care. Feel better.")
+    # The first chunk goes out at once; the rest wait until they are long enough, except the final flush
+    assert chunks == ["Rest.", "Drink water. Sleep well. Eat soup.", "Stay warm. Call us. Take care.", "Feel better."]
+    segmenter = python.SpeechSegmenter()
+    assert all(len(chunk) >= segmenter.min_chars for chunk in chunks[1:-1])
+
+def test_long_sentences_are_split_at_clauses():
+    text = ("A sore throat usually gets better on its own within a week, but you should see a doctor if you have "
+            "a high fever, trouble swallowing or breathing, a rash, swollen glands in your neck, or if the pain "
+            "lasts longer than a week despite rest and fluids.")
+    chunks = segment(text)
+    segmenter = python.SpeechSegmenter()
+    assert " ".join(chunks) == text
+    assert chunks[0] == "A sore throat usually gets better on its own within a week,"
+    assert len(chunks[0]) <= segmenter.first_max_chars
+    assert all(len(chunk) <= segmenter.max_chars for chunk in chunks)
+    assert all(chunk.endswith((',', '.')) for chunk in chunks)
+
+def test_streamed_and_whole_text_give_the_same_chunks():
+    text = "Please see Dr. Smith about the rash. Give 0.5 mg twice a day, e.g. Morning and evening. Rest."
+    segmenter = python.SpeechSegmenter()
+    assert segmenter.feed(text) + segmenter.flush() == segment(text)
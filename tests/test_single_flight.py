@@ -0,0 +1,79 @@
+import asyncio
+
+import python
+
+# An upstream call fed by hand: chunks put on the queue are yielded, an exception is raised, None ends it
+class Upstream:
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.closed = False
+
+    async def produce(self, info):
+        try:
+            while (item := await self.queue.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.closed = True
+
+async def consume(call, received):
+    async for chunk in call.replay():
+        received.append(chunk)
+
+async def settle():
+    await asyncio.sleep(0.01)
+
+def run(scenario):
+    return asyncio.run_coroutine_threadsafe(scenario(), python.answer_loop).result(10)
+
+def test_a_waiter_leaving_does_not_cut_off_the_others():
+    async def scenario():
+        flights, upstream = python.SingleFlight('test'), Upstream()
+        call = flights.join('key', upstream.produce)
+        assert flights.join('key', upstream.produce) is call
+        leaving, staying = [], []
+        leaver = asyncio.ensure_future(consume(call, leaving))
+        stayer = asyncio.ensure_future(consume(call, staying))
+        upstream.queue.put_nowait("Rest. ")
+        await settle()
+        leaver.cancel()
+        await settle()
+        for item in ("Drink fluids. ", "See a doctor. ", None):
+            upstream.queue.put_nowait(item)
+        await stayer
+        assert leaving == ["Rest. "]
+        assert staying == ["Rest. ", "Drink fluids. ", "See a doctor. "]
+        assert not call.task.cancelled()
+        assert flights.snapshot() == {'calls': 1, 'shared': 1, 'cancelled': 0, 'in_flight': 0}
+    run(scenario)
+
+def test_upstream_is_cancelled_only_when_the_last_waiter_leaves():
+    async def scenario():
+        flights, upstream = python.SingleFlight('test'), Upstream()
+        call = flights.join('key', upstream.produce)
+        waiters = [asyncio.ensure_future(consume(flights.join('key', upstream.produce), [])) for _ in range(2)]
+        upstream.queue.put_nowait("Rest. ")
+        await settle()
+        waiters[0].cancel()
+        await settle()
+        assert call.waiters == 1 and not call.task.done() and not upstream.closed
+        assert flights.calls == {'key': call}
+        waiters[1].cancel()
+        await settle()
+        assert call.waiters == 0 and call.task.cancelled() and upstream.closed
+        assert flights.snapshot()['cancelled'] == 1 and flights.snapshot()['in_flight'] == 0
+    run(scenario)
+
+def test_an_upstream_error_is_raised_to_every_waiter():
+    async def scenario():
+        flights, upstream = python.SingleFlight('test'), Upstream()
+        received = [[], [], []]
+        waiters = [consume(flights.join('key', upstream.produce), chunks) for chunks in received]
+        upstream.queue.put_nowait("Rest. ")
+        upstream.queue.put_nowait(python.MistralError(f"{python.MISTRAL_ERROR_PREFIX} connection reset"))
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert all(isinstance(result, python.MistralError) for result in results)
+        assert received == [["Rest. "]] * 3
+        assert flights.snapshot() == {'calls': 1, 'shared': 2, 'cancelled': 0, 'in_flight': 0}
+    run(scenario)
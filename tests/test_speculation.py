@@ -0,0 +1,68 @@
+import asyncio
+import types
+
+import pytest
+
+import python
+
+class FakeSpeculation:
+    def __init__(self, session, prompt):
+        self.prompt = prompt
+        self.error = None
+        self.started = 0.0
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+@pytest.fixture
+def speculations(monkeypatch):
+    monkeypatch.setattr(python, 'Speculation', FakeSpeculation)
+    monkeypatch.setattr(python, 'SPECULATION_ENABLED', True)
+
+def hear(speculator, partial):
+    for _ in range(python.SPECULATION_STABLE_CHUNKS + 1):
+        speculator.observe(partial)
+
+def test_negations_and_numbers_never_match():
+    assert python.prompt_similarity("is it safe to take aspirin with alcohol",
+                                    "is it safe to take aspirin without alcohol") == 0.0
+    assert python.prompt_similarity("how much aspirin for a 12 year old", "how much aspirin for a 2 year old") == 0.0
+    assert python.prompt_similarity("I have a headache after working all day",
+                                    "I have a headache after working all day.") >= python.SPECULATION_MATCH_THRESHOLD
+
+def test_speculation_is_refused_for_a_negated_final_transcript(speculations):
+    speculator = python.Speculator(types.SimpleNamespace(sid='speculation-1'))
+    hear(speculator, "is it safe to take aspirin with alcohol")
+    speculation = speculator.speculation
+    assert speculator.resolve("is it safe to take aspirin without alcohol") is None
+    assert speculation.cancelled
+
+def test_budget_is_refilled_for_each_utterance(speculations):
+    session = types.SimpleNamespace(sid='speculation-2')
+    for _ in range(3):
+        speculator = python.Speculator(session)
+        started = []
+        for partial in ("what should I take", "what should I take for a cold", "what should I take for a sore throat",
+                        "what should I take for a sore throat and a fever"):
+            hear(speculator, partial)
+            if speculator.speculation and speculator.speculation not in started:
+                started.append(speculator.speculation)
+        assert len(started) == python.SPECULATION_BUDGET
+        assert speculator.resolve("what is good for back pain") is None
+
+def test_replay_raises_a_failure_after_partial_content(monkeypatch):
+    async def failing_fetch(session, prompt, context, usage):
+        yield "Rest and drink fluids. "
+        raise python.MistralError(f"{python.MISTRAL_ERROR_PREFIX} connection reset")
+    monkeypatch.setattr(python, 'fetch_medical_response', failing_fetch)
+    session = python.Session('speculation-3')
+
+    async def replay():
+        chunks = []
+        speculation = python.Speculation(session, "I have a cold")
+        with pytest.raises(python.MistralError):
+            async for chunk in speculation.replay():
+                chunks.append(chunk)
+        return chunks
+    assert asyncio.run_coroutine_threadsafe(replay(), python.answer_loop).result(10) == ["Rest and drink fluids. "]
@@ -0,0 +1,103 @@
+import asyncio
+import os
+import types
+import wave
+
+import pytest
+import speech_recognition as sr
+
+import python
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fixtures', 'speech')
+CHUNK_SECONDS = 0.1
+
+def load_chunks(name):
+    with wave.open(os.path.join(FIXTURES, name), 'rb') as recording:
+        rate = recording.getframerate()
+        pcm = recording.readframes(recording.getnframes())
+    step = int(rate * CHUNK_SECONDS) * 2
+    return rate, [pcm[i:i + step] for i in range(0, len(pcm), step)]
+
+# Seconds of audio the detector consumes before it ends the utterance
+def detect_end(name, session=None):
+    rate, chunks = load_chunks(name)
+    session = session or types.SimpleNamespace(sid='detector', noise_floor=None)
+    detector = python.EndOfSpeechDetector(session, rate)
+    for chunk in chunks:
+        if detector.update(chunk):
+            return detector.elapsed
+    return None
+
+@pytest.mark.parametrize('name, speech_ends', [('quiet_room.wav', 2.4), ('noisy_room.wav', 2.8),
+                                               ('immediate_speech.wav', 1.8)])
+def test_utterance_ends_after_the_speaker_stops(name, speech_ends):
+    ended = detect_end(name)
+    assert ended == pytest.approx(speech_ends + python.STT_END_SILENCE_SECONDS, abs=0.25)
+
+# The floor a session learns while the user talks from the first moment must not deafen later utterances
+def test_speech_from_the_start_leaves_a_usable_noise_floor():
+    session = types.SimpleNamespace(sid='detector', noise_floor=None)
+    detect_end('immediate_speech.wav', session)
+    assert session.noise_floor < python.STT_MIN_SPEECH_RMS
+    for name, speech_ends in (('immediate_speech.wav', 1.8), ('quiet_room.wav', 2.4)):
+        assert detect_end(name, session) == pytest.approx(speech_ends + python.STT_END_SILENCE_SECONDS, abs=0.25)
+
+def test_silence_gives_up_after_no_speech_timeout():
+    with pytest.raises(sr.UnknownValueError):
+        detect_end('silence.wav')
+
+class FixtureSpeechBackend:
+    name = 'fixture'
+
+    def __init__(self):
+        self.received = 0
+
+    def start(self, sample_rate):
+        self.received = 0
+        return self
+
+    def accept(self, chunk):
+        self.received += len(chunk)
+        return None
+
+    def finish(self):
+        return "what helps a sore throat"
+
+@pytest.fixture
+def listening_session(monkeypatch):
+    backend = FixtureSpeechBackend()
+    monkeypatch.setattr(python, '_speech_backend', backend)
+    session = python.Session('speech-fixture')
+    events, answers = [], []
+    monkeypatch.setattr(session, 'emit', lambda event, *args: events.append((event,) + args))
+    monkeypatch.setattr(session, 'start_answer', lambda user_input, prefetched=None: answers.append(user_input))
+    return session, backend, events, answers
+
+def recognize(session, name):
+    rate, chunks = load_chunks(name)
+
+    async def drive():
+        queue = asyncio.Queue()
+        for chunk in chunks:
+            queue.put_nowait(chunk)
+        queue.put_nowait(None)
+        await python.recognize_speech(session, queue, rate)
+
+    asyncio.run_coroutine_threadsafe(drive(), python.answer_loop).result(30)
+    return rate
+
+def test_recognize_speech_stops_listening_at_end_of_speech(listening_session):
+    session, backend, events, answers = listening_session
+    rate = recognize(session, 'noisy_room.wav')
+    heard = backend.received / (rate * 2)
+    assert heard == pytest.approx(2.8 + python.STT_END_SILENCE_SECONDS, abs=0.25)
+    assert ('speech_recognized', {'text': "what helps a sore throat"}) in events
+    assert answers == ["what helps a sore throat"]
+    assert python.stt_pool.snapshot()['active'] == 0
+
+def test_recognize_speech_reports_silence(listening_session):
+    session, backend, events, answers = listening_session
+    recognize(session, 'silence.wav')
+    assert answers == []
+    assert any(event == 'error_message' for event, *_ in events)
+    assert events[-1] == ('listening_status', {'status': False})
@@ -0,0 +1,64 @@
+import asyncio
+import threading
+import time
+
+import python
+
+class FakeEngine(python.TTSEngine):
+    name = 'fake'
+    voice = 'en'
+    mime = 'audio/wav'
+    extension = 'wav'
+
+    def synthesize(self, text):
+        return text.encode('utf-8')
+
+    def stream(self, text, cancellation=None):
+        yield text.encode('utf-8')
+
+    def assemble(self, chunks):
+        return b''.join(chunks)
+
+class RecordingCache(python.AudioCache):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append(('get', threading.current_thread()))
+        return super().get(key)
+
+    def put(self, key, audio):
+        self.calls.append(('put', threading.current_thread()))
+        super().put(key, audio)
+
+def clip(text):
+    async def collect():
+        return [audio async for audio in python.synthesize_clip(text)]
+    return asyncio.run_coroutine_threadsafe(collect(), python.answer_loop).result(10)
+
+def test_disk_cache_is_used_off_the_event_loop(tmp_path, monkeypatch):
+    cache = RecordingCache(1024 * 1024, str(tmp_path), 1024 * 1024)
+    monkeypatch.setattr(python, 'tts_cache', cache)
+    monkeypatch.setattr(python, '_tts_engine', FakeEngine())
+
+    assert clip("Rest and drink fluids.") == [b"Rest and drink fluids."]
+    deadline = time.monotonic() + 5
+    while len(cache.calls) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert clip("Rest and drink fluids.") == [b"Rest and drink fluids."]
+
+    assert [kind for kind, _ in cache.calls] == ['get', 'put', 'get']
+    assert python.answer_loop_thread not in [thread for _, thread in cache.calls]
+    assert cache.snapshot()['hits'] == 1
+    assert [path.suffix for path in tmp_path.iterdir()] == ['.wav']
+
+def test_disk_files_are_named_after_their_format(tmp_path):
+    cache = python.AudioCache(1024, str(tmp_path), 1024 * 1024)
+    cache.put(python.AudioCache.key("Rest.", 'en', 'gtts', 'mp3'), b'mp3 audio')
+    cache.put(python.AudioCache.key("Rest.", 'en', 'espeak', 'wav'), b'RIFF audio')
+    assert sorted(path.suffix for path in tmp_path.iterdir()) == ['.mp3', '.wav']
+
+    reloaded = python.AudioCache(1024, str(tmp_path), 1024 * 1024)
+    assert reloaded.disk_bytes == len(b'mp3 audio') + len(b'RIFF audio')
+    assert reloaded.get(python.AudioCache.key("Rest.", 'en', 'espeak', 'wav')) == b'RIFF audio'
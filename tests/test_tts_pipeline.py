@@ -0,0 +1,42 @@
+import python
+
+class LoopRecorder:
+    def __init__(self):
+        self.calls = []
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.calls.append(callback)
+
+def make_session(monkeypatch, sid):
+    monkeypatch.setattr(python, 'answer_loop', LoopRecorder())
+    session = python.Session(sid)
+    events = []
+    monkeypatch.setattr(session, 'emit', lambda event, *args: events.append((event,) + args))
+    return session, events
+
+def start_sentence(session, token):
+    session.tts._reset(token)
+    session.tts.next_seq = 1
+    session.tts.sentences[0] = {'audio': [], 'chunks_sent': 0, 'done': False, 'error': None}
+
+def test_audio_of_cancelled_answer_is_not_sent_after_stop_audio(monkeypatch):
+    session, events = make_session(monkeypatch, 'stale-audio-1')
+    token = session.next_token()
+    start_sentence(session, token)
+    session.tts._add(token, 0, 'chunk', b'before')
+    assert [event[0] for event in events] == ['play_audio_chunk']
+
+    # The pipeline is only reset once answer_loop gets to it; audio arriving before then must be dropped
+    session.start_answer("next question")
+    session.tts._add(token, 0, 'chunk', b'after')
+    session.tts._complete(token, 0, None)
+    assert [event[0] for event in events] == ['play_audio_chunk', 'stop_audio']
+    assert events[1][1] == {'token': token + 1}
+
+def test_cancel_announces_the_new_token(monkeypatch):
+    session, events = make_session(monkeypatch, 'stale-audio-2')
+    token = session.next_token()
+    start_sentence(session, token)
+    session.cancel()
+    session.tts._add(token, 0, 'clip', b'late')
+    assert events == [('stop_audio', {'token': token + 1})]
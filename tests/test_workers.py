@@ -0,0 +1,99 @@
+import os
+import subprocess
+import sys
+import time
+from argparse import Namespace
+
+import pytest
+import requests
+import socketio
+
+import benchmark
+
+WORKER_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker_app.py')
+QUESTION = "I have a headache after working all day"
+
+class Recorder:
+    def __init__(self, url, session_id):
+        self.events = []
+        self.sio = socketio.Client(reconnection=False)
+        for event in ('response_stream', 'play_audio', 'play_audio_chunk', 'stop_audio'):
+            self.sio.on(event, lambda data=None, event=event: self.events.append((time.monotonic(), event, data)))
+        self.sio.connect(url, auth={'session_id': session_id}, transports=['websocket'])
+
+    def answer_events(self, token, since=0.0):
+        return [(at, event) for at, event, data in self.events
+                if event != 'stop_audio' and at >= since and data.get('message_id', data.get('token')) == token]
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.02)
+
+@pytest.fixture
+def stub_mistral():
+    corpus = benchmark.load_corpus()
+    args = Namespace(llm_first_byte=0.05, llm_token_delay=0.05, jitter=0.0, llm_connect_delay=0.0)
+    server = benchmark.start_stub_mistral(args, corpus)
+    yield server
+    server.shutdown()
+
+@pytest.fixture
+def workers(tmp_path, stub_mistral):
+    env = dict(os.environ, LOG_LEVEL='WARNING',
+               SOCKETIO_MESSAGE_QUEUE=f"sqlite:///{tmp_path / 'queue.db'}",
+               SESSION_STORE_URL=f"sqlite:///{tmp_path / 'sessions.db'}")
+    endpoint = f"http://127.0.0.1:{stub_mistral.server_port}/v1/chat/completions"
+    urls, processes = [], []
+    for _ in range(2):
+        port = benchmark.free_port()
+        processes.append(subprocess.Popen([sys.executable, WORKER_APP, str(port), endpoint], env=env))
+        urls.append(f"http://127.0.0.1:{port}")
+    try:
+        for url in urls:
+            wait_for(lambda: ready(url), timeout=30)
+        yield urls
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+def ready(url):
+    try:
+        return requests.get(f"{url}/pools", timeout=1).ok
+    except requests.exceptions.ConnectionError:
+        return False
+
+def test_cancel_on_another_worker_stops_the_answer(workers, stub_mistral):
+    worker_a, worker_b = workers
+    session_id = f"cross-worker-{os.getpid()}"
+    client_a = Recorder(worker_a, session_id)
+    client_b = None
+    try:
+        client_a.sio.emit('send_message', {'message': QUESTION})
+        wait_for(lambda: any(event == 'response_stream' for _, event, _ in client_a.events))
+        token = next(data['message_id'] for _, event, data in client_a.events if event == 'response_stream')
+        upstream = stub_mistral.requests[-1]
+        assert upstream['ended'] is None
+
+        # The same session, connected to worker B, stops the answer worker A is streaming
+        client_b = Recorder(worker_b, session_id)
+        client_b.sio.emit('stop_answer')
+        wait_for(lambda: any(event == 'stop_audio' for _, event, _ in client_a.events))
+        wait_for(lambda: upstream['ended'] is not None, timeout=5)
+        stopped = time.monotonic()
+        assert upstream['aborted']
+        assert upstream['tokens'] < upstream['total_tokens']
+
+        # Anything worker A emits for the cancelled answer after this is a leak
+        time.sleep(1.0)
+        assert client_a.answer_events(token, since=stopped + 0.3) == []
+        finals = [data for _, event, data in client_a.events if event == 'response_stream' and data.get('is_final')]
+        assert finals == []
+    finally:
+        client_a.sio.disconnect()
+        if client_b is not None:
+            client_b.sio.disconnect()
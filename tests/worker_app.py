@@ -0,0 +1,21 @@
+# One app worker for the multi-worker tests: python worker_app.py PORT MISTRAL_ENDPOINT, with the message
+# queue and session store taken from the environment. Speech comes from the benchmark's stub TTS engine.
+import logging
+import os
+import sys
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import benchmark
+
+app = benchmark.app
+
+if __name__ == '__main__':
+    port, endpoint = int(sys.argv[1]), sys.argv[2]
+    app.mistral_client.endpoint = endpoint
+    app.TTS_ENGINES['stub'] = partial(benchmark.StubTTSEngine, 0.01, 0.0, 0.0)
+    app.TTS_ENGINE = 'stub'
+    logging.getLogger('werkzeug').setLevel(logging.CRITICAL)
+    app.socketio.run(app.app, host='127.0.0.1', port=port, allow_unsafe_werkzeug=True)